@@ -1,6 +1,9 @@
 # Import Necessary Modules
-from SURFING.reduce import reduce_combined_p0_p1,reduce_individual_p0_p1
-from SURFING.postprocess import moment0_residuals,coadd_results,convert_to_fits
+import logging
+import sys
+from SURFING.pipeline import build_pipeline
+from SURFING.products import ProductIndex
+from SURFING import backend,instrument,jobqueue,plan,scratch,screening
 
 #-------------------------------------------------------------------------------------------
 #####
@@ -27,6 +30,71 @@ recipe      = 'REDUCE_SCIENCE_NARROWLINE'
 # This can be confirmed in the Het Setup of the JCMTOT.
 mol_subband = {'C18O':1,'13CO':2,'CO':3}
 
+# The number of steps to run at once. Each datescan is reduced three times (P0+P1 combined, P0 alone
+# and P1 alone) and then post-processed -- these steps are shared out over this many workers.
+# 1 runs everything one after the other.
+nprocs      = 1
+
+# If a previous run was interrupted, skip the steps it finished. Set to False to start again from the top.
+resume      = True
+
+# Reductions are recorded in reduced/manifest.json along with a fingerprint of their inputs (raw files,
+# recipe, parfile contents and bad receptors). Datescans already reduced from the same inputs are skipped.
+# Set to True to reduce everything again regardless.
+force       = False
+
+# How to co-add the new observations with the main files:
+# 'wcsmosaic'   re-mosaics the new observations together with the whole existing co-add
+# 'incremental' keeps a running weighted sum per region and molecule in coadds/<region>_<mol>_store/
+#               and only touches the part of it covered by the new data
+# 'tiled'       mosaics the new data and the whole existing co-add in spatial tiles on nprocs worker
+#               processes, using at most about coadd_tile_mb of memory per worker -- for large regions
+coadd_engine = 'wcsmosaic'
+coadd_tile_mb = 256
+
+# Which reduced products to convert to FITS, as lists of file name patterns, e.g.
+# fits_include = ['ga*reduced*','*integ*'] converts only the reduced cubes and the moment 0 maps.
+# None converts everything (include) / excludes nothing (exclude).
+# Files whose FITS copy is already newer than the SDF file are never converted again.
+fits_include = None
+fits_exclude = None
+
+# The format of those copies, and of the co-adds' copies:
+# 'fits'    plain FITS
+# 'fits.fz' tile-compressed FITS (needs astropy) -- lossless, typically a fraction of the size
+# 'h5'      chunked, compressed HDF5 (needs h5py)
+# 'zarr'    a chunked, compressed Zarr store (needs zarr)
+# The compressed formats can be read a spectrum or a range of channels at a time without reading the whole cube,
+# with SURFING.cubeformats.open_cube.
+output_format = 'fits'
+
+# Quick-look images of each datescan (moment 0 maps, P1-P0 residual and the spectrum of the brightest region, for the
+# combined, P0 and P1 reductions) for checking the reductions by eye, with a contact sheet of the whole batch in
+# reduced/quicklook.html. The maps are binned by quicklook_binning x quicklook_binning pixels. None makes no quick-looks.
+quicklook_binning = 4
+
+# A fast local disk (e.g. local NVMe or /dev/shm) to stage the raw files and run ORACDR in, or None to read the
+# raw files from raw/ and run ORACDR in reduced/. Each datescan's raw files are copied there once, ahead of time,
+# and read by all three of its reductions. scratch_budget_gb limits the space the staged raw files may use (0 = no limit).
+scratch_dir       = None
+scratch_budget_gb = 0
+
+# Put the datescans in the batch queue (reduced/queue.sqlite) and work through it, rather than running them here as
+# one batch. Other copies of SURFING -- for other regions or nights, on this or other machines sharing this directory --
+# can work on the same queue at the same time, e.g. with: python -m SURFING.jobqueue work --nprocs 4
+use_queue = False
+
+# Before reducing, screen each receptor's raw data (baseline noise, spikes and Tsys) and leave any that misbehave out
+# of all three reductions (see SURFING/screening.py). The results are kept in reduced/screening/.
+screen_receptors = True
+
+# The Starlink installation to use
+starpath = '/star'
+
+# Only report what a run would do -- which reductions, residuals, co-adds and conversions would run, and which raw or
+# product files are missing -- without running anything (or starting Starlink). Also set by: python SURFING.py --dry-run
+dry_run = False
+
 #-------------------------------------------------------------------------------------------
 
 ###########################################
@@ -36,41 +104,59 @@ mol_subband = {'C18O':1,'13CO':2,'CO':3}
 ###########################################
 
 #####
-# Begin the reduction! Start with the combined P0 and P1 reduction
-#####
-
-print('Reducing P0 and P1 together...')
-reduce_combined_p0_p1(datescans,recipe,parfile=parfile)
-
-#####
-# Now, reduce P0 and P1 individually to see if we have an issue with an individual detector (QA testing)
-#####
-
-print('\nReducing P0 and P1 separately...')
-reduce_individual_p0_p1(datescans,recipe,parfile=parfile)
-
-#####
-# Now, make P1-P0 subtraction maps for Moment 0 to assess residual for structure
-# In a perfect world, this would produce a blank map, but sometimes artifacts/sensitivity differences
-# can lead to different signals from the two detectors (P0 and P1)
-#####
-
-print('\nSubtracting P0 Moment 0 maps from P1 Moment 0 maps...')
-moment0_residuals(datescans,mol_subband)
-
-#####
-# Produce final co-add including the new observations
-#####
-
-print('\nCo-adding the results with the main files...')
-coadd_results(datescans,mol_subband,region)
-
-#####
-# Convert SDF to FITS for convenience
+# The whole batch is run as a graph of tasks (see SURFING/pipeline.py). Per datescan: reduce P0 and P1 together,
+# reduce P0 and P1 individually to see if we have an issue with an individual detector (QA testing),
+# make P1-P0 subtraction maps for Moment 0 to assess residual for structure and convert the SDF files to FITS
+# for "non-Starlink" people ;p. Then co-add each molecule's new observations with the main files.
+# Each step starts as soon as the steps it needs have finished, so one datescan's residuals and FITS conversion
+# run while ORACDR works on the next. If the run is interrupted, running it again picks up where it left off.
 #####
 
-print('\nConverting SDF files to FITS for "non-Starlink" people ;p...')
-convert_to_fits(datescans)
+backend.configure(starpath=starpath)
+screening.configure(screen_receptors)
+
+if dry_run or '--dry-run' in sys.argv[1:]:
+    print(plan.format_plan(plan.plan(region,datescans,recipe,mol_subband,parfile=parfile,force=force,fits_include=fits_include,
+                                     fits_exclude=fits_exclude,output_format=output_format)))
+    sys.exit(0)
+
+logging.basicConfig(level=logging.INFO)
+instrument.configure()
+scratch.configure(scratch_dir,scratch_budget_gb)
+
+if use_queue:
+    queued = jobqueue.submit(region,datescans,recipe=recipe,parfile=parfile,mol_subband=mol_subband,force=force,
+                             coadd_engine=coadd_engine,coadd_tile_mb=coadd_tile_mb,fits_include=fits_include,fits_exclude=fits_exclude,
+                             quicklook_binning=quicklook_binning,output_format=output_format)
+    print('{} datescan(s) added to the queue.'.format(queued))
+    nrun,nfailed = jobqueue.work(nprocs=nprocs)
+    print('\nRan {} job(s), {} failed.'.format(nrun,nfailed))
+    print(jobqueue.status_table())
+
+else:
+    index = ProductIndex.load(datescans)
+    graph = build_pipeline(region,datescans,recipe,mol_subband,parfile=parfile,force=force,coadd_engine=coadd_engine,
+                           fits_include=fits_include,fits_exclude=fits_exclude,index=index,
+                           coadd_nprocs=nprocs,coadd_tile_mb=coadd_tile_mb,quicklook_binning=quicklook_binning,
+                           output_format=output_format)
+
+    print('Running {} tasks for {} datescan(s)...'.format(len(graph.tasks),len(datescans)))
+    prefetcher = scratch.prefetch(datescans)
+    success = graph.run(nworkers=nprocs,resume=resume)
+    prefetcher.join()
+    index.update()
+    index.save()
+    if not success:
+        print('\n{} task(s) failed -- see the messages above. Run again to retry them.'.format(len(graph.failed)))
+
+# Where did the time go? Every stage and Starlink call of this run is recorded in reduced/run_records.jsonl
+# (with nprocs > 1, the Starlink processes' CPU and memory can't be given to one of several stages running at once --
+# those records are counted in the 'shared' column, see SURFING/instrument.py)
+records = instrument.load_records(run=instrument.RUN_ID)
+print('\nTime spent by stage and Starlink command:')
+print(instrument.summary_table(records,by='name'))
+print('\nThe slowest datescans:')
+print(instrument.summary_table(records,by='datescan',kind='stage',top=10))
 
 print('\n\n######################')
 print('              ___            ___')
@@ -0,0 +1,88 @@
+import importlib
+import os
+import threading
+import types
+
+#####
+# The Starlink backend: the wrapper (ORACDR), kappa, convert and hds modules of the Starlink python wrapper.
+#
+# SURFING modules use backend.wrapper, backend.kappa, backend.convert and backend.hds rather than importing starlink
+# themselves, and nothing is loaded until the first time one of them is actually used. So SURFING can be imported --
+# e.g. to plan a run (see SURFING.plan), or on a host with no Starlink installation -- without paying for Starlink's
+# start up, or failing because there is no /star.
+#
+# The backend is pluggable. BACKEND names a module with a load(starpath) function returning an object with wrapper,
+# kappa, convert and hds attributes: 'starlink' (the default) is the Starlink python wrapper itself, and the benchmark
+# uses 'SURFING.bench.stubstar'. STARPATH is the Starlink installation to use.
+# Both can be set with configure() or with $SURFING_BACKEND and $SURFING_STARPATH (default $STARLINK_DIR, then /star),
+# and are passed on to worker processes through the environment.
+#####
+
+BACKEND  = os.environ.get('SURFING_BACKEND','starlink')
+STARPATH = os.environ.get('SURFING_STARPATH',os.environ.get('STARLINK_DIR','/star'))
+
+_lock   = threading.Lock()
+_loaded = None
+
+def configure(starpath=None,backend=None):
+    '''
+    Choose the Starlink installation and/or the backend. Takes effect the next time Starlink is used.
+
+    starpath: The Starlink installation directory e.g. '/star'. None leaves it as it is
+    backend : The name of the backend module, see above. None leaves it as it is
+    '''
+    global BACKEND,STARPATH,_loaded
+    with _lock:
+        if starpath is not None:
+            STARPATH = starpath
+        if backend is not None:
+            BACKEND = backend
+        _loaded = None
+        os.environ['SURFING_STARPATH'] = STARPATH
+        os.environ['SURFING_BACKEND']  = BACKEND
+
+def _load_starlink(starpath):
+    '''
+    Load the Starlink python wrapper, pointed at the Starlink installation in starpath
+    '''
+    from starlink import wrapper,kappa,convert,hds
+    wrapper.change_starpath(starpath)
+    return types.SimpleNamespace(wrapper=wrapper,kappa=kappa,convert=convert,hds=hds)
+
+def load():
+    '''
+    Load the backend, if it isn't loaded already, and return it
+    '''
+    global _loaded
+    with _lock:
+        if _loaded is None:
+            if BACKEND == 'starlink':
+                _loaded = _load_starlink(STARPATH)
+            else:
+                _loaded = importlib.import_module(BACKEND).load(STARPATH)
+        return _loaded
+
+def loaded():
+    '''
+    True if the backend has been loaded
+    '''
+    return _loaded is not None
+
+class _Lazy:
+    '''
+    One module of the backend, which loads the backend the first time anything is looked up in it
+    '''
+
+    def __init__(self,name):
+        self._name = name
+
+    def __getattr__(self,attr):
+        return getattr(getattr(load(),self._name),attr)
+
+    def __repr__(self):
+        return '<SURFING.backend.{} ({}, {})>'.format(self._name,BACKEND,'loaded' if loaded() else 'not loaded yet')
+
+wrapper = _Lazy('wrapper')
+kappa   = _Lazy('kappa')
+convert = _Lazy('convert')
+hds     = _Lazy('hds')
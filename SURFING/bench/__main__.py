@@ -0,0 +1,7 @@
+import sys
+from SURFING.bench.run import failed_checks,main
+
+failures = failed_checks(main())
+for eachfailure in failures:
+    print('Oh no! Check failed -- {}'.format(eachfailure))
+sys.exit(1 if len(failures) > 0 else 0)
@@ -0,0 +1,275 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import time
+import numpy as np
+from SURFING.bench import stubstar
+
+#####
+# Benchmark the SURFING pipeline stages on synthetic data with the stub Starlink backend (SURFING.bench.stubstar).
+#
+# For each batch size, a fresh working directory is filled with synthetic raw data and the stages are run in turn:
+#     reduce    : reduce_all (combined, P0 and P1 ORACDR runs)
+#     residuals : moment0_residuals
+#     quicklook : quicklook (and qlcached: the same again, when every quick-look is up to date)
+#     coadd     : coadd_results
+#     convert   : convert_to_fits (in --output-format)
+#     readspec  : read the centre spectrum of every coadd copy and reduced cube copy (lazily, with cubeformats.open_cube)
+# For each stage we report the wall and CPU time, the number of filesystem operations made from Python
+# (counted with an audit hook: opens, renames, removes, directory listings, copies, shell commands...)
+# and the bytes read and written by this process.
+#
+# The checks (receptor screening, --check-tiled and the output format round trip) are printed too, and if any of
+# them fails the benchmark exits with a non-zero status, so it can be used to catch regressions.
+#
+# Usage: python -m SURFING.bench --nscans 1 10 100
+#####
+
+# The audit events counted as filesystem operations
+FS_EVENTS = {'open','os.rename','os.remove','os.mkdir','os.rmdir','os.listdir','os.scandir','os.link','os.symlink',
+             'os.truncate','os.utime','os.chmod','glob.glob','shutil.copyfile','shutil.copymode','shutil.move',
+             'shutil.rmtree','os.system'}
+
+# The 12 Namakanui receptors: N = Namakanui, U|W|A = Uu|Aweoweo|Alaihi, 0|1 = Polarisation, U|L = Upper or Lower sideband
+RECEPTORS = ['N{}{}{}'.format(rx,pol,sb) for rx in 'UWA' for pol in '01' for sb in 'LU']
+
+_counts = {'fsops':0}
+
+def _audit(event,args):
+    if event in FS_EVENTS:
+        _counts['fsops'] += 1
+
+def _io_bytes():
+    '''
+    The bytes read and written by this process so far (from /proc/self/io), or (0,0) where that isn't available
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(':') for line in f)
+        return int(io['rchar']),int(io['wchar'])
+    except (OSError,KeyError,ValueError):
+        return 0,0
+
+@contextlib.contextmanager
+def measure(results,nscans,stage):
+    '''
+    Time a stage and count its filesystem operations and bytes moved, appending a record to results
+
+    results: The list of result dictionaries
+    nscans : The batch size
+    stage  : The name of the stage
+    '''
+    # Read /proc/self/io before counting, so reading it isn't counted as part of the stage
+    read0,written0 = _io_bytes()
+    fsops0 = _counts['fsops']
+    wall0  = time.perf_counter()
+    cpu0   = time.process_time()
+    yield
+    cpu1   = time.process_time()
+    wall1  = time.perf_counter()
+    fsops1 = _counts['fsops']
+    read1,written1 = _io_bytes()
+    results.append({'nscans':nscans,'stage':stage,'wall':wall1-wall0,'cpu':cpu1-cpu0,'fsops':fsops1-fsops0,
+                    'read':read1-read0,'written':written1-written0})
+
+def make_raw(datescan,nraw=2,ntime=200,nchan=256,seed=0,bad_receptor=None):
+    '''
+    Write synthetic raw ACSIS time-series files for one datescan under raw/<YYYYMMDD>/<SSSSS>/. Every receptor
+    sees noise and a bright line (10 sigma, over about 5% of the band), which the screening must not mistake for spikes.
+
+    datescan    : A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    nraw        : The number of raw files (subscans)
+    ntime       : The number of time samples per file
+    nchan       : The number of spectral channels
+    seed        : Random number seed
+    bad_receptor: A receptor to make misbehave (twice the noise and Tsys, and a few spikes), for the screening to find
+    '''
+    date,scan = datescan.split('_')[0],datescan.split('_')[-1].zfill(5)
+    rawpath   = os.path.join('raw',date,scan)
+    os.makedirs(rawpath,exist_ok=True)
+    rng  = np.random.default_rng([seed,int(scan)])
+    line = 10*np.exp(-0.5*((np.arange(nchan)-nchan/2)/(0.05*nchan/2.355))**2)
+    for i in range(nraw):
+        data = (rng.normal(0,1,(ntime,len(RECEPTORS),nchan))+line).astype(np.float32)
+        tsys = (250+rng.normal(0,5,(ntime,len(RECEPTORS)))).astype(np.float32)
+        if bad_receptor is not None:
+            r = RECEPTORS.index(bad_receptor)
+            data[:,r,:] = data[:,r,:]*2
+            data[rng.integers(0,ntime,ntime//10),r,rng.integers(0,nchan,ntime//10)] = 50
+            tsys[:,r]   = tsys[:,r]*2
+        more = {'ACSIS':{'RECEPTORS':np.array(RECEPTORS),'TSYS':tsys}}
+        stubstar.write_ndf(os.path.join(rawpath,'a{}_{}_01_{:04d}.sdf'.format(date,scan,i+1)),data,more=more)
+
+def run_batch(nscans,workdir,args):
+    '''
+    Run every stage for one batch size in a fresh working directory
+
+    nscans : The number of datescans in the batch
+    workdir: The directory to work in -- it is emptied first
+    args   : The parsed command line arguments
+
+    Returns the list of result dictionaries
+    '''
+    from SURFING.reduce import reduce_all
+    from SURFING.postprocess import moment0_residuals,coadd_results,convert_to_fits
+    from SURFING.products import ProductIndex
+    from SURFING import cubeformats,ndfio,quicklook,screening,tiledmosaic
+
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(os.path.join(workdir,'config'))
+    with open(os.path.join(workdir,'config','SURFING.ini'),'w') as f:
+        f.write('[REDUCE_SCIENCE_NARROWLINE]\nPIXEL_SCALE = 6.0\n')
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results     = []
+    datescans   = ['20220307_{}'.format(i+1) for i in range(nscans)]
+    mol_subband = {'C18O':1,'13CO':2,'CO':3}
+    try:
+        with open('bench.log','w') as log, contextlib.redirect_stdout(log):
+            for datescan in datescans:
+                make_raw(datescan,nraw=args.nraw,ntime=args.ntime,nchan=args.nchan,seed=args.seed,bad_receptor=args.bad_receptor)
+
+            with measure(results,nscans,'screen'):
+                screened = {datescan:screening.bad_receptors(datescan) for datescan in datescans}
+            expected = [] if args.bad_receptor is None else [args.bad_receptor]
+            results[-1]['check_screen'] = {'expected':expected,'wrong':sorted(i for i in screened if screened[i] != expected)}
+            with measure(results,nscans,'reduce'):
+                reduce_all(datescans,'REDUCE_SCIENCE_NARROWLINE',parfile='config/SURFING.ini',nprocs=args.nprocs)
+            with measure(results,nscans,'index'):
+                index = ProductIndex(datescans)
+            with measure(results,nscans,'residuals'):
+                moment0_residuals(datescans,mol_subband,index=index)
+            with measure(results,nscans,'quicklook'):
+                quicklook.quicklook(datescans,mol_subband,index=index)
+            with measure(results,nscans,'qlcached'):
+                quicklook.quicklook(datescans,mol_subband,index=index)
+            with measure(results,nscans,'coadd'):
+                coadd_results(datescans,mol_subband,'BENCH',engine=args.coadd_engine,index=index,
+                              nprocs=args.nprocs,max_tile_mb=args.max_tile_mb,output_format=args.output_format)
+            if args.check_tiled:
+                with measure(results,nscans,'tiled'):
+                    coadd_results(datescans,mol_subband,'BENCH_TILED',engine='tiled',index=index,
+                                  nprocs=args.nprocs,max_tile_mb=args.max_tile_mb)
+                results[-1]['check'] = {eachmol:tiledmosaic.compare('coadds/BENCH_TILED_{}_coadd.sdf'.format(eachmol),
+                                                                    'coadds/BENCH_{}_coadd.sdf'.format(eachmol))
+                                        for eachmol in mol_subband}
+            with measure(results,nscans,'convert'):
+                convert_to_fits(datescans,nprocs=args.nprocs,index=index,output_format=args.output_format)
+
+            # Read the centre spectrum of every cube from its copy, and check it against the SDF file
+            cubes = ['coadds/BENCH_{}_coadd.sdf'.format(i) for i in mol_subband]+index.query(datescans,kind='reduced')
+            with measure(results,nscans,'readspec'):
+                spectra = {}
+                for eachcube in cubes:
+                    with cubeformats.open_cube(cubeformats.output_path(eachcube,args.output_format)) as cube:
+                        y,x = [o+n//2 for o,n in zip(cube.origin[-2:],cube.shape[-2:])]
+                        spectra[eachcube] = (x,y,cube.spectrum(x,y))
+            mismatched = 0
+            for eachcube,(x,y,spectrum) in spectra.items():
+                data,origin = ndfio.read_ndf(eachcube)
+                if not np.array_equal(spectrum,data[:,y-origin[-2],x-origin[-1]],equal_nan=True):
+                    mismatched = mismatched+1
+            results[-1]['check_format'] = {'ncubes':len(cubes),'mismatched':mismatched,
+                                           'sdf_mb':sum(_size(i) for i in cubes)/1e6,
+                                           'copy_mb':sum(_size(cubeformats.output_path(i,args.output_format)) for i in cubes)/1e6}
+    finally:
+        os.chdir(cwd)
+    return results
+
+def _size(path):
+    '''
+    The size of a file, or of everything in a directory (a Zarr store)
+    '''
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d,f)) for d,_,files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def format_table(results):
+    '''
+    Format the results as a text table
+
+    results: The list of result dictionaries
+    '''
+    lines = ['{:>6s}  {:<10s} {:>9s} {:>9s} {:>8s} {:>10s} {:>10s}'.format('nscans','stage','wall[s]','cpu[s]','fs_ops','read[MB]','write[MB]')]
+    for r in results:
+        lines.append('{:>6d}  {:<10s} {:>9.3f} {:>9.3f} {:>8d} {:>10.2f} {:>10.2f}'.format(
+                r['nscans'],r['stage'],r['wall'],r['cpu'],r['fsops'],r['read']/1e6,r['written']/1e6))
+    return '\n'.join(lines)
+
+def failed_checks(results):
+    '''
+    Describe every check in the results that failed
+
+    results: The list of result dictionaries
+
+    Returns a list of strings, empty if every check passed
+    '''
+    failures = []
+    for r in results:
+        for eachmol,check in sorted(r.get('check',{}).items()):
+            if not check['match']:
+                failures.append('{} scans: the tiled {} coadd does not match'.format(r['nscans'],eachmol))
+        if 'check_screen' in r and len(r['check_screen']['wrong']) > 0:
+            failures.append('{} scans: screening found the wrong bad receptors for {}'.format(
+                    r['nscans'],', '.join(r['check_screen']['wrong'])))
+        if 'check_format' in r and r['check_format']['mismatched'] > 0:
+            failures.append('{} scans: {} spectra read back differently'.format(r['nscans'],r['check_format']['mismatched']))
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the SURFING pipeline on synthetic data with a stub Starlink backend')
+    parser.add_argument('--nscans',type=int,nargs='+',default=[1,10,100],help='Batch sizes (number of datescans) to run')
+    parser.add_argument('--nx',type=int,default=32,help='Reduced cube width in pixels')
+    parser.add_argument('--ny',type=int,default=32,help='Reduced cube height in pixels')
+    parser.add_argument('--nchan',type=int,default=128,help='Spectral channels in the reduced cubes and raw data')
+    parser.add_argument('--nraw',type=int,default=2,help='Raw files per datescan')
+    parser.add_argument('--ntime',type=int,default=100,help='Time samples per raw file')
+    parser.add_argument('--nprocs',type=int,default=1,help='Worker processes for reduction and conversion')
+    parser.add_argument('--coadd-engine',default='wcsmosaic',choices=['wcsmosaic','incremental','tiled'])
+    parser.add_argument('--max-tile-mb',type=float,default=256,help='Memory budget per tile for the tiled coadd engine')
+    parser.add_argument('--check-tiled',action='store_true',
+                        help='Also make the coadds with the tiled engine and check they match the wcsmosaic engine')
+    parser.add_argument('--output-format',default='fits',choices=['fits','fits.fz','h5','zarr'],
+                        help='Format of the converted products and coadd copies (see SURFING.cubeformats)')
+    parser.add_argument('--bad-receptor',default=None,choices=RECEPTORS,
+                        help='Make this receptor noisy in the raw data, and check the screening finds it (see SURFING.screening)')
+    parser.add_argument('--scratch',default=None,help='Stage raw files and run ORACDR in this scratch directory (see SURFING.scratch)')
+    parser.add_argument('--scratch-budget',type=float,default=0,help='Scratch space budget for staged raw files in GB (0 = no limit)')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--workdir',default='bench_work',help='Scratch directory for the synthetic data')
+    parser.add_argument('--json',default=None,help='Also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    from SURFING import backend,scratch
+    backend.configure(backend='SURFING.bench.stubstar')
+    scratch.configure(args.scratch,args.scratch_budget)
+    stubstar.CONFIG.update({'nx':args.nx,'ny':args.ny,'nchan':args.nchan,'seed':args.seed})
+    sys.addaudithook(_audit)
+
+    results = []
+    for nscans in args.nscans:
+        results = results+run_batch(nscans,os.path.join(args.workdir,'{}scans'.format(nscans)),args)
+        print(format_table([r for r in results if r['nscans'] == nscans]))
+        for r in results:
+            for eachmol,check in sorted(r.get('check',{}).items()) if r['nscans'] == nscans else []:
+                print('tiled vs {} {:<5s}: match={} max_abs_diff={:.3g} max_rel_diff={:.3g} npix={}'.format(
+                        args.coadd_engine,eachmol,check['match'],check['max_abs_diff'],check['max_rel_diff'],check['npix']))
+            if r['nscans'] == nscans and 'check_screen' in r:
+                check = r['check_screen']
+                print('screening: expected bad receptors {}, {} datescans screened differently'.format(
+                        ','.join(check['expected']) or 'none',len(check['wrong'])))
+            if r['nscans'] == nscans and 'check_format' in r:
+                check = r['check_format']
+                print('{}: {} cubes, {:.2f} MB as SDF, {:.2f} MB as {}, {} spectra read back differently'.format(
+                        args.output_format,check['ncubes'],check['sdf_mb'],check['copy_mb'],args.output_format,check['mismatched']))
+        print('')
+
+    if args.json is not None:
+        with open(args.json,'w') as f:
+            json.dump(results,f,indent=1)
+    return results
@@ -0,0 +1,298 @@
+import os
+import pickle
+import re
+import tempfile
+import types
+import zlib
+from collections import namedtuple
+import numpy as np
+
+#####
+# A stand-in for the parts of the Starlink python wrapper that SURFING uses, so the pipeline can be run and timed
+# without a Starlink installation or real telescope data.
+#
+# "NDFs" written by the stub are pickled dictionaries laid out like the HDS structure of a real NDF
+# (DATA_ARRAY/DATA, DATA_ARRAY/ORIGIN, VARIANCE), read and written through a fake hds module with the same
+# locator interface SURFING.ndfio uses. Every cube is on the same pixel grid, so alignment is the identity.
+# oracdr() writes synthetic reduced cubes and moment 0 maps; wcsmosaic, wcsalign, sub, ndfcopy, paste and ndf2fits
+# do the equivalent array operations; ndf2fits writes a real (uncompressed) FITS file.
+# wcsmosaic only does what kappa.wcsmosaic does with its defaults on inputs that need no resampling: a plain mean of
+# the good input pixels, with variance sum(var)/n**2. It knows nothing about how a real mosaic resamples, so a
+# co-add engine that agrees with it is only known to get the tiling and bookkeeping right.
+#
+# Use it with SURFING.backend.configure(backend='SURFING.bench.stubstar') (see load).
+#####
+
+VAL__BADR = np.float32(-3.4028235e+38)
+
+# The size of the synthetic products made by oracdr(). Set by the benchmark before it runs anything.
+CONFIG = {'nx':32,'ny':32,'nchan':128,'subbands':[1,2,3],'seed':0}
+
+ORACOutput = namedtuple('ORACOutput',['runlog','outdir','datafiles','imagefiles','logfiles','status'])
+
+#####
+# Stub NDF storage
+#####
+
+def _load(path):
+    with open(path,'rb') as f:
+        return pickle.load(f)
+
+def _save(path,ndf):
+    with open(path,'wb') as f:
+        pickle.dump(ndf,f,protocol=pickle.HIGHEST_PROTOCOL)
+
+def write_ndf(path,data,origin=None,variance=None,more=None):
+    '''
+    Write a stub NDF. NaNs in data/variance are stored as bad values, like a real NDF.
+
+    path    : The .sdf file to write
+    data    : The data array (NumPy axis order)
+    origin  : The pixel origin (NumPy axis order). Default all 1
+    variance: The variance array, or None
+    more    : A dictionary stored as the NDF's MORE extension (e.g. ACSIS receptor information for raw data)
+    '''
+    origin = [1]*data.ndim if origin is None else list(origin)
+    ndf = {'DATA_ARRAY':{'DATA':np.where(np.isfinite(data),data,VAL__BADR).astype(np.float32),
+                         'ORIGIN':np.array(origin[::-1],dtype=np.int32)}}
+    if variance is not None:
+        ndf['VARIANCE'] = {'DATA':np.where(np.isfinite(variance),variance,VAL__BADR).astype(np.float32),
+                           'ORIGIN':np.array(origin[::-1],dtype=np.int32)}
+    if more is not None:
+        ndf['MORE'] = more
+    _save(path,ndf)
+
+def read_ndf(path):
+    '''
+    Read a stub NDF as (data,origin,variance) with bad values as NaN. variance is None if there isn't one.
+
+    path: The .sdf file to read
+    '''
+    ndf    = _load(path)
+    data   = ndf['DATA_ARRAY']['DATA'].astype(np.float64)
+    data[data == VAL__BADR] = np.nan
+    origin = tuple(int(i) for i in ndf['DATA_ARRAY']['ORIGIN'][::-1])
+    var    = None
+    if 'VARIANCE' in ndf:
+        var = ndf['VARIANCE']['DATA'].astype(np.float64)
+        var[var == VAL__BADR] = np.nan
+    return data,origin,var
+
+class _Locator:
+    '''
+    A fake HDS locator over a stub NDF, implementing the parts of the pyhds interface SURFING uses
+    '''
+
+    def __init__(self,path,mode,root,parent,name):
+        self.path   = path
+        self.mode   = mode
+        self.root   = root
+        self.parent = parent
+        self.name   = name
+
+    @property
+    def _node(self):
+        return self.root if self.parent is None else self.parent[self.name]
+
+    @property
+    def struc(self):
+        return isinstance(self._node,dict)
+
+    @property
+    def shape(self):
+        return tuple(reversed(self._node.shape))
+
+    @property
+    def type(self):
+        return '_DOUBLE' if self._node.dtype == np.float64 else '_REAL'
+
+    def there(self,name):
+        return name in self._node
+
+    def find(self,name):
+        if name not in self._node:
+            raise KeyError('No component {} in {}'.format(name,self.path))
+        return _Locator(self.path,self.mode,self.root,self._node,name)
+
+    def get(self):
+        return np.array(self._node)
+
+    def put(self,value):
+        self.parent[self.name] = np.array(value)
+
+    def new(self,name,type,dims):
+        dtype = np.float64 if type == '_DOUBLE' else np.float32
+        self._node[name] = np.zeros(tuple(reversed(dims)),dtype=dtype)
+
+    def erase(self,name):
+        del self._node[name]
+
+    def annul(self):
+        if self.parent is None and self.mode == 'UPDATE':
+            _save(self.path,self.root)
+
+def _hds_open(path,mode='READ'):
+    return _Locator(path,mode.upper(),_load(path),None,None)
+
+#####
+# Stub Starlink commands
+#####
+
+def _bounds(origin,shape):
+    return [o+n-1 for o,n in zip(origin,shape)]
+
+def _mosaic(inputs,out):
+    '''
+    The mean of stub NDFs on the common pixel grid, over the union of their bounds (kappa.wcsmosaic with VARIANCE=FALSE)
+    '''
+    cubes  = [read_ndf(i) for i in inputs]
+    lower  = np.min([c[1] for c in cubes],axis=0)
+    upper  = np.max([_bounds(c[1],c[0].shape) for c in cubes],axis=0)
+    shape  = tuple(upper-lower+1)
+    total  = np.zeros(shape)
+    vtotal = np.zeros(shape)
+    n      = np.zeros(shape,dtype=int)
+    for data,origin,var in cubes:
+        sl   = tuple(slice(o-l,o-l+m) for o,l,m in zip(origin,lower,data.shape))
+        good = ~np.isnan(data)
+        total[sl] += np.nan_to_num(data)
+        n[sl]     += good
+        if var is not None:
+            vtotal[sl] += np.where(good,var,0.0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        var = vtotal/n**2 if all(c[2] is not None for c in cubes) else None
+        write_ndf(out,np.where(n>0,total/n,np.nan),lower,None if var is None else np.where(n>0,var,np.nan))
+
+def _group(inlist):
+    if inlist.startswith('^'):
+        with open(inlist[1:]) as f:
+            return [i.strip() for i in f if i.strip() != '']
+    return [inlist]
+
+def wcsmosaic(inlist,out,ref=None,lbnd='!',ubnd='!',**kwargs):
+    _mosaic(_group(inlist),out)
+
+def paste(inlist,out,p1=None,confine=False,transp=False,**kwargs):
+    '''
+    Paste a group of NDFs on to the first, over the union of their bounds (confine=False, transp=False only)
+    '''
+    cubes = [read_ndf(i) for i in _group(inlist)]
+    lower = np.min([c[1] for c in cubes],axis=0)
+    upper = np.max([_bounds(c[1],c[0].shape) for c in cubes],axis=0)
+    shape = tuple(upper-lower+1)
+    data  = np.full(shape,np.nan)
+    var   = np.full(shape,np.nan) if all(c[2] is not None for c in cubes) else None
+    for eachdata,origin,eachvar in cubes:
+        sl = tuple(slice(o-l,o-l+n) for o,l,n in zip(origin,lower,eachdata.shape))
+        data[sl] = eachdata
+        if var is not None:
+            var[sl] = eachvar
+    write_ndf(out,data,lower,var)
+
+def wcsalign(inndf,out,ref=None,lbnd='!',ubnd='!',**kwargs):
+    data,origin,var = read_ndf(inndf)
+    write_ndf(out,data,origin,var)
+
+def sub(in1,in2,out,**kwargs):
+    d1,o1,v1 = read_ndf(in1)
+    d2,o2,v2 = read_ndf(in2)
+    lower = np.maximum(o1,o2)
+    upper = np.minimum(_bounds(o1,d1.shape),_bounds(o2,d2.shape))
+    s1    = tuple(slice(l-o,u-o+1) for l,u,o in zip(lower,upper,o1))
+    s2    = tuple(slice(l-o,u-o+1) for l,u,o in zip(lower,upper,o2))
+    var   = v1[s1]+v2[s2] if v1 is not None and v2 is not None else None
+    write_ndf(out,d1[s1]-d2[s2],lower,var)
+
+def ndfcopy(inndf,out,**kwargs):
+    match = re.match(r'^(?P<path>.+)\((?P<section>[-0-9:,]+)\)$',inndf)
+    if match is None:
+        data,origin,var = read_ndf(inndf)
+        write_ndf(out,data,origin,var)
+        return
+    data,origin,var = read_ndf(match.group('path'))
+    section = [[int(j) for j in i.split(':')] for i in match.group('section').split(',')][::-1]
+    lower   = [i[0] for i in section]
+    shape   = tuple(i[1]-i[0]+1 for i in section)
+    newdata = np.full(shape,np.nan)
+    newvar  = np.full(shape,np.nan) if var is not None else None
+    src,dst = [],[]
+    for o,n,l,m in zip(origin,data.shape,lower,shape):
+        lo,hi = max(o,l),min(o+n,l+m)
+        src.append(slice(lo-o,max(hi-o,lo-o)))
+        dst.append(slice(lo-l,max(hi-l,lo-l)))
+    newdata[tuple(dst)] = data[tuple(src)]
+    if var is not None:
+        newvar[tuple(dst)] = var[tuple(src)]
+    write_ndf(out,newdata,lower,newvar)
+
+def ndf2fits(inndf,out,**kwargs):
+    '''
+    Write the data array as a minimal, valid, uncompressed FITS file
+    '''
+    data,origin,_ = read_ndf(inndf)
+    cards = [('SIMPLE','T'),('BITPIX',-32),('NAXIS',data.ndim)]
+    cards = cards+[('NAXIS{}'.format(i+1),n) for i,n in enumerate(data.shape[::-1])]
+    cards = cards+[('LBOUND{}'.format(i+1),o) for i,o in enumerate(origin[::-1])]
+    cards = ['{:<8s}= {:>20}'.format(key,value) for key,value in cards]
+    cards.append('END')
+    header = ''.join('{:<80s}'.format(i) for i in cards)
+    header = header+' '*(-len(header)%2880)
+    body   = data.astype('>f4').tobytes()
+    with open(out,'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(body)
+        f.write(b'\0'*(-len(body)%2880))
+
+def oracdr(instrument,loop='file',dataout=None,recipe=None,rawfiles=None,recpars=None,calib=None,**kwargs):
+    '''
+    Pretend to reduce a scan: write a reduced cube, a moment 0 map and a png per subband, and some logs,
+    in to a new ORACworking* directory inside dataout
+    '''
+    outdir = tempfile.mkdtemp(prefix='ORACworking',dir=dataout)
+    name   = os.path.basename(sorted(rawfiles)[0])
+    date   = name[1:9]
+    scan   = int(name.split('_')[1])
+
+    # Shift each scan a little on the sky, so the coadds have partial overlaps to deal with
+    rng   = np.random.default_rng([CONFIG['seed'],scan,zlib.crc32((calib or '').encode())])
+    nx,ny,nchan = CONFIG['nx'],CONFIG['ny'],CONFIG['nchan']
+    origin = (-nchan//2,-ny//2+(scan%5)*(ny//8),-nx//2+(scan%7)*(nx//8))
+    yy,xx  = np.mgrid[0:ny,0:nx]
+    source = 5.0*np.exp(-((xx-nx/2)**2+(yy-ny/2)**2)/(2*(nx/6)**2))
+    line   = np.exp(-(np.arange(nchan)-nchan/2)**2/(2*(nchan/20)**2))
+
+    datafiles,imagefiles = [],[]
+    for subband in CONFIG['subbands']:
+        cube = (line[:,None,None]*source[None,:,:]).astype(np.float32)+rng.normal(0,0.3,(nchan,ny,nx)).astype(np.float32)
+        base = os.path.join(outdir,'ga{}_{}_{}_'.format(date,scan,subband))
+        write_ndf(base+'reduced001.sdf',cube,origin,np.full(cube.shape,0.09,dtype=np.float32))
+        write_ndf(base+'integ.sdf',cube.sum(axis=0),origin[1:],np.full((ny,nx),0.09*nchan,dtype=np.float32))
+        with open(base+'rimg.png','wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n'+bytes(1024))
+        datafiles  = datafiles+[base+'reduced001.sdf',base+'integ.sdf']
+        imagefiles = imagefiles+[base+'rimg.png']
+
+    runlog = os.path.join(outdir,'oracdr_run.log')
+    with open(runlog,'w') as f:
+        f.write('Stub ORACDR run of {} with recipe {}\n'.format(name,recipe))
+        if calib:
+            f.write('calib: {}\n'.format(calib))
+    with open(os.path.join(outdir,'log.group'),'w') as f:
+        f.write('group log\n')
+    return ORACOutput(runlog,outdir,datafiles,imagefiles,[os.path.join(outdir,'log.group')],0)
+
+def change_starpath(path):
+    pass
+
+def load(starpath):
+    '''
+    The stub backend for SURFING.backend: an object with wrapper, kappa, convert and hds attributes
+    e.g. SURFING.backend.configure(backend='SURFING.bench.stubstar')
+
+    starpath: Ignored -- there is no Starlink installation
+    '''
+    wrapper = types.SimpleNamespace(oracdr=oracdr,change_starpath=change_starpath)
+    kappa   = types.SimpleNamespace(wcsmosaic=wcsmosaic,wcsalign=wcsalign,sub=sub,ndfcopy=ndfcopy,paste=paste)
+    convert = types.SimpleNamespace(ndf2fits=ndf2fits)
+    hds     = types.SimpleNamespace(open=_hds_open)
+    return types.SimpleNamespace(wrapper=wrapper,kappa=kappa,convert=convert,hds=hds)
@@ -0,0 +1,371 @@
+import json
+import os
+import numpy as np
+from SURFING import backend,fileops,instrument,ndfio
+
+# Record every call to Starlink (see SURFING.instrument)
+kappa = instrument.wrap(backend.kappa,'kappa')
+
+#####
+# An incremental coadd store for one region and molecule.
+#
+# Rather than re-mosaicking the whole region every time new data arrive, the store keeps two
+# running-sum cubes on disk as memory-mapped .npy files:
+#     wsum.npy : sum over observations of weight * data
+#     wt.npy   : sum over observations of weight
+# where weight = 1/variance (or 1 if the cube has no variance). The coadd is then wsum/wt and its variance 1/wt.
+# Each new observation is aligned to the store's reference pixel grid and added in to the part of the
+# running sums it overlaps, so the cost of an update scales with the new data, not the region's coverage.
+# The official SDF coadd is only written out (materialised) when asked for.
+#
+# Each observation's own aligned weight*data and weight are kept too (contributions/<n>_wsum.npy, <n>_wt.npy, with
+# its pixel origin in meta.json), so when a cube is reduced again (e.g. because its inputs or bad receptors changed)
+# its old contribution is taken back out of the running sums before the new one goes in.
+#
+# An update changes the running sums in place, so it is journalled to survive being interrupted: the parts of the
+# sums it is about to change are saved (journal/) and listed in meta.json first, and the update only counts once
+# meta.json records the new contribution. If an update was interrupted, the next one puts the saved parts back
+# (see _recover) rather than adding the same cube twice. A new store is built under a temporary name and renamed
+# in to place once it holds its first cube.
+#####
+
+def store_path(region,mol):
+    '''
+    The directory holding the coadd store for a region and molecule
+
+    region: The region e.g. SERPENS_SOUTH
+    mol   : The molecule e.g. C18O
+    '''
+    return 'coadds/{}_{}_store'.format(region,mol)
+
+def _load_meta(store):
+    '''
+    Read the store's metadata, or return None if the store doesn't exist yet
+
+    store: The store directory
+    '''
+    if not os.path.exists(os.path.join(store,'meta.json')):
+        return None
+    with open(os.path.join(store,'meta.json')) as f:
+        return json.load(f)
+
+def _save_meta(store,meta):
+    '''
+    Write the store's metadata atomically (write a temporary file and rename it over the old one)
+
+    store: The store directory
+    meta : The metadata dictionary
+    '''
+    with fileops.atomic_write(os.path.join(store,'meta.json')) as f:
+        json.dump(meta,f,indent=1)
+
+def _region(meta,origin,shape):
+    '''
+    The slice of the running sums covered by a cube
+
+    meta  : The metadata dictionary
+    origin: The pixel origin of the cube (NumPy axis order)
+    shape : The shape of the cube
+    '''
+    return tuple(slice(o-so,o-so+n) for o,so,n in zip(origin,meta['origin'],shape))
+
+def _grow(store,meta,lbnd,ubnd):
+    '''
+    Enlarge the running-sum cubes so they cover the pixel bounds lbnd:ubnd as well as their current area.
+    This only happens when an observation extends beyond everything seen before.
+
+    store: The store directory
+    meta : The metadata dictionary -- updated in place
+    lbnd : The lower pixel bounds that must be covered (NumPy axis order)
+    ubnd : The upper pixel bounds that must be covered (NumPy axis order)
+    '''
+    oldorigin = meta['origin']
+    oldupper  = [o+n-1 for o,n in zip(oldorigin,meta['shape'])]
+    neworigin = [min(a,b) for a,b in zip(oldorigin,lbnd)]
+    newupper  = [max(a,b) for a,b in zip(oldupper,ubnd)]
+    if neworigin == oldorigin and newupper == oldupper:
+        return
+    newshape  = [u-o+1 for o,u in zip(neworigin,newupper)]
+    inside    = tuple(slice(a-b,a-b+n) for a,b,n in zip(oldorigin,neworigin,meta['shape']))
+
+    for name in ['wsum','wt']:
+        old = np.load(os.path.join(store,name+'.npy'),mmap_mode='r')
+        new = np.lib.format.open_memmap(os.path.join(store,name+'.npy.grow'),mode='w+',dtype=np.float64,shape=tuple(newshape))
+        new[inside] = old
+        new.flush()
+        del old,new
+
+    # Record the new grid before the enlarged cubes replace the old ones, so an interrupted swap can be finished
+    meta['growing'] = {'origin':neworigin,'shape':newshape}
+    _save_meta(store,meta)
+    _finish_growing(store,meta)
+
+def _finish_growing(store,meta):
+    '''
+    Put the enlarged running-sum cubes made by _grow in place and record their grid in meta.json
+
+    store: The store directory
+    meta : The metadata dictionary -- updated in place
+    '''
+    for name in ['wsum','wt']:
+        if os.path.exists(os.path.join(store,name+'.npy.grow')):
+            os.replace(os.path.join(store,name+'.npy.grow'),os.path.join(store,name+'.npy'))
+    growing = meta.pop('growing')
+    meta['origin'] = growing['origin']
+    meta['shape']  = growing['shape']
+    _save_meta(store,meta)
+
+def _begin(store,meta,regions):
+    '''
+    Save the parts of the running sums an update is about to change, and list them in meta.json, so the update
+    can be undone if it is interrupted (see _recover)
+
+    store  : The store directory
+    meta   : The metadata dictionary -- updated in place
+    regions: A list of (origin,shape) of the cubes the update adds or takes out
+    '''
+    journal = os.path.join(store,'journal')
+    fileops.remove_tree(journal)
+    fileops.makedirs(journal)
+    wsum = np.load(os.path.join(store,'wsum.npy'),mmap_mode='r')
+    wt   = np.load(os.path.join(store,'wt.npy'),mmap_mode='r')
+    meta['journal'] = []
+    for n,(origin,shape) in enumerate(regions):
+        region_slice = _region(meta,origin,shape)
+        np.save(os.path.join(journal,'{}_wsum.npy'.format(n)),wsum[region_slice])
+        np.save(os.path.join(journal,'{}_wt.npy'.format(n)),wt[region_slice])
+        meta['journal'].append({'origin':list(origin),'shape':list(shape),'file':str(n)})
+    del wsum,wt
+    _save_meta(store,meta)
+
+def _recover(store,meta):
+    '''
+    Finish or undo an update of the store that was interrupted (see _grow and _begin)
+
+    store: The store directory
+    meta : The metadata dictionary -- updated in place
+    '''
+    if 'growing' in meta:
+        _finish_growing(store,meta)
+    if len(meta.get('journal',[])) == 0:
+        return
+
+    print('The last update of the coadd store in {} was interrupted -- undoing it.'.format(store))
+    journal = os.path.join(store,'journal')
+    wsum    = np.load(os.path.join(store,'wsum.npy'),mmap_mode='r+')
+    wt      = np.load(os.path.join(store,'wt.npy'),mmap_mode='r+')
+    for entry in meta['journal']:
+        region_slice = _region(meta,entry['origin'],entry['shape'])
+        wsum[region_slice] = np.load(os.path.join(journal,entry['file']+'_wsum.npy'))
+        wt[region_slice]   = np.load(os.path.join(journal,entry['file']+'_wt.npy'))
+    wsum.flush()
+    wt.flush()
+    del wsum,wt
+
+    meta['journal'] = []
+    _save_meta(store,meta)
+    fileops.remove_tree(journal)
+
+def weights(data,var):
+    '''
+    Inverse-variance weights for a cube (or 1 everywhere if it has no variance).
+    Pixels that are bad in either the data or the variance get no weight.
+
+    data: The data array, NaN where bad
+    var : The variance array, or None
+
+    Returns (good,weight): the mask of good pixels and the weight of each pixel
+    '''
+    if var is not None:
+        good   = np.isfinite(data) & np.isfinite(var) & (var > 0)
+        weight = np.where(good,1.0/np.where(good,var,1.0),0.0)
+    else:
+        good   = np.isfinite(data)
+        weight = good.astype(np.float64)
+    return good,weight
+
+def _remove_contribution(store,meta,key):
+    '''
+    Take one observation's contribution back out of the running sums. Its saved copy is left for the caller to
+    delete once the update is complete.
+
+    store: The store directory
+    meta : The metadata dictionary -- updated in place
+    key  : The name the contribution is recorded under
+
+    Returns the path of the saved copy, without the _wsum.npy/_wt.npy ending
+    '''
+    thisone  = meta['contributions'].pop(key)
+    contrib  = os.path.join(store,'contributions',thisone['file'])
+    old_wsum = np.load(contrib+'_wsum.npy',mmap_mode='r')
+    old_wt   = np.load(contrib+'_wt.npy',mmap_mode='r')
+
+    region_slice = _region(meta,thisone['origin'],old_wt.shape)
+    wsum = np.load(os.path.join(store,'wsum.npy'),mmap_mode='r+')
+    wt   = np.load(os.path.join(store,'wt.npy'),mmap_mode='r+')
+    wsum[region_slice] -= old_wsum
+    wt[region_slice]   -= old_wt
+    # Pixels only this observation covered should now have no weight -- don't leave rounding errors behind
+    gone = wt[region_slice] <= 1e-9*old_wt
+    wsum[region_slice] = np.where(gone,0.0,wsum[region_slice])
+    wt[region_slice]   = np.where(gone,0.0,wt[region_slice])
+    wsum.flush()
+    wt.flush()
+    del wsum,wt,old_wsum,old_wt
+    return contrib
+
+def accumulate(region,mol,sdffile,key=None):
+    '''
+    Add one observation (a reduced cube, or an existing coadd) in to the store for this region and molecule.
+    The first cube added becomes the store's reference pixel grid; later cubes are aligned to it with kappa.wcsalign.
+    Files already in the store are skipped, unless they have changed since they were added -- then their old
+    contribution is replaced by the new one.
+
+    region : The region e.g. SERPENS_SOUTH
+    mol    : The molecule e.g. C18O
+    sdffile: The path to the cube to add
+    key    : The name to record the contribution under. Defaults to sdffile
+
+    Returns True if the cube was added (or replaced), False if it was already in the store
+    '''
+    store = store_path(region,mol)
+    meta  = _load_meta(store)
+    key   = sdffile if key is None else key
+    mtime = os.path.getmtime(sdffile)
+    if meta is not None:
+        _recover(store,meta)
+
+    replacing = None
+    if meta is not None and key in meta['contributions']:
+        thisone = meta['contributions'][key]
+        if not isinstance(thisone,dict):
+            # Stores made before contributions were kept only have the time each cube was added
+            if thisone != mtime:
+                print('Oh no! {} has changed since it was added to the {} {} coadd store, which can\'t take its old '\
+                        'version back out. To rebuild it, remove {} AND coadds/{}_{}_coadd.sdf (the store would otherwise '\
+                        'be seeded from that co-add, which has the old version in it) and co-add all of the region\'s '\
+                        'datescans again.'.format(sdffile,region,mol,store,region,mol))
+            return False
+        if thisone['mtime'] == mtime:
+            return False
+        print('{} has changed since it was added to the {} {} coadd store -- replacing it.'.format(sdffile,region,mol))
+        replacing = thisone
+
+    #####
+    # Put the new cube on to the store's pixel grid. A new store is built under a temporary name
+    #####
+    if meta is None:
+        target = fileops.temp_path(store,'_new')
+        fileops.remove_tree(target)
+        fileops.makedirs(target)
+        fileops.copy(sdffile,os.path.join(target,'reference.sdf'))
+        aligned = sdffile
+    else:
+        target  = store
+        aligned = fileops.temp_path(os.path.join(store,'aligned.sdf'),'_temp')
+        kappa.wcsalign(sdffile,out=aligned,ref=os.path.join(store,'reference.sdf'),lbnd='!',ubnd='!')
+
+    data,origin = ndfio.read_ndf(aligned)
+    var,_       = ndfio.read_ndf(aligned,'VARIANCE')
+    if aligned != sdffile:
+        fileops.remove(aligned)
+
+    good,weight = weights(data,var)
+    upper = [o+n-1 for o,n in zip(origin,data.shape)]
+
+    if meta is None:
+        meta = {'origin':list(origin),'shape':list(data.shape),'variance':var is not None,'contributions':{},'next':0,'journal':[]}
+        for name in ['wsum','wt']:
+            np.lib.format.open_memmap(os.path.join(target,name+'.npy'),mode='w+',dtype=np.float64,shape=data.shape).flush()
+    else:
+        _grow(store,meta,origin,upper)
+        meta['variance'] = meta['variance'] and var is not None
+
+    # Keep this observation's own contribution, so it can be taken out again
+    contribution = weight*np.where(good,data,0.0)
+    name    = str(meta.get('next',len(meta['contributions'])))
+    contrib = os.path.join(target,'contributions',name)
+    fileops.makedirs(os.path.dirname(contrib))
+    np.save(contrib+'_wsum.npy',contribution)
+    np.save(contrib+'_wt.npy',weight)
+
+    #####
+    # Add the new cube in to the overlapping part of the running sums (taking its old version out first)
+    #####
+    if target == store:
+        regions = [(origin,data.shape)]
+        if replacing is not None:
+            regions.append((replacing['origin'],np.load(os.path.join(store,'contributions',replacing['file']+'_wt.npy'),mmap_mode='r').shape))
+        _begin(store,meta,regions)
+    oldcontrib = _remove_contribution(store,meta,key) if replacing is not None else None
+
+    region_slice = _region(meta,origin,data.shape)
+    wsum = np.load(os.path.join(target,'wsum.npy'),mmap_mode='r+')
+    wt   = np.load(os.path.join(target,'wt.npy'),mmap_mode='r+')
+    wsum[region_slice] += contribution
+    wt[region_slice]   += weight
+    wsum.flush()
+    wt.flush()
+    del wsum,wt
+
+    # The update is complete once meta.json records it
+    meta['contributions'][key] = {'mtime':mtime,'origin':list(origin),'file':name}
+    meta['next']    = int(name)+1
+    meta['journal'] = []
+    _save_meta(target,meta)
+
+    fileops.remove_tree(os.path.join(target,'journal'))
+    if oldcontrib is not None:
+        fileops.remove(oldcontrib+'_wsum.npy')
+        fileops.remove(oldcontrib+'_wt.npy')
+    if target != store:
+        os.replace(target,store)
+    return True
+
+def materialise(region,mol,out):
+    '''
+    Write the store out as an SDF coadd on the grid of the store's reference cube (see write_on_grid).
+
+    region: The region e.g. SERPENS_SOUTH
+    mol   : The molecule e.g. C18O
+    out   : The path to the SDF file to write
+    '''
+    store = store_path(region,mol)
+    meta  = _load_meta(store)
+    if meta is None:
+        raise FileNotFoundError('There is no coadd store for {} {} in {}'.format(region,mol,store))
+    _recover(store,meta)
+
+    wsum = np.load(os.path.join(store,'wsum.npy'),mmap_mode='r')
+    wt   = np.load(os.path.join(store,'wt.npy'),mmap_mode='r')
+    with np.errstate(divide='ignore',invalid='ignore'):
+        write_on_grid(os.path.join(store,'reference.sdf'),meta['origin'],np.where(wt > 0,wsum/wt,np.nan),
+                      np.where(wt > 0,1.0/wt,np.nan) if meta['variance'] else None,out)
+    del wsum,wt
+
+def write_on_grid(reference,origin,data,var,out):
+    '''
+    Write a cube that lies on the pixel grid of a reference NDF as an SDF file. The output NDF is made by copying
+    the section of the reference that covers the cube (kappa.ndfcopy pads pixels outside the reference with bad
+    values), so it carries the reference WCS, and then the data and variance are written in to it.
+    The file is written under a temporary name and renamed in to place.
+
+    reference: The reference NDF
+    origin   : The pixel origin of the cube on the reference grid (NumPy axis order)
+    data     : The data array
+    var      : The variance array, or None for no variance (the reference's variance is not kept)
+    out      : The path to the SDF file to write
+    '''
+    # NDF sections are given in Starlink (reversed) axis order
+    upper   = [o+n-1 for o,n in zip(origin,data.shape)]
+    section = ','.join('{}:{}'.format(l,u) for l,u in zip(reversed(origin),reversed(upper)))
+    tmpout  = fileops.temp_path(out,'_materialise_temp')
+    kappa.ndfcopy('{}({})'.format(reference,section),out=tmpout)
+
+    ndfio.write_ndf(tmpout,data)
+    if var is not None:
+        ndfio.write_ndf(tmpout,var,'VARIANCE')
+    else:
+        ndfio.remove_component(tmpout,'VARIANCE')
+
+    fileops.replace(tmpout,out)
@@ -0,0 +1,298 @@
+import importlib
+import os
+import numpy as np
+from SURFING import backend,fileops,instrument,ndfio
+
+# Record every call to Starlink (see SURFING.instrument)
+convert = instrument.wrap(backend.convert,'convert')
+
+#####
+# Output formats for the non-Starlink copies of SDF products (convert_to_fits and the co-adds), and a lazy reader.
+#
+#     'fits'    : plain FITS written by convert.ndf2fits -- what SURFING has always written
+#     'fits.fz' : tile-compressed FITS: ndf2fits' output (so the headers and WCS are exactly the same) losslessly
+#                 GZIP compressed tile by tile with astropy. Any CFITSIO-based reader (ds9, funpack, astropy...) reads it
+#     'h5'      : HDF5 (h5py) with the DATA and VARIANCE arrays gzip compressed in chunks
+#     'zarr'    : a Zarr store (zarr) laid out the same way
+# The HDF5 and Zarr copies keep the pixel origin and the NDF's WCS (the lines of its AST dump, see ndfio.read_wcs)
+# as attributes.
+#
+# Cubes are compressed CHUNKS = (channels,y,x) at a time, so reading one spectrum touches nchan/64 small chunks,
+# and reading a range of channels only the chunks that cover it, rather than the whole file.
+# open_cube() reads any of the formats lazily -- only the chunks (tiles) that are indexed are read and decompressed.
+# The HDF5 and Zarr copies are written a block of channels at a time (see _blocks), so converting a big cube never
+# holds all of it in memory.
+#
+# astropy, h5py and zarr are only needed for their own formats, and are only imported when they are used.
+#####
+
+FORMATS = {'fits':'.fits','fits.fz':'.fits.fz','h5':'.h5','zarr':'.zarr'}
+
+# The chunk (tile) shape in NumPy axis order: spectral channels, y, x. Maps use the last two.
+CHUNKS = (64,32,32)
+
+# The most memory (in MB) the data and variance of one block take when a cube is copied in to HDF5 or Zarr.
+# Cubes that fit are read in one go; bigger ones a block of whole chunks of channels at a time
+MAX_BLOCK_MB = 256
+
+# The package each optional module comes from
+_PACKAGES = {'astropy.io.fits':'astropy','h5py':'h5py','zarr':'zarr'}
+
+def _optional(module,fmt):
+    '''
+    Import an optional dependency, explaining which format needs it if it isn't installed
+    '''
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError('The {!r} output format needs {} (pip install {})'.format(fmt,module,_PACKAGES[module]))
+
+def output_path(sdffile,fmt='fits'):
+    '''
+    The path of an SDF file's copy in an output format e.g. reduced/.../ga20220307_73_1_reduced001.fits.fz
+
+    sdffile: The path to the SDF file
+    fmt    : One of FORMATS
+    '''
+    if fmt not in FORMATS:
+        raise ValueError('Unknown output format {!r}, choose from {}'.format(fmt,', '.join(FORMATS)))
+    return os.path.splitext(sdffile)[0]+FORMATS[fmt]
+
+def format_of(path):
+    '''
+    The output format of a file, from its name
+    '''
+    for fmt in sorted(FORMATS,key=lambda i: -len(FORMATS[i])):
+        if path.rstrip('/').endswith(FORMATS[fmt]):
+            return fmt
+    raise ValueError('{} is not in any of the output formats ({})'.format(path,', '.join(FORMATS)))
+
+def chunk_shape(shape,chunks=CHUNKS):
+    '''
+    The chunk shape for an array: CHUNKS along the last axes, one pixel along any others, no bigger than the array
+    '''
+    chunks = [1]*max(0,len(shape)-len(chunks))+list(chunks[-len(shape):])
+    return tuple(min(c,n) for c,n in zip(chunks,shape))
+
+def _attributes(sdffile,origin):
+    '''
+    The attributes kept with the HDF5 and Zarr copies
+    '''
+    wcs = ndfio.read_wcs(sdffile)
+    return {'source':os.path.basename(sdffile),'origin':[int(i) for i in origin],'wcs':'\n'.join(wcs or [])}
+
+def _write_fitsfz(sdffile,out,chunks):
+    fits  = _optional('astropy.io.fits','fits.fz')
+    plain = fileops.temp_path(os.path.splitext(out)[0],'_ndf2fits_temp')
+    try:
+        convert.ndf2fits(sdffile,plain)
+        with fits.open(plain,memmap=True) as hdul:
+            hdus = [fits.PrimaryHDU()]
+            for hdu in hdul:
+                if hdu.header.get('NAXIS',0) == 0:
+                    continue
+                header = hdu.header.copy()
+                for key in ['SIMPLE','EXTEND','XTENSION','PCOUNT','GCOUNT']:
+                    header.remove(key,ignore_missing=True)
+                hdus.append(fits.CompImageHDU(data=hdu.data,header=header,compression_type='GZIP_2',quantize_level=0.0,
+                                              tile_shape=chunk_shape(hdu.data.shape,chunks)))
+            fits.HDUList(hdus).writeto(out)
+    finally:
+        fileops.remove(plain)
+
+def _blocks(sdffile,chunks,workdir):
+    '''
+    Read the DATA and VARIANCE of an NDF a block of planes (along the first NumPy axis, i.e. channels of a cube)
+    at a time, each block no more than MAX_BLOCK_MB and a whole number of chunks deep. Blocks of a cube too big to
+    read at once are read as NDF sections (see ndfio.read_section).
+
+    sdffile: The path to the SDF file
+    chunks : The chunk shape, see CHUNKS
+    workdir: A directory for the sections
+
+    Yields (planes,data,var): the slice of the first axis the block covers, and its arrays (var None if there is no variance)
+    '''
+    lbnd,ubnd = ndfio.ndf_bounds(sdffile)
+    shape     = [u-l+1 for l,u in zip(lbnd,ubnd)]
+    nplanes   = max(1,int(MAX_BLOCK_MB*1e6/(2*8*int(np.prod(shape[1:])))))
+    if nplanes >= shape[0]:
+        data,_ = ndfio.read_ndf(sdffile)
+        var,_  = ndfio.read_ndf(sdffile,'VARIANCE')
+        yield slice(0,shape[0]),data,var
+        return
+
+    depth   = chunk_shape(shape,chunks)[0]
+    nplanes = max(depth,nplanes//depth*depth)
+    for start in range(0,shape[0],nplanes):
+        stop     = min(start+nplanes,shape[0])
+        data,var = ndfio.read_section(sdffile,[lbnd[0]+start]+list(lbnd[1:]),[lbnd[0]+stop-1]+list(ubnd[1:]),workdir)
+        yield slice(start,stop),data,var
+
+def _write_h5(sdffile,out,chunks):
+    h5py      = _optional('h5py','h5')
+    lbnd,ubnd = ndfio.ndf_bounds(sdffile)
+    shape     = tuple(u-l+1 for l,u in zip(lbnd,ubnd))
+    with h5py.File(out,'w') as f:
+        f.attrs.update(_attributes(sdffile,lbnd))
+        for planes,data,var in _blocks(sdffile,chunks,os.path.dirname(out) or '.'):
+            for name,array in [('data',data),('variance',var)]:
+                if array is None:
+                    continue
+                if name not in f:
+                    f.create_dataset(name,shape=shape,dtype=array.dtype,chunks=chunk_shape(shape,chunks),compression='gzip',
+                                     shuffle=True,fillvalue=np.nan)
+                f[name][planes] = array
+
+def _write_zarr(sdffile,out,chunks):
+    zarr      = _optional('zarr','zarr')
+    lbnd,ubnd = ndfio.ndf_bounds(sdffile)
+    shape     = tuple(u-l+1 for l,u in zip(lbnd,ubnd))
+    group     = zarr.open_group(out,mode='w')
+    group.attrs.update(_attributes(sdffile,lbnd))
+    stored    = {}
+    for planes,data,var in _blocks(sdffile,chunks,os.path.dirname(out) or '.'):
+        for name,array in [('data',data),('variance',var)]:
+            if array is None:
+                continue
+            if name not in stored:
+                stored[name] = zarr.open_array(store=out,path=name,mode='w',shape=shape,dtype=array.dtype,
+                                               chunks=chunk_shape(shape,chunks),fill_value=np.nan)
+            stored[name][planes] = array
+
+def _remove(path):
+    '''
+    Delete a file or (Zarr) directory if it exists
+    '''
+    if os.path.isdir(path):
+        fileops.remove_tree(path)
+    else:
+        fileops.remove(path)
+
+def write(sdffile,out=None,fmt='fits',chunks=CHUNKS):
+    '''
+    Write a copy of an SDF file in one of the output formats. It is written under a temporary name and renamed
+    in to place, so an interrupted conversion never leaves a partial file that looks up to date.
+
+    sdffile: The path to the SDF file
+    out    : The copy to write. Default None writes it alongside the SDF file, see output_path
+    fmt    : One of FORMATS
+    chunks : The chunk (tile) shape for the compressed formats, see CHUNKS
+    '''
+    out     = output_path(sdffile,fmt) if out is None else out
+    partial = fileops.temp_path(out,'_{}_temp'.format(fmt.replace('.','')))
+    _remove(partial)
+    try:
+        if fmt == 'fits':
+            convert.ndf2fits(sdffile,partial)
+        elif fmt == 'fits.fz':
+            _write_fitsfz(sdffile,partial,chunks)
+        elif fmt == 'h5':
+            _write_h5(sdffile,partial,chunks)
+        elif fmt == 'zarr':
+            _write_zarr(sdffile,partial,chunks)
+        else:
+            raise ValueError('Unknown output format {!r}, choose from {}'.format(fmt,', '.join(FORMATS)))
+    except BaseException:
+        _remove(partial)
+        raise
+    if fmt == 'zarr':
+        return fileops.replace_tree(partial,out)
+    return fileops.replace(partial,out)
+
+class LazyCube:
+    '''
+    One array component of a cube (or map) in any of the output formats, read lazily: indexing it reads and
+    decompresses only the chunks needed, e.g. cube[10:20] reads channels 10-19, cube.spectrum(x,y) one spectrum.
+    As in SURFING.ndfio, axes are in NumPy order (spectral,y,x), pixel indices count from the NDF's pixel origin
+    and bad pixels are NaN. Use it in a with block, or call close() when done.
+
+    path     : The file (.fits, .fits.fz, .h5 or .zarr)
+    component: 'DATA' (default) or 'VARIANCE'
+
+    Attributes:
+    shape : The array shape
+    origin: The pixel index of the first element along each axis
+    wcs   : The FITS header (FITS formats), or the lines of the NDF's AST WCS dump (HDF5 and Zarr, None if it had none)
+    '''
+
+    def __init__(self,path,component='DATA'):
+        self.path      = path
+        self.component = component
+        self.format    = format_of(path)
+        self._file     = None
+
+        if self.format in ['fits','fits.fz']:
+            fits       = _optional('astropy.io.fits',self.format)
+            self._file = fits.open(path,memmap=True)
+            if component == 'DATA':
+                hdu = [i for i in self._file if i.header.get('NAXIS',0) > 0][0]
+            elif component in self._file:
+                hdu = self._file[component]
+            else:
+                self.close()
+                raise KeyError('{} has no {} component'.format(path,component))
+            self._array = hdu.section
+            self.shape  = tuple(hdu.shape)
+            self.origin = tuple(hdu.header.get('LBOUND{}'.format(i),1) for i in range(len(self.shape),0,-1))
+            self.wcs    = hdu.header
+            return
+
+        if self.format == 'h5':
+            self._file = _optional('h5py','h5').File(path,'r')
+            attrs      = self._file.attrs
+        else:
+            self._file = _optional('zarr','zarr').open_group(path,mode='r')
+            attrs      = self._file.attrs
+        if component.lower() not in self._file:
+            self.close()
+            raise KeyError('{} has no {} component'.format(path,component))
+        self._array = self._file[component.lower()]
+        self.shape  = tuple(self._array.shape)
+        self.origin = tuple(int(i) for i in attrs['origin'])
+        self.wcs    = str(attrs['wcs']).split('\n') if attrs['wcs'] else None
+
+    def __getitem__(self,key):
+        return np.asarray(self._array[key])
+
+    def section(self,lbnd,ubnd):
+        '''
+        Read the part of the array between two pixel indices (inclusive, NumPy axis order, as ndfio.ndf_bounds),
+        clipped to the array
+
+        lbnd: The lower pixel index on each axis
+        ubnd: The upper pixel index on each axis
+        '''
+        key = tuple(slice(max(l-o,0),max(min(u-o+1,n),0)) for l,u,o,n in zip(lbnd,ubnd,self.origin,self.shape))
+        return self[key]
+
+    def spectrum(self,x,y):
+        '''
+        Read the spectrum at one spatial pixel of a cube
+
+        x,y: The pixel indices
+        '''
+        iy,ix = y-self.origin[-2],x-self.origin[-1]
+        if not (0 <= iy < self.shape[-2] and 0 <= ix < self.shape[-1]):
+            raise IndexError('Pixel ({},{}) is outside {}'.format(x,y,self.path))
+        return self[(slice(None),iy,ix)]
+
+    def close(self):
+        if self._file is not None and self.format != 'zarr':
+            self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def open_cube(path,component='DATA'):
+    '''
+    Open a cube (or map) in any of the output formats for lazy reading, see LazyCube
+    e.g. with open_cube('coadds/SERPENS_SOUTH_CO_coadd.h5') as cube: spectrum = cube.spectrum(10,-4)
+
+    path     : The file (.fits, .fits.fz, .h5 or .zarr)
+    component: 'DATA' (default) or 'VARIANCE'
+    '''
+    return LazyCube(path,component)
@@ -0,0 +1,168 @@
+import errno
+import fcntl
+import os
+import shutil
+from contextlib import contextmanager
+
+#####
+# File management for SURFING, done in this process rather than with os.system('mkdir/cp/mv/rm ...').
+#
+# Nothing here fails silently: anything other than "it's already there" (makedirs) or "it's already gone"
+# (remove, remove_tree) raises an OSError. Files that other steps read -- coadds, their FITS copies, the manifest
+# and the other JSON records -- are written under a temporary name next to their final name and then renamed
+# over it, so at every moment there is either the complete old file or the complete new one.
+# The temporary names include the process id, so several workers (see SURFING.jobqueue) never share one.
+#
+# locked() holds a lock file, for anything that more than one worker process -- or host, on a shared
+# filesystem -- may update at once (e.g. a region's coadds, the manifest).
+#####
+
+def temp_path(path,suffix='_partial'):
+    '''
+    A temporary name for this process next to path, keeping its extension (Starlink needs the .sdf)
+    e.g. coadds/X_CO_coadd.sdf -> coadds/X_CO_coadd_partial12345.sdf
+
+    path  : The final path
+    suffix: What to add to the name
+    '''
+    root,ext = os.path.splitext(path)
+    return '{}{}{}{}'.format(root,suffix,os.getpid(),ext)
+
+def makedirs(path):
+    '''
+    Make a directory and any missing parent directories (mkdir -p)
+
+    path: The directory
+    '''
+    if path != '':
+        os.makedirs(path,exist_ok=True)
+
+def remove(path):
+    '''
+    Delete a file if it exists (rm -f)
+
+    path: The file
+    '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def remove_tree(path):
+    '''
+    Delete a directory and everything in it, if it exists (rm -rf)
+
+    path: The directory
+    '''
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+
+def replace(src,dest):
+    '''
+    Move src to dest in one step, replacing dest if it exists. On the same filesystem this is a rename;
+    otherwise src is copied to a temporary name next to dest, renamed over dest, and then deleted.
+
+    src : The new file
+    dest: Where it goes
+    '''
+    try:
+        os.replace(src,dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy(src,dest)
+        os.remove(src)
+    return dest
+
+def replace_tree(src,dest):
+    '''
+    Move the directory src to dest, replacing dest if it exists. The old dest is renamed out of the way first and
+    deleted afterwards, so dest is only missing for the moment between two renames.
+
+    src : The new directory
+    dest: Where it goes
+    '''
+    old = None
+    if os.path.exists(dest):
+        old = temp_path(dest,'_old')
+        os.replace(dest,old)
+    os.replace(src,dest)
+    if old is not None:
+        remove_tree(old)
+    return dest
+
+def move(src,dest):
+    '''
+    Move a file (mv). If dest is a directory the file keeps its name. The move is atomic, see replace.
+
+    src : The file
+    dest: The new path, or a directory to move it in to
+    '''
+    if os.path.isdir(dest):
+        dest = os.path.join(dest,os.path.basename(src))
+    return replace(src,dest)
+
+def copy(src,dest):
+    '''
+    Copy a file (cp). If dest is a directory the copy keeps its name. The copy is written under a temporary
+    name and renamed in to place, so dest is never half written.
+
+    src : The file
+    dest: The new path, or a directory to copy it in to
+    '''
+    if os.path.isdir(dest):
+        dest = os.path.join(dest,os.path.basename(src))
+    partial = temp_path(dest)
+    try:
+        shutil.copyfile(src,partial)
+        os.replace(partial,dest)
+    except BaseException:
+        remove(partial)
+        raise
+    return dest
+
+@contextmanager
+def atomic_write(path,mode='w',newline=None):
+    '''
+    Open a file for writing so it only replaces path once the with block has finished without an error
+    e.g. with atomic_write('reduced/manifest.json') as f: json.dump(manifest,f)
+
+    path   : The file to write
+    mode   : The open() mode, 'w' or 'wb'
+    newline: As for open() e.g. '' for the csv module
+    '''
+    makedirs(os.path.dirname(path))
+    partial = temp_path(path)
+    try:
+        with open(partial,mode,newline=newline) as f:
+            yield f
+        os.replace(partial,path)
+    except BaseException:
+        remove(partial)
+        raise
+
+@contextmanager
+def locked(lockfile,exclusive=True,block=True):
+    '''
+    Hold a lock on a lock file (made if need be) for the with block. Uses flock, which Linux also
+    honours between hosts on NFS. Yields True if the lock was taken, or False if block=False and it is held elsewhere.
+    e.g. with locked('coadds/SERPENS_SOUTH_CO_coadd.lock'): ...
+
+    lockfile : The lock file
+    exclusive: True for an exclusive (write) lock, False for a shared (read) lock
+    block    : If True, wait for the lock
+    '''
+    makedirs(os.path.dirname(lockfile))
+    with open(lockfile,'a') as f:
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(f,mode if block else mode|fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f,fcntl.LOCK_UN)
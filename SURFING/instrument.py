@@ -0,0 +1,310 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+#####
+# Structured timing and resource records for every pipeline stage and every external (Starlink) call.
+#
+# Each record is one JSON line in RECORDS_FILE with:
+#     run      : an id shared by every record of one run of the pipeline
+#     kind     : 'stage' or 'call'
+#     name     : e.g. 'reduce', 'coadd', 'kappa.wcsmosaic', 'wrapper.oracdr'
+#     start    : the UNIX time it started
+#     wall     : wall clock time (s)
+#     cpu      : cpu_self+cpu_children (cpu_self alone if cpu_children is None)
+#     cpu_self : CPU time (s) used by the thread it ran in -- other threads' work is not included
+#     cpu_children: CPU time (s) of the child processes that finished during it (the Starlink tasks run as child
+#                processes), or None if anything else was being measured in another thread at the same time
+#     maxrss_kb: the peak resident set size (kB) of the child processes that finished during it, or None if that
+#                can't be told apart (as for cpu_children) or no child finished with a bigger peak than earlier ones
+#     shared   : True if other threads were being measured at the same time (e.g. the task graph with nworkers>1),
+#                so the child process figures could not be given to this record alone
+#     bytes_in : the size of the existing files it read (calls), or that were passed in as inputs (stages)
+#     bytes_out: the size of the files it wrote
+#     status   : 'ok' or 'error' (with the error message in 'error')
+# plus the tags of the stage it ran in (e.g. datescan, pol, molecule, region).
+#
+# Wrap a Starlink module with wrap() to record every call made through it, and put stages in a
+# "with stage(name,**tags):" block. summary_table() gives an end-of-run table of where the time went.
+#####
+
+RECORDS_FILE = 'reduced/run_records.jsonl'
+
+# The run id is passed to worker processes through the environment
+RUN_ID = os.environ.setdefault('SURFING_RUN_ID',time.strftime('%Y%m%dT%H%M%S')+'_'+uuid.uuid4().hex[:6])
+
+_lock  = threading.Lock()
+_local = threading.local()
+
+def configure(records_file=RECORDS_FILE,new_run=True):
+    '''
+    Choose where records are written, and (by default) start a new run id
+
+    records_file: The JSON lines file to append records to
+    new_run     : If True, records from here on get a new run id
+    '''
+    global RECORDS_FILE,RUN_ID
+    RECORDS_FILE = records_file
+    if new_run:
+        RUN_ID = time.strftime('%Y%m%dT%H%M%S')+'_'+uuid.uuid4().hex[:6]
+        os.environ['SURFING_RUN_ID'] = RUN_ID
+
+def _tags():
+    '''
+    The tags of the stages this thread is currently inside (inner stages override outer ones)
+    '''
+    tags = {}
+    for eachtags in getattr(_local,'stack',[]):
+        tags.update(eachtags)
+    return tags
+
+def _write(record):
+    '''
+    Append one record to the records file. Each record is a single write, so records from
+    several threads and processes don't get mixed up.
+    '''
+    line = json.dumps(record,default=str)+'\n'
+    with _lock:
+        if os.path.dirname(RECORDS_FILE) != '' and not os.path.exists(os.path.dirname(RECORDS_FILE)):
+            os.makedirs(os.path.dirname(RECORDS_FILE),exist_ok=True)
+        with open(RECORDS_FILE,'a') as f:
+            f.write(line)
+
+def _filesize(paths):
+    '''
+    The total size of those paths that are existing files
+    '''
+    total = 0
+    for path in paths:
+        if isinstance(path,str) and os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total
+
+# The blocks being measured in each thread, so a block can tell whether another thread was busy at the same time --
+# the kernel only totals up finished child processes for the whole process (RUSAGE_CHILDREN), not per thread
+_active = {}
+
+def _usage():
+    '''
+    (wall time, CPU time of this thread, CPU time of the finished children, peak child RSS in kB)
+    '''
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.time(),time.thread_time(),children.ru_utime+children.ru_stime,children.ru_maxrss
+
+def _enter(state):
+    '''
+    Start tracking a measured block in this thread, marking it (and anything open in other threads) as shared
+    if other threads are being measured too
+    '''
+    me = threading.get_ident()
+    with _lock:
+        others = [i for thread,states in _active.items() if thread != me for i in states]
+        if len(others) > 0:
+            state['shared'] = True
+            for i in others:
+                i['shared'] = True
+        _active.setdefault(me,[]).append(state)
+
+def _exit(state):
+    me = threading.get_ident()
+    with _lock:
+        _active[me].remove(state)
+        if len(_active[me]) == 0:
+            del _active[me]
+
+@contextmanager
+def _measure(kind,name,tags):
+    '''
+    Measure the block and write a record for it. The yielded dictionary can be given
+    'bytes_in'/'bytes_out' (and any other fields) by the block.
+    '''
+    extra = {}
+    state = {'shared':False}
+    start,cpu0,child0,maxrss0 = _usage()
+    _enter(state)
+    status,error = 'ok',None
+    try:
+        yield extra
+    except BaseException as e:
+        status,error = 'error','{}: {}'.format(type(e).__name__,e)
+        raise
+    finally:
+        end,cpu1,child1,maxrss1 = _usage()
+        _exit(state)
+        if state['shared']:
+            children,maxrss = None,None
+        else:
+            children,maxrss = child1-child0,(maxrss1 if maxrss1 > maxrss0 else None)
+        record = {'run':RUN_ID,'kind':kind,'name':name,'start':start,'wall':end-start,
+                  'cpu':cpu1-cpu0+(children or 0.0),'cpu_self':cpu1-cpu0,'cpu_children':children,'maxrss_kb':maxrss,
+                  'shared':state['shared'],'bytes_in':0,'bytes_out':0,'status':status,'pid':os.getpid()}
+        record.update(tags)
+        record.update(extra)
+        if error is not None:
+            record['error'] = error
+        _write(record)
+
+@contextmanager
+def stage(name,inputs=(),outputs=(),**tags):
+    '''
+    Record a pipeline stage. Calls made through wrapped modules inside the block are tagged with this stage's tags.
+
+    name   : The stage name, e.g. 'reduce'
+    inputs : Files the stage reads, for the bytes_in count
+    outputs: Files the stage writes, for the bytes_out count (measured when the stage ends)
+    tags   : Anything else to record, e.g. datescan='20220307_73', molecule='CO'
+    '''
+    if not hasattr(_local,'stack'):
+        _local.stack = []
+    _local.stack.append(dict(tags,stage=name))
+    try:
+        with _measure('stage',name,_tags()) as extra:
+            extra['bytes_in'] = _filesize(inputs)
+            try:
+                yield extra
+            finally:
+                extra['bytes_out'] = extra.get('bytes_out',0)+_filesize(outputs)
+    finally:
+        _local.stack.pop()
+
+def _paths(args,kwargs):
+    '''
+    Collect the file paths passed to a Starlink command: string arguments, lists of strings,
+    and the contents of '^list' files
+    '''
+    paths = []
+    for value in list(args)+list(kwargs.values()):
+        if isinstance(value,(list,tuple)):
+            paths = paths+[i for i in value if isinstance(i,str)]
+        elif isinstance(value,str):
+            if value.startswith('^') and os.path.isfile(value[1:]):
+                with open(value[1:]) as f:
+                    paths = paths+[i.strip() for i in f if i.strip() != '']
+            else:
+                paths.append(value)
+    return paths
+
+def _snapshot(paths):
+    '''
+    The (size,mtime) of each path that is an existing file
+    '''
+    state = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except (OSError,ValueError):
+            continue
+        if os.path.isfile(path):
+            state[path] = (stat.st_size,stat.st_mtime)
+    return state
+
+def traced(name,func):
+    '''
+    Wrap a function so every call to it is recorded. Files passed to it that exist beforehand and are unchanged
+    afterwards count as inputs; files that are new or changed afterwards count as outputs. If the function
+    returns an ORACDR output object, its data files also count as outputs.
+
+    name: The name to record the call under, e.g. 'kappa.wcsmosaic'
+    func: The function to wrap
+    '''
+    @functools.wraps(func)
+    def wrapped(*args,**kwargs):
+        paths  = _paths(args,kwargs)
+        before = _snapshot(paths)
+        with _measure('call',name,_tags()) as extra:
+            result = func(*args,**kwargs)
+            after  = _snapshot(paths)
+            extra['bytes_in']  = sum(size for path,(size,mtime) in before.items() if after.get(path) == (size,mtime))
+            extra['bytes_out'] = sum(size for path,(size,mtime) in after.items() if before.get(path) != (size,mtime))
+            if hasattr(result,'datafiles'):
+                extra['bytes_out'] += _filesize(result.datafiles)
+                extra['products']   = len(result.datafiles)
+        return result
+    return wrapped
+
+class _Wrapped:
+    '''
+    A stand-in for a module whose functions are all recorded with traced()
+    '''
+
+    def __init__(self,module,prefix):
+        self._module = module
+        self._prefix = prefix
+
+    def __getattr__(self,attr):
+        value = getattr(self._module,attr)
+        if callable(value):
+            return traced('{}.{}'.format(self._prefix,attr),value)
+        return value
+
+def wrap(module,prefix):
+    '''
+    Wrap a module (e.g. starlink.kappa) so every function called through it is recorded
+
+    module: The module
+    prefix: The name to record calls under, e.g. 'kappa' gives 'kappa.wcsmosaic'
+    '''
+    return _Wrapped(module,prefix)
+
+def load_records(records_file=None,run=None):
+    '''
+    Read records back in
+
+    records_file: The JSON lines file. Default the current RECORDS_FILE
+    run         : Only return records from this run id. Default None returns every run
+    '''
+    records_file = RECORDS_FILE if records_file is None else records_file
+    records = []
+    if not os.path.exists(records_file):
+        return records
+    with open(records_file) as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            if run is None or record.get('run') == run:
+                records.append(record)
+    return records
+
+def summary_table(records,by='name',kind=None,top=None):
+    '''
+    Total up records by one field (e.g. 'name', 'datescan', 'molecule', 'stage') as a text table,
+    sorted by total wall time. The 'shared' column counts the records whose child process CPU and memory could not
+    be told apart from other threads' (see above), so are left out of cpu[s] and maxrss[MB].
+
+    records: The records, e.g. from load_records
+    by     : The field to group by
+    kind   : Only include 'stage' or 'call' records. Default None includes both
+    top    : Only show this many rows. Default None shows them all
+    '''
+    groups = {}
+    for record in records:
+        if kind is not None and record['kind'] != kind:
+            continue
+        key = record.get(by)
+        if key is None:
+            continue
+        group = groups.setdefault(key,{'n':0,'wall':0.0,'cpu':0.0,'maxrss_kb':0,'bytes_in':0,'bytes_out':0,'errors':0,
+                                       'shared':0})
+        group['n']        += 1
+        group['wall']     += record['wall']
+        group['cpu']      += record['cpu']
+        group['maxrss_kb'] = max(group['maxrss_kb'],record['maxrss_kb'] or 0)
+        group['shared']   += bool(record.get('shared'))
+        group['bytes_in'] += record['bytes_in']
+        group['bytes_out']+= record['bytes_out']
+        group['errors']   += record['status'] != 'ok'
+
+    rows  = sorted(groups.items(),key=lambda i: -i[1]['wall'])[:top]
+    lines = ['{:<28s} {:>5s} {:>10s} {:>10s} {:>12s} {:>10s} {:>10s} {:>6s} {:>6s}'.format(
+                by,'n','wall[s]','cpu[s]','maxrss[MB]','in[MB]','out[MB]','errors','shared')]
+    for key,group in rows:
+        lines.append('{:<28s} {:>5d} {:>10.2f} {:>10.2f} {:>12.1f} {:>10.1f} {:>10.1f} {:>6d} {:>6d}'.format(
+                str(key),group['n'],group['wall'],group['cpu'],group['maxrss_kb']/1024.,
+                group['bytes_in']/1e6,group['bytes_out']/1e6,group['errors'],group['shared']))
+    return '\n'.join(lines)
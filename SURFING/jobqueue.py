@@ -0,0 +1,331 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from SURFING import backend,fileops
+
+#####
+# A persistent queue of (region, datescan) jobs, so a season's backlog can be shared out over several worker
+# processes -- on one machine, or on several hosts that share the working directory.
+#
+# The queue is an SQLite database (QUEUE_FILE). Each job is one datescan of one region, with the parameters
+# to run the pipeline with (recipe, parfile, molecules...). A worker claims the oldest pending job, runs the
+# SURFING.pipeline task graph for it, and marks it done or failed. While a job runs the worker updates its
+# heartbeat; a running job whose heartbeat stops for STALE_AFTER seconds (e.g. its worker was killed) goes back
+# to pending for another worker to pick up.
+#
+# Workers can run side by side because:
+#     - each job has its own scheduler state file and its own temporary directories and files, and writes its
+#       summary, product index cache and contact sheet to its own directory (see job_dir)
+#     - only one worker at a time can update a region's co-add of a molecule (a lock file next to the co-add)
+#     - the manifest is locked while it is updated
+#
+# Usage:
+#     python -m SURFING.jobqueue submit SERPENS_SOUTH 20220307_73 20220307_74 ...
+#     python -m SURFING.jobqueue work --nprocs 4      (on as many machines as you like)
+#     python -m SURFING.jobqueue status
+# or set use_queue = True in SURFING.py, which submits its datescans and then works on the queue.
+#
+# Note that SQLite relies on the shared filesystem's locking -- use a filesystem where that works (e.g. NFSv4, Lustre).
+#####
+
+QUEUE_FILE = 'reduced/queue.sqlite'
+
+# Seconds without a heartbeat before a running job is given to another worker
+STALE_AFTER = 30*60
+HEARTBEAT   = 60
+
+# The pipeline parameters stored with each job, and their defaults
+DEFAULT_PARAMS = {'recipe'      : 'REDUCE_SCIENCE_NARROWLINE',
+                  'parfile'     : 'config/SURFING.ini',
+                  'mol_subband' : {'C18O':1,'13CO':2,'CO':3},
+                  'force'       : False,
+                  'coadd_engine': 'wcsmosaic',
+                  'coadd_tile_mb': 256,
+                  'fits_include': None,
+                  'fits_exclude': None,
+                  'quicklook_binning': 4,
+                  'output_format': 'fits'}
+
+def _connect(queue_file=QUEUE_FILE):
+    '''
+    Open the queue, creating it if need be. Transactions are started explicitly (see claim).
+    '''
+    fileops.makedirs(os.path.dirname(queue_file))
+    conn = sqlite3.connect(queue_file,timeout=120,isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                        id        INTEGER PRIMARY KEY AUTOINCREMENT,
+                        region    TEXT NOT NULL,
+                        datescan  TEXT NOT NULL,
+                        params    TEXT NOT NULL,
+                        status    TEXT NOT NULL DEFAULT 'pending',
+                        worker    TEXT,
+                        attempts  INTEGER NOT NULL DEFAULT 0,
+                        submitted REAL,
+                        started   REAL,
+                        heartbeat REAL,
+                        finished  REAL,
+                        error     TEXT,
+                        UNIQUE(region,datescan))''')
+    return conn
+
+def worker_name():
+    '''
+    A name for this worker process: host:pid
+    '''
+    return '{}:{}'.format(socket.gethostname(),os.getpid())
+
+def submit(region,datescans,queue_file=QUEUE_FILE,resubmit=False,**params):
+    '''
+    Add (region, datescan) jobs to the queue. Jobs already in the queue are left alone, except failed jobs,
+    which are put back to pending with the new parameters.
+
+    region    : The region the datescans belong to e.g. SERPENS_SOUTH
+    datescans : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    queue_file: The queue database
+    resubmit  : If True, put jobs that are already done back to pending too
+    params    : The pipeline parameters for these jobs, see DEFAULT_PARAMS
+
+    Returns the number of jobs that are now pending because of this call
+    '''
+    unknown = set(params)-set(DEFAULT_PARAMS)
+    if len(unknown) > 0:
+        raise ValueError('Unknown job parameters: {}'.format(', '.join(sorted(unknown))))
+    thisparams = dict(DEFAULT_PARAMS,**params)
+    thisparams = json.dumps(thisparams,sort_keys=True)
+
+    statuses = ['failed','done'] if resubmit else ['failed']
+    conn     = _connect(queue_file)
+    queued   = 0
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        for datescan in datescans:
+            cursor = conn.execute('INSERT OR IGNORE INTO jobs (region,datescan,params,submitted) VALUES (?,?,?,?)',
+                                  (region,datescan,thisparams,time.time()))
+            if cursor.rowcount == 0:
+                cursor = conn.execute('UPDATE jobs SET status=?,params=?,error=NULL,worker=NULL WHERE region=? AND datescan=? '
+                                      'AND status IN ({})'.format(','.join('?'*len(statuses))),
+                                      ['pending',thisparams,region,datescan]+statuses)
+            queued += cursor.rowcount
+    conn.close()
+    return queued
+
+def claim(worker=None,queue_file=QUEUE_FILE):
+    '''
+    Take the oldest pending job, first returning any stale running jobs to pending.
+    The whole thing is one transaction, so two workers can never claim the same job.
+
+    worker    : The name of the worker, default worker_name()
+    queue_file: The queue database
+
+    Returns the job as a dictionary (with params decoded), or None if there are no pending jobs
+    '''
+    worker = worker_name() if worker is None else worker
+    conn   = _connect(queue_file)
+    now    = time.time()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        stale = conn.execute("UPDATE jobs SET status='pending',worker=NULL WHERE status='running' AND heartbeat<?",
+                             (now-STALE_AFTER,)).rowcount
+        if stale > 0:
+            print('Returned {} stale job(s) to the queue'.format(stale))
+        job = conn.execute("SELECT * FROM jobs WHERE status='pending' ORDER BY id LIMIT 1").fetchone()
+        if job is not None:
+            conn.execute("UPDATE jobs SET status='running',worker=?,started=?,heartbeat=?,attempts=attempts+1 WHERE id=?",
+                         (worker,now,now,job['id']))
+    conn.close()
+    if job is None:
+        return None
+    job = dict(job)
+    job['params'] = json.loads(job['params'])
+    return job
+
+def heartbeat(jobid,queue_file=QUEUE_FILE):
+    '''
+    Record that the worker running a job is still alive
+    '''
+    conn = _connect(queue_file)
+    with conn:
+        conn.execute("UPDATE jobs SET heartbeat=? WHERE id=? AND status='running'",(time.time(),jobid))
+    conn.close()
+
+def finish(jobid,error=None,queue_file=QUEUE_FILE):
+    '''
+    Mark a job as done, or as failed if error is given
+
+    jobid     : The job id
+    error     : None if the job succeeded, otherwise a description of what went wrong
+    queue_file: The queue database
+    '''
+    conn = _connect(queue_file)
+    with conn:
+        conn.execute('UPDATE jobs SET status=?,finished=?,error=? WHERE id=?',
+                     ('done' if error is None else 'failed',time.time(),error,jobid))
+    conn.close()
+
+def jobs(queue_file=QUEUE_FILE,status=None,region=None):
+    '''
+    List the jobs in the queue
+
+    queue_file: The queue database
+    status    : Only list jobs with this status ('pending','running','done','failed'). Default None lists them all
+    region    : Only list jobs of this region. Default None lists them all
+    '''
+    conn  = _connect(queue_file)
+    query = 'SELECT * FROM jobs WHERE 1=1'
+    args  = []
+    if status is not None:
+        query,args = query+' AND status=?',args+[status]
+    if region is not None:
+        query,args = query+' AND region=?',args+[region]
+    rows = [dict(i) for i in conn.execute(query+' ORDER BY id',args)]
+    conn.close()
+    return rows
+
+def job_dir(job):
+    '''
+    The directory for the files a job writes that would otherwise be shared by the whole working directory
+    (Summary.txt, the product index cache and the contact sheet): reduced/jobs/<region>_<datescan>/
+
+    job: The job, as returned by claim
+    '''
+    return os.path.join('reduced','jobs','{}_{}'.format(job['region'],job['datescan']))
+
+def _run_job(job,nprocs=1):
+    '''
+    Run the pipeline for one job. Returns None if it succeeded, or a description of what failed
+    '''
+    from SURFING.pipeline import build_pipeline
+    from SURFING.products import ProductIndex
+
+    params   = dict(DEFAULT_PARAMS,**job['params'])
+    datescan = job['datescan']
+    jobdir   = job_dir(job)
+    index    = ProductIndex.load([datescan],index_file=os.path.join(jobdir,'product_index.json'))
+    graph    = build_pipeline(job['region'],[datescan],params['recipe'],params['mol_subband'],parfile=params['parfile'],
+                              force=params['force'],coadd_engine=params['coadd_engine'],fits_include=params['fits_include'],
+                              fits_exclude=params['fits_exclude'],index=index,coadd_nprocs=nprocs,coadd_tile_mb=params['coadd_tile_mb'],
+                              quicklook_binning=params['quicklook_binning'],output_format=params['output_format'],
+                              state_file='reduced/pipeline_state_{}_{}.json'.format(job['region'],datescan),
+                              summary_file=os.path.join(jobdir,'Summary.txt'),contact_sheet=os.path.join(jobdir,'quicklook.html'))
+    success  = graph.run(nworkers=nprocs)
+    index.update()
+    index.save(os.path.join(jobdir,'product_index.json'))
+    if success:
+        return None
+    return 'Failed tasks: {}'.format(', '.join(sorted(graph.failed)))
+
+def work(queue_file=QUEUE_FILE,nprocs=1,max_jobs=None,wait=False,poll=60):
+    '''
+    Claim and run jobs until the queue is empty
+
+    queue_file: The queue database
+    nprocs    : The number of workers each job's task graph uses
+    max_jobs  : Stop after this many jobs. Default None keeps going
+    wait      : If True, wait for new jobs (checking every poll seconds) rather than stopping when the queue is empty
+    poll      : Seconds between checks for new jobs when wait is True
+
+    Returns the number of jobs run and the number that failed
+    '''
+    worker = worker_name()
+    nrun,nfailed = 0,0
+    while max_jobs is None or nrun < max_jobs:
+        job = claim(worker,queue_file)
+        if job is None:
+            if not wait:
+                break
+            time.sleep(poll)
+            continue
+
+        print('\n#####\n{} is running job {}: {} {}\n#####'.format(worker,job['id'],job['region'],job['datescan']))
+
+        # Keep the heartbeat going in the background while the job runs
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(HEARTBEAT):
+                heartbeat(job['id'],queue_file)
+        beater = threading.Thread(target=beat,name='SURFING-heartbeat',daemon=True)
+        beater.start()
+        try:
+            error = _run_job(job,nprocs=nprocs)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__,e)
+        finally:
+            stop.set()
+            beater.join()
+
+        finish(job['id'],error,queue_file)
+        nrun = nrun+1
+        if error is not None:
+            nfailed = nfailed+1
+            print('Oh no! Job {} ({} {}) failed: {}'.format(job['id'],job['region'],job['datescan'],error))
+
+    # Each job's contact sheet only shows its own datescan -- finish with one for every job that is done.
+    # Workers finishing at the same time take turns, so the last one to write it sees every finished job
+    if nrun > 0:
+        from SURFING import quicklook
+        with fileops.locked(quicklook.CONTACT_SHEET+'.lock'):
+            done        = jobs(queue_file,status='done')
+            mol_subband = {}
+            for eachjob in done:
+                mol_subband.update(json.loads(eachjob['params'])['mol_subband'])
+            quicklook.contact_sheet(sorted(set(i['datescan'] for i in done)),mol_subband)
+
+    return nrun,nfailed
+
+def status_table(queue_file=QUEUE_FILE):
+    '''
+    The number of jobs of each status for each region, as a text table
+    '''
+    counts = {}
+    for job in jobs(queue_file):
+        counts.setdefault(job['region'],{}).setdefault(job['status'],0)
+        counts[job['region']][job['status']] += 1
+    lines = ['{:<24s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('region','pending','running','done','failed')]
+    for region in sorted(counts):
+        lines.append('{:<24s} {:>8d} {:>8d} {:>8d} {:>8d}'.format(region,*[counts[region].get(i,0) for i in ['pending','running','done','failed']]))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='The SURFING batch queue')
+    parser.add_argument('--queue',default=QUEUE_FILE,help='The queue database')
+    parser.add_argument('--starpath',default=None,help='The Starlink installation (default $SURFING_STARPATH, $STARLINK_DIR or /star)')
+    commands = parser.add_subparsers(dest='command',required=True)
+
+    submitparser = commands.add_parser('submit',help='Add datescans of a region to the queue')
+    submitparser.add_argument('region')
+    submitparser.add_argument('datescans',nargs='+')
+    submitparser.add_argument('--recipe',default=DEFAULT_PARAMS['recipe'])
+    submitparser.add_argument('--parfile',default=DEFAULT_PARAMS['parfile'])
+    submitparser.add_argument('--coadd-engine',default=DEFAULT_PARAMS['coadd_engine'],choices=['wcsmosaic','incremental','tiled'])
+    submitparser.add_argument('--output-format',default=DEFAULT_PARAMS['output_format'],choices=['fits','fits.fz','h5','zarr'])
+    submitparser.add_argument('--force',action='store_true',help='Reduce again even if the manifest says they are up to date')
+    submitparser.add_argument('--resubmit',action='store_true',help='Put jobs that are already done back in the queue')
+
+    workparser = commands.add_parser('work',help='Run jobs from the queue')
+    workparser.add_argument('--nprocs',type=int,default=1,help='Workers for each job')
+    workparser.add_argument('--max-jobs',type=int,default=None)
+    workparser.add_argument('--wait',action='store_true',help='Wait for new jobs instead of stopping when the queue is empty')
+
+    commands.add_parser('status',help='Show the number of jobs of each status')
+    args = parser.parse_args(argv)
+    if args.starpath is not None:
+        backend.configure(starpath=args.starpath)
+
+    if args.command == 'submit':
+        queued = submit(args.region,args.datescans,queue_file=args.queue,resubmit=args.resubmit,recipe=args.recipe,
+                        parfile=args.parfile,coadd_engine=args.coadd_engine,output_format=args.output_format,force=args.force)
+        print('{} job(s) queued'.format(queued))
+    elif args.command == 'work':
+        nrun,nfailed = work(queue_file=args.queue,nprocs=args.nprocs,max_jobs=args.max_jobs,wait=args.wait)
+        print('Ran {} job(s), {} failed'.format(nrun,nfailed))
+    print(status_table(args.queue))
+
+if __name__ == '__main__':
+    main()
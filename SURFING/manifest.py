@@ -0,0 +1,183 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from SURFING import fileops
+
+# The manifest lives alongside the reduced products it describes
+MANIFEST_FILE = 'reduced/manifest.json'
+
+# Stands in for the ORACDR output object of a reduction that was skipped because it is up to date
+RecordedOutput = namedtuple('RecordedOutput',['runlog','datafiles','imagefiles','logfiles'])
+
+# Serialises read-modify-write cycles on the manifest between threads of this process
+_lock = threading.Lock()
+
+def _sha1_file(path,blocksize=1<<20):
+    '''
+    Return the SHA1 hex digest of a file's contents, read in blocks so large raw files are not held in memory
+
+    path     : The file to hash
+    blocksize: The number of bytes to read at a time
+    '''
+    sha1 = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(blocksize),b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def manifest_key(datescan,eachpol=None):
+    '''
+    The manifest key for one reduction -- 'YYYYMMDD_SS' for the combined P0+P1 reduction,
+    'YYYYMMDD_SS/P0' or 'YYYYMMDD_SS/P1' for the individual polarisations
+
+    datescan : A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    eachpol  : None for the combined reduction, or 'P0'/'P1'
+    '''
+    if eachpol is None:
+        return datescan
+    return '{}/{}'.format(datescan,eachpol)
+
+def fingerprint(datescan,recipe,parfile='',bad_receptors=None,checksum=False):
+    '''
+    Describe everything that goes in to a reduction, and summarise it with a single hash.
+    If any of these inputs change, the reduction has to be redone.
+
+    datescan     : A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    recipe       : The ORACDR recipe to run. e.g. 'REDUCE_SCIENCE_NARROWLINE'
+    parfile      : The configuration/parameter file passed to ORACDR. Its contents (not its name) are fingerprinted
+    bad_receptors: The list of receptors ORACDR is told to ignore (None or [] if none)
+    checksum     : If True, hash the contents of each raw file. Otherwise (default) use the file sizes and
+                   modification times, which is much quicker and catches re-downloaded or replaced raw data
+
+    Returns a dictionary of the inputs, with the overall hash stored under 'hash'
+    '''
+    rawpath   = 'raw/{}/{}/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+    raw_files = sorted(list(glob.glob(os.path.join(rawpath,'*sdf'))))
+
+    raw = []
+    for eachfile in raw_files:
+        stat = os.stat(eachfile)
+        if checksum:
+            raw.append([os.path.basename(eachfile),stat.st_size,_sha1_file(eachfile)])
+        else:
+            raw.append([os.path.basename(eachfile),stat.st_size,int(stat.st_mtime)])
+
+    if parfile != '' and os.path.exists(parfile):
+        parfile_hash = _sha1_file(parfile)
+    else:
+        parfile_hash = ''
+
+    inputs = {'raw'          : raw,
+              'recipe'       : recipe,
+              'parfile'      : parfile_hash,
+              'bad_receptors': sorted(bad_receptors or [])}
+    inputs['hash'] = hashlib.sha1(json.dumps(inputs,sort_keys=True).encode()).hexdigest()
+
+    return inputs
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    '''
+    Read the manifest of previous reductions. Returns an empty manifest if there isn't one yet.
+
+    manifest_file: The path to the manifest
+    '''
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_manifest(manifest,manifest_file=MANIFEST_FILE):
+    '''
+    Write the manifest. The new version is written next to the old one and renamed over it,
+    so a crash part way through never leaves a truncated manifest behind.
+
+    manifest     : The manifest dictionary
+    manifest_file: The path to the manifest
+    '''
+    with fileops.atomic_write(manifest_file) as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+
+@contextmanager
+def locked_manifest(manifest_file=MANIFEST_FILE):
+    '''
+    Load the manifest for updating, and save it again at the end of the with block.
+    Nobody else -- in this process, another worker process or on another host -- can update the manifest
+    in the meantime, so reductions finishing at the same time can't overwrite each other's entries.
+
+    manifest_file: The path to the manifest
+    '''
+    with _lock, fileops.locked(manifest_file+'.lock'):
+        themanifest = load_manifest(manifest_file)
+        yield themanifest
+        save_manifest(themanifest,manifest_file)
+
+def is_up_to_date(manifest,key,inputs):
+    '''
+    Check whether the reduction recorded under key was made from exactly these inputs
+    and all of the products it made are still on disk.
+
+    manifest: The manifest dictionary
+    key     : The manifest key, see manifest_key
+    inputs  : The fingerprint of the reduction we are about to run, see fingerprint
+    '''
+    entry = manifest.get(key)
+    if entry is None or entry['inputs']['hash'] != inputs['hash']:
+        return False
+    for eachfile in entry['products']:
+        if not os.path.exists(eachfile):
+            return False
+    return True
+
+def record(manifest,key,inputs,output):
+    '''
+    Record a finished reduction in the manifest
+
+    manifest: The manifest dictionary
+    key     : The manifest key, see manifest_key
+    inputs  : The fingerprint of the reduction, see fingerprint
+    output  : The ORACDR output object for the reduction. The ORACworking* part of
+              each path is removed, since the products have been moved out of there
+    '''
+    manifest[key] = {'inputs'    : inputs,
+                     'products'  : [strip_working(i) for i in output.datafiles],
+                     'runlog'    : output.runlog,
+                     'datafiles' : list(output.datafiles),
+                     'imagefiles': list(output.imagefiles),
+                     'logfiles'  : list(output.logfiles)}
+
+def recorded_output(manifest,key):
+    '''
+    Rebuild the useful parts of the ORACDR output object for a reduction recorded in the manifest
+
+    manifest: The manifest dictionary
+    key     : The manifest key, see manifest_key
+    '''
+    entry = manifest[key]
+    return RecordedOutput(entry['runlog'],entry['datafiles'],entry['imagefiles'],entry['logfiles'])
+
+def remove_products(manifest,key):
+    '''
+    Delete the data products recorded for a stale reduction so they can't be mixed
+    in with the products of the new one (e.g. picked up by the coadd)
+
+    manifest: The manifest dictionary
+    key     : The manifest key, see manifest_key
+    '''
+    entry = manifest.pop(key,None)
+    if entry is None:
+        return
+    for eachfile in entry['products']:
+        fileops.remove(eachfile)
+
+def strip_working(path):
+    '''
+    Remove the ORACworking* directory from a path reported by ORACDR
+
+    path: The path reported by ORACDR
+    '''
+    parts = path.split(os.sep)
+    return os.sep.join([i for i in parts if not i.startswith('ORACworking')])
@@ -0,0 +1,209 @@
+import os
+import tempfile
+import numpy as np
+from SURFING import backend,fileops,instrument
+
+# Record every call to Starlink (see SURFING.instrument)
+kappa = instrument.wrap(backend.kappa,'kappa')
+
+#####
+# Read and write NDF (.sdf) arrays directly with HDS, so pixel arithmetic can be done with NumPy
+# in this process rather than by running a Starlink task for every file.
+#
+# NumPy arrays come back in C order, which is the REVERSE of the Starlink/Fortran axis order:
+# a cube with (x,y,spectral) axes in Starlink is a NumPy array of shape (nspec,ny,nx).
+# Pixel origins returned here are in the same (NumPy) order as the array axes.
+#####
+
+# Starlink "bad" pixel values for single and double precision data
+VAL__BADR = np.float32(-3.4028235e+38)
+VAL__BADD = np.float64(-1.7976931348623157e+308)
+
+def _open(path,mode='READ'):
+    '''
+    Open an NDF with HDS
+
+    path: The path to the .sdf file
+    mode: 'READ' or 'UPDATE'
+    '''
+    return backend.hds.open(path,mode)
+
+def _array_loc(ndfloc,component):
+    '''
+    Return an HDS locator for the numerical values of an NDF array component, and the locator of the component itself.
+    NDF arrays are either a primitive array or an ARRAY structure holding DATA (and an ORIGIN).
+
+    ndfloc   : The locator of the NDF
+    component: 'DATA' or 'VARIANCE'
+    '''
+    name = 'DATA_ARRAY' if component == 'DATA' else component
+    if not ndfloc.there(name):
+        return None,None
+    comploc = ndfloc.find(name)
+    if comploc.struc:
+        return comploc.find('DATA'),comploc
+    return comploc,comploc
+
+def _origin(comploc,ndim):
+    '''
+    Return the pixel origin of an NDF array component in NumPy axis order
+
+    comploc: The locator of the array component
+    ndim   : The number of dimensions of the array
+    '''
+    if comploc.struc and comploc.there('ORIGIN'):
+        return tuple(int(i) for i in reversed(comploc.find('ORIGIN').get()))
+    return tuple([1]*ndim)
+
+def read_ndf(path,component='DATA'):
+    '''
+    Read an array component of an NDF as a floating point NumPy array, with bad pixels set to NaN
+
+    path     : The path to the .sdf file
+    component: 'DATA' (default) or 'VARIANCE'
+
+    Returns (array,origin) where origin is the pixel index of the first element along each (NumPy) axis,
+    or (None,None) if the NDF has no such component
+    '''
+    ndfloc          = _open(path)
+    valloc,comploc  = _array_loc(ndfloc,component)
+    if valloc is None:
+        ndfloc.annul()
+        return None,None
+    array  = np.asarray(valloc.get())
+    origin = _origin(comploc,array.ndim)
+    ndfloc.annul()
+
+    if array.dtype == np.float32:
+        array = np.where(array == VAL__BADR,np.nan,array)
+    else:
+        array = np.where(array == VAL__BADD,np.nan,array.astype(np.float64))
+    return array,origin
+
+def ndf_bounds(path):
+    '''
+    Return the pixel bounds of an NDF as (lbnd,ubnd) tuples in NumPy axis order, without reading the data
+
+    path: The path to the .sdf file
+    '''
+    ndfloc         = _open(path)
+    valloc,comploc = _array_loc(ndfloc,'DATA')
+    shape          = tuple(valloc.shape)[::-1]
+    origin         = _origin(comploc,len(shape))
+    ndfloc.annul()
+    return origin,tuple(o+n-1 for o,n in zip(origin,shape))
+
+def has_component(path,component):
+    '''
+    True if an NDF has an array component (e.g. 'VARIANCE'), without reading it
+
+    path     : The path to the .sdf file
+    component: 'DATA' or 'VARIANCE'
+    '''
+    ndfloc   = _open(path)
+    valloc,_ = _array_loc(ndfloc,component)
+    ndfloc.annul()
+    return valloc is not None
+
+def read_section(path,lbnd,ubnd,workdir):
+    '''
+    Read the data and variance of part of an NDF -- e.g. one tile, or a block of planes of a cube too big to read at
+    once -- by copying that NDF section to a small temporary NDF with kappa.ndfcopy. HDS can only read a whole array,
+    so this keeps the memory used here to the size of the section. Pixels outside the NDF are NaN.
+
+    path   : The path to the .sdf file
+    lbnd   : The lower pixel bounds of the section (NumPy axis order)
+    ubnd   : The upper pixel bounds of the section (NumPy axis order, inclusive)
+    workdir: A directory for the temporary NDF
+
+    Returns (data,var), where var is None if the NDF has no variance
+    '''
+    # NDF sections are given in Starlink (reversed) axis order
+    section = ','.join('{}:{}'.format(l,u) for l,u in zip(reversed(lbnd),reversed(ubnd)))
+    tmpdir  = tempfile.mkdtemp(prefix='section_',dir=workdir)
+    try:
+        tmpfile = os.path.join(tmpdir,'section.sdf')
+        kappa.ndfcopy('{}({})'.format(path,section),out=tmpfile)
+        data,_ = read_ndf(tmpfile)
+        var,_  = read_ndf(tmpfile,'VARIANCE')
+    finally:
+        fileops.remove_tree(tmpdir)
+    return data,var
+
+def read_wcs(path):
+    '''
+    Return the WCS of an NDF as the lines of its AST dump (the WCS.DATA component), or None if it has no WCS.
+    Lines starting with '+' continue the line before. starlink.Ast.Channel can read them back in to a FrameSet.
+
+    path: The path to the .sdf file
+    '''
+    ndfloc = _open(path)
+    lines  = None
+    if ndfloc.there('WCS') and ndfloc.find('WCS').there('DATA'):
+        lines = [i.decode() if isinstance(i,bytes) else str(i) for i in ndfloc.find('WCS').find('DATA').get()]
+        lines = [i.rstrip() for i in lines]
+    ndfloc.annul()
+    return lines
+
+def read_extension(path,*names):
+    '''
+    Read a component of an NDF's MORE extensions, e.g. read_extension(rawfile,'ACSIS','TSYS').
+    Floating point bad values are set to NaN and character arrays come back as str.
+
+    path : The path to the .sdf file
+    names: The path to the component below MORE
+
+    Returns a NumPy array, or None if there is no such component
+    '''
+    ndfloc = _open(path)
+    loc    = ndfloc
+    for name in ('MORE',)+names:
+        if not loc.there(name):
+            ndfloc.annul()
+            return None
+        loc = loc.find(name)
+    array = np.asarray(loc.get())
+    ndfloc.annul()
+
+    if array.dtype == np.float32:
+        array = np.where(array == VAL__BADR,np.nan,array)
+    elif array.dtype == np.float64:
+        array = np.where(array == VAL__BADD,np.nan,array)
+    elif array.dtype.kind == 'S':
+        array = np.char.strip(np.char.decode(array))
+    elif array.dtype.kind == 'U':
+        array = np.char.strip(array)
+    return array
+
+def write_ndf(path,array,component='DATA'):
+    '''
+    Overwrite an array component of an existing NDF. NaNs are written as Starlink bad values.
+    The array must have the same shape as the NDF. A missing VARIANCE component is created.
+
+    path     : The path to the .sdf file
+    array    : The NumPy array to write
+    component: 'DATA' (default) or 'VARIANCE'
+    '''
+    ndfloc    = _open(path,'UPDATE')
+    valloc,_  = _array_loc(ndfloc,component)
+    if valloc is None:
+        ndfloc.new(component,'_REAL',list(reversed(array.shape)))
+        valloc = ndfloc.find(component)
+
+    if valloc.type == '_DOUBLE':
+        valloc.put(np.where(np.isfinite(array),array,VAL__BADD).astype(np.float64))
+    else:
+        valloc.put(np.where(np.isfinite(array),array,VAL__BADR).astype(np.float32))
+    ndfloc.annul()
+
+def remove_component(path,component):
+    '''
+    Delete a component of an NDF (e.g. its VARIANCE) if it has one
+
+    path     : The path to the .sdf file
+    component: The component name e.g. 'VARIANCE'
+    '''
+    ndfloc = _open(path,'UPDATE')
+    if ndfloc.there(component):
+        ndfloc.erase(component)
+    ndfloc.annul()
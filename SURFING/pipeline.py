@@ -0,0 +1,144 @@
+import os
+from SURFING import products,quicklook,scratch,screening
+from SURFING.reduce import reduce_datescan,write_summary
+from SURFING.postprocess import moment0_residuals,coadd_results,convert_to_fits
+from SURFING.scheduler import TaskGraph
+
+#####
+# The SURFING pipeline as a task graph (see SURFING.scheduler).
+#
+# Per datescan:
+#     screen:<datescan>     the receptor screening of the raw data (see SURFING.screening)
+#     reduce:<datescan>:combined, reduce:<datescan>:P0, reduce:<datescan>:P1   -- the three ORACDR reductions,
+#                           which need the screening
+#     residuals:<datescan>  needs the P0 and P1 reductions
+#     convert:<datescan>    needs all three reductions and the residuals
+#     quicklook:<datescan>  needs all three reductions -- the quick-look images (see SURFING.quicklook)
+#     scratch:<datescan>    needs all three reductions -- removes the datescan's raw files from the scratch area
+#                           (only if there is one, see SURFING.scratch)
+# Per molecule:
+#     coadd:<molecule>      needs the combined reductions of every datescan. If any of them fails the co-add is held
+#                           back: the wcsmosaic engine can't tell which cubes are already in the official co-add, so
+#                           co-adding part of the batch now and the whole batch once it's fixed would count the
+#                           rest twice
+# And finally:
+#     summary               runs after the combined reductions of every datescan, whether or not they succeed, and
+#                           lists any that failed
+#     quicklook             needs every datescan's quick-look images -- the contact sheet, reduced/quicklook.html
+#
+# So residuals and FITS conversion for one datescan can run while ORACDR is still busy with another,
+# and only the co-adds wait for the whole batch.
+#####
+
+def _residuals_task(datescan,mol_subband,index):
+    '''
+    Make the P1-P0 Moment 0 residuals for one datescan.
+    The statistics table for each datescan goes in its Moment0_residuals directory.
+    '''
+    index.refresh(datescan)
+    statsfile = os.path.join(products.datescan_path(datescan),'Moment0_residuals','residual_stats.csv')
+    return moment0_residuals([datescan],mol_subband,statsfile=statsfile,index=index)
+
+def _convert_task(datescan,include,exclude,index,output_format):
+    '''
+    Convert one datescan's products to FITS (or another output format)
+    '''
+    index.refresh(datescan)
+    return convert_to_fits([datescan],include=include,exclude=exclude,index=index,output_format=output_format)
+
+def _quicklook_task(datescan,mol_subband,index,binning):
+    '''
+    Make the quick-look images for one datescan
+    '''
+    index.refresh(datescan)
+    return quicklook.quicklook_datescan(datescan,mol_subband,index=index,binning=binning)
+
+def _coadd_task(datescans,eachmol,subband,region,engine,index,nprocs,max_tile_mb,output_format):
+    '''
+    Co-add one molecule's new observations with the main file
+    '''
+    for datescan in datescans:
+        index.refresh(datescan)
+    return coadd_results(datescans,{eachmol:subband},region,engine=engine,index=index,nprocs=nprocs,max_tile_mb=max_tile_mb,
+                         output_format=output_format)
+
+def _summary_task(graph,datescans,summary_file):
+    '''
+    Write the summary file, listing the datescans whose combined reduction failed in this run as failed
+    '''
+    failed = [i for i in datescans if not graph.succeeded('reduce:{}:combined'.format(i))]
+    return write_summary(datescans,failed=failed,summary_file=summary_file)
+
+def build_pipeline(region,datescans,recipe,mol_subband,parfile='',force=False,coadd_engine='wcsmosaic',
+                   fits_include=None,fits_exclude=None,index=None,state_file='reduced/pipeline_state.json',
+                   coadd_nprocs=1,coadd_tile_mb=256,quicklook_binning=4,output_format='fits',summary_file='Summary.txt',
+                   contact_sheet=quicklook.CONTACT_SHEET):
+    '''
+    Build the task graph for reducing and post-processing a batch of datescans.
+    Run it with graph.run(nworkers=...).
+
+    region      : The region the datescans belong to e.g. SERPENS_SOUTH
+    datescans   : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    recipe      : The ORACDR recipe to run. e.g. 'REDUCE_SCIENCE_NARROWLINE'
+    mol_subband : A Key-Value paring of the Molecules associated with each subband e.g. {'C18O':1,'13CO':2,'CO':3}
+    parfile     : The configuration/parameter file to pass to ORACDR. An empty string ('') assumes the default parameters
+    force       : If True, reduce every datescan again even if the manifest says it is up to date
+    coadd_engine: 'wcsmosaic', 'incremental' or 'tiled', see SURFING.postprocess.coadd_results
+    fits_include: File name patterns of the products to convert to FITS, see SURFING.postprocess.convert_to_fits
+    fits_exclude: File name patterns of the products not to convert to FITS
+    index       : The SURFING.products.ProductIndex shared by the post-processing tasks. Default None makes a new one
+    state_file  : Where to record finished tasks, so an interrupted run can be resumed
+    coadd_nprocs: The number of worker processes each 'tiled' co-add uses
+    coadd_tile_mb: The most memory (in MB) each 'tiled' co-add worker uses for one tile
+    quicklook_binning: The spatial binning of the quick-look maps, see SURFING.quicklook. None makes no quick-looks
+    output_format: The format of the products' and co-adds' non-Starlink copies: 'fits', 'fits.fz', 'h5' or 'zarr'
+    summary_file: Where to write the summary of the combined reductions
+    contact_sheet: Where to write the quick-look contact sheet of the batch
+
+    Returns the SURFING.scheduler.TaskGraph
+    '''
+    if index is None:
+        index = products.ProductIndex()
+    graph     = TaskGraph(state_file=state_file)
+    batch     = ','.join(datescans)
+    combined  = []
+    previews  = []
+
+    for datescan in datescans:
+        graph.add('screen:{}'.format(datescan),screening.bad_receptors,args=(datescan,))
+        for eachpol in [None,'P0','P1']:
+            name = 'reduce:{}:{}'.format(datescan,'combined' if eachpol is None else eachpol)
+            graph.add(name,reduce_datescan,args=(datescan,recipe),kwargs={'parfile':parfile,'eachpol':eachpol,'force':force},
+                      deps=['screen:{}'.format(datescan)],signature=recipe)
+        combined.append('reduce:{}:combined'.format(datescan))
+
+        if scratch.enabled():
+            graph.add('scratch:{}'.format(datescan),scratch.release,args=(datescan,),
+                      deps=['reduce:{}:{}'.format(datescan,i) for i in ['combined','P0','P1']])
+
+        if quicklook_binning is not None:
+            graph.add('quicklook:{}'.format(datescan),_quicklook_task,args=(datescan,mol_subband,index,quicklook_binning),
+                      deps=['reduce:{}:{}'.format(datescan,i) for i in ['combined','P0','P1']])
+            previews.append('quicklook:{}'.format(datescan))
+
+        graph.add('residuals:{}'.format(datescan),_residuals_task,args=(datescan,mol_subband,index),
+                  deps=['reduce:{}:P0'.format(datescan),'reduce:{}:P1'.format(datescan)])
+
+        graph.add('convert:{}'.format(datescan),_convert_task,args=(datescan,fits_include,fits_exclude,index,output_format),
+                  deps=['reduce:{}:{}'.format(datescan,i) for i in ['combined','P0','P1']]+['residuals:{}'.format(datescan)],
+                  signature=output_format)
+
+    for eachmol in mol_subband:
+        graph.add('coadd:{}'.format(eachmol),_coadd_task,args=(datescans,eachmol,mol_subband[eachmol],region,coadd_engine,index,coadd_nprocs,coadd_tile_mb,output_format),
+                  deps=combined,outputs=['coadds/{}_{}_coadd.sdf'.format(region,eachmol)],
+                  signature='{}:{}'.format(region,batch),
+                  skipnote='The {} {} co-add is held back until every datescan in the batch has been reduced -- run '\
+                           'again once the failed reduction is fixed.'.format(region,eachmol))
+
+    graph.add('summary',_summary_task,args=(graph,datescans,summary_file),after=combined,outputs=[summary_file],signature=batch)
+
+    if quicklook_binning is not None:
+        graph.add('quicklook',quicklook.contact_sheet,args=(datescans,mol_subband,contact_sheet),deps=previews,
+                  outputs=[contact_sheet],signature=batch)
+
+    return graph
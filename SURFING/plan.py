@@ -0,0 +1,151 @@
+import glob
+import os
+from SURFING import cubeformats,manifest,products,screening
+from SURFING.postprocess import _fits_is_current,_wanted
+from SURFING.reduce import BAD_RECEPTORS
+
+#####
+# A dry run: what would a run of the pipeline do, and what is missing?
+#
+# For each datescan: how many raw files there are, and whether each of its three reductions (combined, P0, P1) would
+# run, and why (new, inputs changed, products missing or forced) -- the same check against reduced/manifest.json the
+# reduction itself makes. For each datescan and molecule: whether the P1-P0 residual can be made, how many products
+# would be converted, and which products a finished reduction should have made but are not on disk.
+# For each molecule: the co-add and how many new cubes would go in to it.
+#
+# Nothing is run or written, and Starlink is not loaded (see SURFING.backend), so this is quick and works anywhere.
+#####
+
+POLS = [(None,'combined'),('P0','P0'),('P1','P1')]
+
+def _reduction_status(themanifest,datescan,eachpol,recipe,parfile,force,nraw,screened):
+    '''
+    Would one reduction run, and why? Returns (status,missing products)
+    '''
+    if nraw == 0:
+        return 'no raw data',[]
+    key    = manifest.manifest_key(datescan,eachpol)
+    ignore = sorted(set(BAD_RECEPTORS.get(eachpol,[])+(screened or [])))
+    inputs = manifest.fingerprint(datescan,recipe,parfile=parfile,bad_receptors=ignore)
+    entry  = themanifest.get(key)
+    if entry is None:
+        return 'run (new)',[]
+    missing = [i for i in entry['products'] if not os.path.exists(i)]
+    if screened is None:
+        # Whether the inputs changed depends on which receptors the screening leaves out
+        return 'screen, then see',missing
+    if entry['inputs']['hash'] != inputs['hash']:
+        return 'run (inputs changed)',missing
+    if len(missing) > 0:
+        return 'run (products missing)',missing
+    if force:
+        return 'run (forced)',[]
+    return 'up to date',[]
+
+def plan(region,datescans,recipe,mol_subband,parfile='',force=False,fits_include=None,fits_exclude=None,
+         output_format='fits',index=None):
+    '''
+    Work out what the pipeline would do for a batch, without running anything
+
+    region       : The region the datescans belong to e.g. SERPENS_SOUTH
+    datescans    : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    recipe       : The ORACDR recipe to run. e.g. 'REDUCE_SCIENCE_NARROWLINE'
+    mol_subband  : A Key-Value paring of the Molecules associated with each subband e.g. {'C18O':1,'13CO':2,'CO':3}
+    parfile      : The configuration/parameter file to pass to ORACDR
+    force        : If True, every reduction would run again
+    fits_include : File name patterns of the products to convert, see SURFING.postprocess.convert_to_fits
+    fits_exclude : File name patterns of the products not to convert
+    output_format: The format products would be converted to, see SURFING.cubeformats
+    index        : The SURFING.products.ProductIndex of the reduced products. Default None builds one for these datescans
+
+    Returns a dictionary:
+        'datescans': {datescan: {'raw': number of raw files, 'screened': bad receptors found by screening (None if not
+                                 screened yet), 'reduce': {pol: status}, 'missing': [files],
+                                 'molecules': {molecule: {'residuals': status, 'convert': status, 'missing': [products]}}}}
+        'coadds'   : {molecule: {'coadd': path, 'exists': True/False, 'cubes': number of new cubes}}
+    '''
+    if index is None:
+        index = products.ProductIndex(datescans)
+    themanifest = manifest.load_manifest()
+
+    theplan = {'datescans':{},'coadds':{}}
+    for datescan in datescans:
+        nraw   = len(glob.glob(os.path.join(products.datescan_path(datescan,root='raw'),'*sdf')))
+        # Receptors are screened before reducing -- until then we can't tell whether a screened receptor would
+        # change the inputs of a reduction (see SURFING.screening)
+        screened = screening.bad_receptors(datescan,compute=False) if nraw > 0 else []
+        thisds = {'raw':nraw,'screened':screened,'reduce':{},'missing':[],'molecules':{}}
+        for eachpol,name in POLS:
+            status,missing = _reduction_status(themanifest,datescan,eachpol,recipe,parfile,force,nraw,screened)
+            thisds['reduce'][name] = status
+            thisds['missing']      = thisds['missing']+missing
+        rerun = {name:thisds['reduce'][name].startswith('run') for _,name in POLS}
+
+        for eachmol in mol_subband:
+            subband = mol_subband[eachmol]
+            have    = {}
+            missing = []
+            for _,name in POLS:
+                for kind in ['reduced','integ']:
+                    have[name,kind] = len(index.query(datescan,pol=name,subband=subband,kind=kind,group=True)) > 0
+                    # A reduction that is up to date should already have made its products
+                    if thisds['reduce'][name] == 'up to date' and not have[name,kind]:
+                        missing.append('{} {}'.format(name,kind))
+
+            # The residual needs the P0 and P1 moment 0 maps, made now or before
+            if all(rerun[i] or have[i,'integ'] for i in ['P0','P1']):
+                residuals = 'run'
+            else:
+                residuals = 'no P0/P1 moment 0 maps'
+
+            # Products of reductions that would run are only known afterwards
+            if any(rerun.values()):
+                convert = 'after reduction'
+            else:
+                sdffiles = [i for i in index.query(datescan,subband=subband,ext='sdf') if _wanted(i,fits_include,fits_exclude)]
+                todo     = [i for i in sdffiles if not _fits_is_current(i,cubeformats.output_path(i,output_format))]
+                convert  = '{} of {} files'.format(len(todo),len(sdffiles))
+            thisds['molecules'][eachmol] = {'residuals':residuals,'convert':convert,'missing':missing}
+        theplan['datescans'][datescan] = thisds
+
+    for eachmol in mol_subband:
+        officialcoadd = 'coadds/{}_{}_coadd.sdf'.format(region,eachmol)
+        cubes = 0
+        for datescan in datescans:
+            thisds = theplan['datescans'][datescan]
+            if thisds['reduce']['combined'].startswith('run') or \
+               len(index.query(datescan,pol='combined',subband=mol_subband[eachmol],kind='reduced',group=True)) > 0:
+                cubes = cubes+1
+        theplan['coadds'][eachmol] = {'coadd':officialcoadd,'exists':os.path.exists(officialcoadd),'cubes':cubes}
+
+    return theplan
+
+def format_plan(theplan):
+    '''
+    The plan as text tables, see plan
+    '''
+    lines = ['Dry run -- nothing has been run.','',
+             '{:<14s} {:>4s}  {:<24s} {:<24s} {:<24s} {}'.format('datescan','raw','combined','P0','P1','bad receptors')]
+    for datescan,thisds in theplan['datescans'].items():
+        screened = 'not screened yet' if thisds['screened'] is None else ','.join(thisds['screened']) or '-'
+        lines.append('{:<14s} {:>4d}  {:<24s} {:<24s} {:<24s} {}'.format(datescan,thisds['raw'],
+                     *[thisds['reduce'][i] for _,i in POLS]+[screened]))
+
+    lines = lines+['','{:<14s} {:<8s} {:<24s} {:<18s} {}'.format('datescan','molecule','residuals','convert','missing products')]
+    for datescan,thisds in theplan['datescans'].items():
+        for eachmol,thismol in thisds['molecules'].items():
+            lines.append('{:<14s} {:<8s} {:<24s} {:<18s} {}'.format(datescan,eachmol,thismol['residuals'],thismol['convert'],
+                                                                   ', '.join(thismol['missing']) or '-'))
+
+    lines = lines+['','{:<8s} {:<44s} {}'.format('molecule','coadd','new cubes')]
+    for eachmol,thiscoadd in theplan['coadds'].items():
+        lines.append('{:<8s} {:<44s} {}'.format(eachmol,thiscoadd['coadd']+('' if thiscoadd['exists'] else ' (new)'),thiscoadd['cubes']))
+
+    missing = [(datescan,i) for datescan,thisds in theplan['datescans'].items() for i in thisds['missing']]
+    noraw   = [datescan for datescan,thisds in theplan['datescans'].items() if thisds['raw'] == 0]
+    if len(noraw) > 0:
+        lines = lines+['','Oh no! No raw data in raw/<YYYYMMDD>/<SSSSS>/ for: {}'.format(', '.join(noraw))]
+    if len(missing) > 0:
+        lines = lines+['','Products recorded in the manifest but missing from disk:']
+        lines = lines+['    {}: {}'.format(datescan,i) for datescan,i in missing]
+    return '\n'.join(lines)
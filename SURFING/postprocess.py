@@ -1,17 +1,19 @@
-import glob
+import fnmatch
 import re
 import os
-import logging
-logging.basicConfig(level=logging.INFO)
-logging.root.setLevel(logging.INFO)
-from starlink import wrapper,kappa,convert
-wrapper.change_starpath('/star')
+import tempfile
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from SURFING import backend,coaddstore,cubeformats,fileops,instrument,products,residuals,tiledmosaic
 
-def moment0_residuals(datescans,mol_subband):
+# Record every call to Starlink (see SURFING.instrument). Starlink is only loaded when first used (see SURFING.backend)
+kappa = instrument.wrap(backend.kappa,'kappa')
+
+def moment0_residuals(datescans,mol_subband,statsfile='reduced/Moment0_residual_stats.csv',index=None):
     '''
     ORACDR has produced moment 0 maps (*integ.sdf) for each molecule and datescan.
     This code grabs those "integ.sdf" files and organises them by P0 and P1, performs subtractions.
     then organises the results for by-eye QA testing.
+    The subtractions and residual statistics for the whole batch are done together with NumPy (see SURFING.residuals).
 
     datescans  : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
     mol_subband: A Key-Value paring of the Molecules associated with each subband. For SURFING:
@@ -19,49 +21,57 @@ def moment0_residuals(datescans,mol_subband):
                  13CO Signal = Subband 2. The Image band is subband 5.
                  12CO Signal = Subband 3. The Image band is subband 6.
                  This can be confirmed in the Het Setup of the JCMTOT.
+    statsfile  : The CSV table to write the residual RMS, normalised RMS and fractional difference of each
+                 datescan and molecule to
+    index      : The SURFING.products.ProductIndex of the reduced products. Default None builds one for these datescans.
+                 The residual maps are added to it
+
+    Returns the residual statistics as a list of dictionaries, one per datescan and molecule
     '''
+    if index is None:
+        index = products.ProductIndex(datescans)
 
     #####
-    # Loop over datescans
+    # Loop over datescans and collect the matching P0 and P1 Moment 0 maps
     #####
+    pairs = []
     for datescan in datescans:
-        
-        # Collect the individual P0 and P1 Moment 0 maps
-        P0_mom0 = glob.glob('reduced/{}/{}/{}/g*integ.sdf'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5),'P0'))
-        P1_mom0 = glob.glob('reduced/{}/{}/{}/g*integ.sdf'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5),'P1'))
 
         # Make the directory to store the residuals
-        if not os.path.exists('reduced/{}/{}/Moment0_residuals/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))):
-            os.system('mkdir reduced/{}/{}/Moment0_residuals/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5)))
+        outdir = os.path.join(products.datescan_path(datescan),'Moment0_residuals/')
+        fileops.makedirs(outdir)
 
-        # Define the directory to store the residuals 
-        outsub  = 'reduced/{}/{}/Moment0_residuals/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))   
-     
-        # Perform the subtraction by molecule
         for eachmol in mol_subband:
             thissubband = mol_subband[eachmol]
 
-            # Define the name = include molecule information
-            outsub = outsub+'{}_P1_minus_P0_integ.sdf'.format(eachmol)
-    
-            # Define empty strings to ensure that we have matching P0 and P1 Moment 0 maps, or we can't perform subtraction!
-            P0_coadd_thismol = ''
-            P1_coadd_thismol = ''
-    
-            for P0file in P0_mom0:
-                if P0file.endswith('{}_integ.sdf'.format(thissubband)):
-                    P0_coadd_thismol = P0file
-        
-            for P1file in P1_mom0:
-                if P1file.endswith('{}_integ.sdf'.format(thissubband)):
-                    P1_coadd_thismol = P1file
-   
-            # If we have matching P0 and P1 moment 0 maps, perform the subtraction!
-            if P0_coadd_thismol != '':
-                if P1_coadd_thismol != '':
-                    kappa.sub(P1_coadd_thismol,P0_coadd_thismol,outsub)
-
-def coadd_results(datescans,mol_subband,region):
+            # Find the individual P0 and P1 Moment 0 maps for this molecule -- we need both to perform the subtraction!
+            P0_mom0 = index.query(datescan,pol='P0',subband=thissubband,kind='integ',group=True)
+            P1_mom0 = index.query(datescan,pol='P1',subband=thissubband,kind='integ',group=True)
+            P0_coadd_thismol = P0_mom0[-1] if len(P0_mom0)>0 else ''
+            P1_coadd_thismol = P1_mom0[-1] if len(P1_mom0)>0 else ''
+
+            # If we have matching P0 and P1 moment 0 maps, we can perform the subtraction!
+            if P0_coadd_thismol != '' and P1_coadd_thismol != '':
+                pairs.append({'datescan':datescan,'molecule':eachmol,'P0':P0_coadd_thismol,'P1':P1_coadd_thismol,
+                              'out':outdir+'{}_P1_minus_P0_integ.sdf'.format(eachmol)})
+
+    #####
+    # Perform all of the subtractions at once and save the statistics
+    #####
+    with instrument.stage('residuals',inputs=[i['P0'] for i in pairs]+[i['P1'] for i in pairs],outputs=[i['out'] for i in pairs],
+                          datescan=','.join(datescans),nmaps=len(pairs)):
+        stats = residuals.batch_residuals(pairs)
+    residuals.write_statistics(stats,statsfile)
+    for pair in pairs:
+        index.add(pair['out'],pair['datescan'])
+    for row in stats:
+        print('\t{} {}: residual RMS = {:.4g}, normalised RMS = {:.3g}, fractional difference = {:.3g}'.format(
+                row['datescan'],row['molecule'],row['residual_rms'],row['normalised_rms'],row['fractional_difference']))
+    print('The residual statistics are available here: {}'.format(statsfile))
+
+    return stats
+
+def coadd_results(datescans,mol_subband,region,engine='wcsmosaic',index=None,nprocs=1,max_tile_mb=256,output_format='fits'):
     '''
     Produce coadds including new results. If no coadd exists yet, create one. If there is a coadd from previous observations,
     add these new observations to that main file.
@@ -73,96 +83,276 @@ def coadd_results(datescans,mol_subband,region):
                  12CO Signal = Subband 3. The Image band is subband 6.
                  This can be confirmed in the Het Setup of the JCMTOT.
     region     : The region you are working on -- MUST MATCH CURRENT CO-ADD NAME FOR PROPER AVERAGING e.g. SERPENS_SOUTH
+    engine     : How to build the co-add:
+                 'wcsmosaic'   (default) mosaic the new observations with kappa.wcsmosaic, then mosaic the result with the existing co-add
+                 'incremental' add each new observation in to a running-sum coadd store (see SURFING.coaddstore), weighted by
+                               its inverse variance, and write the official co-add from the store
+                 'tiled'       mosaic the new observations and the existing co-add tile by tile on a pool of worker
+                               processes, with bounded memory per worker (see SURFING.tiledmosaic)
+    index      : The SURFING.products.ProductIndex of the reduced products. Default None builds one for these datescans
+    nprocs     : The number of worker processes for the 'tiled' engine
+    max_tile_mb: The most memory (in MB) each 'tiled' worker uses for one tile
+    output_format: The format of the co-adds' non-Starlink copies: 'fits' (default), or the compressed, chunked
+                 'fits.fz', 'h5' or 'zarr' (see SURFING.cubeformats)
     '''
+    if index is None:
+        index = products.ProductIndex(datescans)
+
     # Perform co-adds by molecule
     for eachmol in mol_subband:
 
-        # Define an empty list to populate with all the ga*reduced0*.sdf cubes for this molecule by date and scan
-        reduced_files = []
-        for datescan in datescans:
-
-            # This directory was created and populated in previous steps found in SURFING.reduce
-            reducedpath = 'reduced/{}/{}/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
-            reduced_files = reduced_files+list(glob.glob(reducedpath+'ga*_{}_reduced0*.sdf'.format(mol_subband[eachmol])))
-
-        #####
-        # We will first co-add all new observations together, then co-add the result with the existing, main co-added file.
-        #####
-
-        # Create a name for the co-add of the new observations and store it in a temporary directory
-        coadd_out = 'coadd_temp/{}_{}_temp_coadd.sdf'.format(region,eachmol)
-        if not os.path.exists('coadd_temp/'):
-            os.system('mkdir coadd_temp/')
-
-        # Check to see if we have more than one new observation to co-add together for this molecule!
-        if len(reduced_files)>1:
-            wcsmosaicin = open('mosaicin.lis','w')
-            for i in reduced_files:
-                wcsmosaicin.write('{}\n'.format(i))
-            wcsmosaicin.close()
-            kappa.wcsmosaic('^mosaicin.lis',out=coadd_out,ref=reduced_files[0],lbnd='!',ubnd='!')
-            os.system('rm -f mosaicin.lis')
-
-        # In the case that we are only reducing one observation - we don't need to co-add it with itself!
-        elif len(reduced_files)==1:
-            os.system('cp {} {}'.format(reduced_files[0],coadd_out))
-    
-        else:
-            try:
-                print(reduced_files[1])
-            except IndexError:
-                print('Oh no! There are no ga*_{}_reduced0*.sdf files to co-add! It appears that there is no new {} data in '\
-                        'the listed datescans!'.format(mol_subband[eachmol],eachmol))
-
-        # Make sure that the official co-add exists. If it doesn't - move the new co-added observations to
-        # the main "coadds" directory and that will become the official co-add.
-        if not os.path.exists('coadds'):
-            os.system('mkdir coadds')
-        if not os.path.exists('coadds/{}_{}_coadd.sdf'.format(region,eachmol)):
-            os.system('cp {} coadds/{}_{}_coadd.sdf'.format(coadd_out,region,eachmol))
-        else:
-            # Perform the coadd
-            wcsmosaicin = open('mosaicin.lis','w')
-            wcsmosaicin.write('{}\n'.format(coadd_out))
-            wcsmosaicin.write('coadds/{}_{}_coadd.sdf'.format(region,eachmol))
-            wcsmosaicin.close()
-            kappa.wcsmosaic('^mosaicin.lis',out='coadds/{}_{}_coadd_new.sdf'.format(region,eachmol),ref='coadds/{}_{}_coadd.sdf'.format(region,eachmol),lbnd='!',ubnd='!')
-            os.system('rm -f mosaicin.lis')
+        # Collect all the ga*reduced0*.sdf cubes for this molecule by date and scan
+        # (the combined P0+P1 products made in previous steps found in SURFING.reduce)
+        reduced_files = _reduced_cubes(index,datescans,mol_subband[eachmol])
 
-            # Remove the old coadd
-            os.system('rm -f coadds/{}_{}_coadd.sdf'.format(region,eachmol))
-            # Rename the new coadd to be the official version
-            os.system('mv coadds/{}_{}_coadd_new.sdf coadds/{}_{}_coadd.sdf'.format(region,eachmol,region,eachmol))
+        # Only one worker at a time may update a region's co-add of a molecule (see SURFING.jobqueue)
+        officialcoadd = 'coadds/{}_{}_coadd.sdf'.format(region,eachmol)
+        with fileops.locked(officialcoadd.replace('.sdf','.lock')):
+            with instrument.stage('coadd',inputs=reduced_files,outputs=[officialcoadd,cubeformats.output_path(officialcoadd,output_format)],
+                                  region=region,molecule=eachmol,engine=engine):
+                if engine == 'incremental':
+                    _coadd_incremental(reduced_files,region,eachmol)
+                elif engine == 'tiled':
+                    _coadd_tiled(reduced_files,region,eachmol,nprocs=nprocs,max_tile_mb=max_tile_mb)
+                else:
+                    _coadd_wcsmosaic(reduced_files,region,eachmol,mol_subband[eachmol])
 
-        # Remove temp directory
-        os.system('rm -rf coadd_temp/')
+                # Create a new FITS (or other format) copy of the coadd (if the coadd has changed)
+                if os.path.exists(officialcoadd):
+                    _convert(officialcoadd,fmt=output_format)
 
-        # Create a new FITS copy of the coadd
-        if os.path.exists('coadds/{}_{}_coadd.fits'.format(region,eachmol)):
-            os.system('rm -f coadds/{}_{}_coadd.fits'.format(region,eachmol))
-        # Convert SDF to fits
-        convert.ndf2fits('coadds/{}_{}_coadd.sdf'.format(region,eachmol),'coadds/{}_{}_coadd.fits'.format(region,eachmol))
+def _coadd_wcsmosaic(reduced_files,region,eachmol,subband):
+    '''
+    Co-add one molecule's new observations with kappa.wcsmosaic, then mosaic the result with the existing, main co-added file
 
-def convert_to_fits(datescans):
+    reduced_files: The new ga*reduced0*.sdf cubes for this molecule
+    region       : The region you are working on e.g. SERPENS_SOUTH
+    eachmol      : The molecule
+    subband      : The subband of the molecule
     '''
-    Convert all reduced sdf fils to fits
+    #####
+    # We will first co-add all new observations together, then co-add the result with the existing, main co-added file.
+    #####
 
-    datescans  : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    # Create a name for the co-add of the new observations and store it in a temporary directory.
+    # Each co-add has its own temporary directory and input list, so molecules (and other workers) can co-add at the same time.
+    fileops.makedirs('coadd_temp')
+    tempdir   = tempfile.mkdtemp(prefix='{}_{}_'.format(region,eachmol),dir='coadd_temp')+'/'
+    coadd_out = tempdir+'{}_{}_temp_coadd.sdf'.format(region,eachmol)
+    mosaiclis = tempdir+'mosaicin.lis'
+
+    # Check to see if we have more than one new observation to co-add together for this molecule!
+    if len(reduced_files)>1:
+        wcsmosaicin = open(mosaiclis,'w')
+        for i in reduced_files:
+            wcsmosaicin.write('{}\n'.format(i))
+        wcsmosaicin.close()
+        kappa.wcsmosaic('^'+mosaiclis,out=coadd_out,ref=reduced_files[0],lbnd='!',ubnd='!')
+        fileops.remove(mosaiclis)
+
+    # In the case that we are only reducing one observation - we don't need to co-add it with itself!
+    elif len(reduced_files)==1:
+        fileops.copy(reduced_files[0],coadd_out)
+
+    else:
+        try:
+            print(reduced_files[1])
+        except IndexError:
+            print('Oh no! There are no ga*_{}_reduced0*.sdf files to co-add! It appears that there is no new {} data in '\
+                    'the listed datescans!'.format(subband,eachmol))
+
+    # Make sure that the official co-add exists. If it doesn't - copy the new co-added observations to
+    # the main "coadds" directory and that will become the official co-add.
+    officialcoadd = 'coadds/{}_{}_coadd.sdf'.format(region,eachmol)
+    fileops.makedirs('coadds')
+    if not os.path.exists(officialcoadd):
+        if os.path.exists(coadd_out):
+            fileops.replace(coadd_out,officialcoadd)
+    elif os.path.exists(coadd_out):
+        # Perform the coadd in to a new file next to the official co-add
+        newcoadd = fileops.temp_path(officialcoadd,'_new')
+        wcsmosaicin = open(mosaiclis,'w')
+        wcsmosaicin.write('{}\n'.format(coadd_out))
+        wcsmosaicin.write(officialcoadd)
+        wcsmosaicin.close()
+        kappa.wcsmosaic('^'+mosaiclis,out=newcoadd,ref=officialcoadd,lbnd='!',ubnd='!')
+        fileops.remove(mosaiclis)
+
+        # Rename the new coadd over the old one in a single step, so there is always an official co-add
+        fileops.replace(newcoadd,officialcoadd)
+
+    # Remove temp directory
+    fileops.remove_tree(tempdir)
+
+def _reduced_cubes(index,datescans,subband):
     '''
+    Return the combined P0+P1 ga*_<subband>_reduced0*.sdf cubes of the datescans, in datescan order
 
-    # Loop over all new observations
+    index    : The SURFING.products.ProductIndex of the reduced products
+    datescans: A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    subband  : The subband of the molecule
+    '''
+    reduced_files = []
     for datescan in datescans:
-        # Gather combined P0 and P1 results
-        sdf_files_1 = sorted(list(glob.glob('reduced/{}/{}/*sdf'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5)))))
+        reduced_files = reduced_files+index.query(datescan,pol='combined',subband=subband,kind='reduced',group=True)
+    return reduced_files
+
+def _coadd_incremental(reduced_files,region,eachmol):
+    '''
+    Co-add one molecule's new observations using the incremental coadd store, then write the official co-add.
 
-        # Gather individual P0 and P1 results
-        sdf_files_2 = sorted(list(glob.glob('reduced/{}/{}/*/*sdf'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5)))))
+    reduced_files: The new ga*reduced0*.sdf cubes for this molecule
+    region       : The region you are working on e.g. SERPENS_SOUTH
+    eachmol      : The molecule
+    '''
+    # If there is an official co-add from before the store existed, it seeds the store
+    officialcoadd = 'coadds/{}_{}_coadd.sdf'.format(region,eachmol)
+    if not os.path.exists(coaddstore.store_path(region,eachmol)) and os.path.exists(officialcoadd):
+        coaddstore.accumulate(region,eachmol,officialcoadd,key='previous_coadd')
 
-        # Concatenate the lists into one
-        all_sdf_files = sdf_files_1+sdf_files_2
+    # Add in all of the ga*reduced0*.sdf cubes for this molecule -- cubes already in the store are skipped
+    added = 0
+    for eachfile in reduced_files:
+        if coaddstore.accumulate(region,eachmol,eachfile):
+            added = added+1
 
-        # Loop through all sdf files and perform conversion to fits
-        for i,eachsdf in enumerate(all_sdf_files):
-            print('\tFile {} of {}...'.format(i+1,len(all_sdf_files)))
-            convert.ndf2fits(eachsdf,eachsdf.replace('.sdf','.fits'))
+    if added == 0:
+        print('No new {} data to co-add for {}.'.format(eachmol,region))
+        if not os.path.exists(coaddstore.store_path(region,eachmol)) or os.path.exists(officialcoadd):
+            return
+
+    # Write the official co-add from the store
+    coaddstore.materialise(region,eachmol,officialcoadd)
+
+def _coadd_tiled(reduced_files,region,eachmol,nprocs=1,max_tile_mb=256):
+    '''
+    Co-add one molecule's new observations with the tiled engine, then mosaic the result with the existing, main
+    co-added file on its pixel grid -- the same two steps the wcsmosaic engine takes.
+
+    reduced_files: The new ga*reduced0*.sdf cubes for this molecule
+    region       : The region you are working on e.g. SERPENS_SOUTH
+    eachmol      : The molecule
+    nprocs       : The number of worker processes
+    max_tile_mb  : The most memory (in MB) each worker uses for one tile
+    '''
+    officialcoadd = 'coadds/{}_{}_coadd.sdf'.format(region,eachmol)
+    if len(reduced_files) == 0:
+        print('Oh no! There are no new {} observations to co-add in the listed datescans!'.format(eachmol))
+        return
+
+    fileops.makedirs('coadds')
+    fileops.makedirs('coadd_temp')
+    tempdir = tempfile.mkdtemp(prefix='{}_{}_tiles_'.format(region,eachmol),dir='coadd_temp')
+
+    # Without a co-add yet, the new observations' co-add becomes the official one. Either way the new co-add is
+    # written under a temporary name and renamed over the official co-add
+    if not os.path.exists(officialcoadd):
+        tiledmosaic.mosaic(reduced_files,officialcoadd,ref=reduced_files[0],nprocs=nprocs,max_tile_mb=max_tile_mb,
+                           workdir=os.path.join(tempdir,'new'))
+    else:
+        coadd_out = os.path.join(tempdir,'{}_{}_temp_coadd.sdf'.format(region,eachmol))
+        tiledmosaic.mosaic(reduced_files,coadd_out,ref=reduced_files[0],nprocs=nprocs,max_tile_mb=max_tile_mb,
+                           workdir=os.path.join(tempdir,'new'))
+        tiledmosaic.mosaic([coadd_out,officialcoadd],officialcoadd,ref=officialcoadd,nprocs=nprocs,max_tile_mb=max_tile_mb,
+                           workdir=os.path.join(tempdir,'all'))
+    fileops.remove_tree(tempdir)
+
+def _fits_is_current(sdffile,fitsfile):
+    '''
+    Check whether a FITS (or other format) copy exists and is at least as new as the SDF file it was made from
+
+    sdffile : The path to the SDF file
+    fitsfile: The path to its FITS copy
+    '''
+    return os.path.exists(fitsfile) and os.path.getmtime(fitsfile) >= os.path.getmtime(sdffile)
+
+def _convert(sdffile,force=False,fmt='fits'):
+    '''
+    Convert one SDF file to FITS (or another output format, see SURFING.cubeformats), unless its copy is already
+    up to date. The copy is written under a temporary name and renamed in to place, so an interrupted
+    conversion never leaves a partial file that looks up to date.
+
+    sdffile: The path to the SDF file. The copy is written alongside it
+    force  : If True, convert even if the copy is up to date
+    fmt    : 'fits' (default), 'fits.fz', 'h5' or 'zarr'
+
+    Returns True if the file was converted, False if it was skipped
+    '''
+    if not force and _fits_is_current(sdffile,cubeformats.output_path(sdffile,fmt)):
+        return False
+    cubeformats.write(sdffile,fmt=fmt)
+    return True
+
+def _wanted(sdffile,include=None,exclude=None):
+    '''
+    Apply the include/exclude product filters of convert_to_fits to a file name
+
+    sdffile: The path to the SDF file -- the patterns are matched against the file name only
+    include: A list of glob-style patterns; the file must match at least one of them. None includes everything
+    exclude: A list of glob-style patterns; the file must match none of them. None excludes nothing
+    '''
+    name = os.path.basename(sdffile)
+    if include is not None and not any(fnmatch.fnmatch(name,i) for i in include):
+        return False
+    if exclude is not None and any(fnmatch.fnmatch(name,i) for i in exclude):
+        return False
+    return True
+
+def convert_to_fits(datescans,nprocs=1,include=None,exclude=None,force=False,index=None,output_format='fits'):
+    '''
+    Convert all reduced sdf fils to fits.
+    Files whose FITS copy is already newer than the SDF file are skipped, so only new or changed files are converted.
+    With output_format, the copies can instead be tile-compressed FITS or chunked HDF5/Zarr, see SURFING.cubeformats.
+
+    datescans  : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    nprocs     : The number of conversions to run at once. Default 1 (one after the other)
+    include    : Only convert files whose names match one of these glob-style patterns, e.g. ['ga*reduced*','*integ*'].
+                 Default None converts every file
+    exclude    : Never convert files whose names match one of these glob-style patterns. Default None
+    force      : If True, convert files even if their FITS copy is up to date
+    index      : The SURFING.products.ProductIndex of the reduced products. Default None builds one for these datescans
+    output_format: 'fits' (default), 'fits.fz', 'h5' or 'zarr'
+
+    Returns the number of files converted. If any file could not be converted, the rest are still converted
+    and then a RuntimeError is raised
+    '''
+    if index is None:
+        index = products.ProductIndex(datescans)
+
+    # Gather the combined P0 and P1 results, and the individual P0 and P1 results, of all new observations
+    all_sdf_files = []
+    for datescan in datescans:
+        all_sdf_files = all_sdf_files+index.query(datescan,ext='sdf')
+
+    # Keep only the products we want that don't have an up-to-date FITS copy already
+    all_sdf_files = [i for i in all_sdf_files if _wanted(i,include,exclude)]
+    todo          = [i for i in all_sdf_files if force or not _fits_is_current(i,cubeformats.output_path(i,output_format))]
+    print('\t{} of {} files need converting...'.format(len(todo),len(all_sdf_files)))
+
+    # Loop through all sdf files and perform conversion to fits. A file that fails doesn't stop the rest
+    failures = []
+    with instrument.stage('convert',inputs=todo,outputs=[cubeformats.output_path(i,output_format) for i in todo],
+                          datescan=','.join(datescans),nfiles=len(todo),format=output_format):
+        if nprocs <= 1:
+            for i,eachsdf in enumerate(todo):
+                print('\tFile {} of {}...'.format(i+1,len(todo)))
+                try:
+                    _convert(eachsdf,force=True,fmt=output_format)
+                except Exception as e:
+                    failures.append((eachsdf,e))
+        else:
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                futures = {pool.submit(_convert,eachsdf,True,output_format):eachsdf for eachsdf in todo}
+                for i,future in enumerate(as_completed(futures)):
+                    try:
+                        future.result()
+                        print('\tFile {} of {}...'.format(i+1,len(todo)))
+                    except Exception as e:
+                        failures.append((futures[future],e))
 
+    for eachsdf,e in failures:
+        print('Oh no! Could not convert {} to {}: {}'.format(eachsdf,output_format,e))
+    if len(failures) > 0:
+        raise RuntimeError('{} of {} files could not be converted to {} ({} were converted)'.format(
+                            len(failures),len(todo),output_format,len(todo)-len(failures)))
+    return len(todo)
@@ -0,0 +1,215 @@
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+from SURFING import fileops
+
+#####
+# An index of the reduced data products, built once per run and shared by all of the post-processing stages.
+#
+# Every file under reduced/<YYYYMMDD>/<SSSSS>/ is classified by datescan, polarisation, subband and
+# product kind, so the stages can ask for e.g. "the P1 integ map for subband 2 of 20220307_73"
+# instead of globbing the directory tree with hand-built patterns each time.
+#
+# Polarisation is 'combined' for the P0+P1 reduction, or 'P0'/'P1' for the individual reductions.
+# Kinds are 'reduced' (ga*_reduced0*), 'integ' (moment 0 maps), 'residual' (P1-P0 moment 0 maps),
+# 'log', 'png', or the ORACDR suffix of any other product (e.g. 'rimg', 'sp').
+# ORACDR group products (names beginning with 'g', e.g. ga*) are flagged with group=True.
+#####
+
+INDEX_FILE = 'reduced/product_index.json'
+
+Product = namedtuple('Product',['path','datescan','pol','subband','molecule','kind','ext','group'])
+
+# ORACDR product names, e.g. ga20220307_73_1_reduced001.sdf or ga20220307_73_2_integ.sdf
+_ORACDR_NAME   = re.compile(r'^(?P<prefix>[a-z]+)\d{8}_\d+_(?P<subband>\d+)_(?P<suffix>[a-z]+?)(?P<num>\d*)\.(?P<ext>\w+)$',re.IGNORECASE)
+# Residual maps written by moment0_residuals, e.g. C18O_P1_minus_P0_integ.sdf
+_RESIDUAL_NAME = re.compile(r'^(?P<molecule>\w+?)_P1_minus_P0_integ\.(?P<ext>\w+)$')
+
+def datescan_path(datescan,root='reduced'):
+    '''
+    The directory of a datescan's products, e.g. '20220307_73' -> 'reduced/20220307/00073'
+
+    datescan: A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    root    : The top of the directory tree, e.g. 'reduced' or 'raw'
+    '''
+    return os.path.join(root,datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+
+def classify(path,datescan):
+    '''
+    Work out what a product file is from its path
+
+    path    : The path to the file, somewhere under the datescan's directory
+    datescan: The datescan the file belongs to
+    '''
+    name  = os.path.basename(path)
+    parts = os.path.relpath(path,datescan_path(datescan)).split(os.sep)[:-1]
+    pol   = 'combined'
+    for eachpol in ['P0','P1']:
+        if eachpol in parts:
+            pol = eachpol
+    ext   = name.rsplit('.',1)[-1] if '.' in name else ''
+
+    match = _RESIDUAL_NAME.match(name)
+    if match and 'Moment0_residuals' in parts:
+        return Product(path,datescan,pol,None,match.group('molecule'),'residual',ext,False)
+
+    if 'logfiles' in parts or name.startswith('log') or '.log' in name:
+        return Product(path,datescan,pol,None,None,'log',ext,False)
+
+    if ext == 'png':
+        return Product(path,datescan,pol,None,None,'png',ext,name.startswith('g'))
+
+    match = _ORACDR_NAME.match(name)
+    if match:
+        return Product(path,datescan,pol,int(match.group('subband')),None,match.group('suffix').lower(),ext,
+                       match.group('prefix').startswith('g'))
+
+    return Product(path,datescan,pol,None,None,'other',ext,False)
+
+class ProductIndex:
+    '''
+    The index of products for a batch of datescans. Build it with ProductIndex(datescans), or
+    ProductIndex.load() to reuse a cached index -- directories that haven't changed since the
+    cache was written are not listed again.
+
+    datescans: A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    '''
+
+    def __init__(self,datescans=()):
+        self.products  = {}
+        self.dirmtime  = {}
+        self.datescans = []
+        # The index can be shared by stages running on different threads
+        self._lock     = threading.RLock()
+        self.update(datescans)
+
+    def update(self,datescans=None):
+        '''
+        Add datescans to the index, and re-list any directory that has changed since it was last listed
+
+        datescans: Datescans to add. None just refreshes the datescans already in the index
+        '''
+        with self._lock:
+            for datescan in datescans or []:
+                if datescan not in self.datescans:
+                    self.datescans.append(datescan)
+            for datescan in self.datescans:
+                self._scan(datescan_path(datescan),datescan)
+
+    def refresh(self,datescan):
+        '''
+        Re-list any of one datescan's directories that have changed since they were last listed,
+        adding the datescan to the index if it isn't there yet
+
+        datescan: A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+        '''
+        with self._lock:
+            if datescan not in self.datescans:
+                self.datescans.append(datescan)
+            self._scan(datescan_path(datescan),datescan)
+
+    def _scan(self,directory,datescan):
+        '''
+        List one directory (and its subdirectories) in to the index, unless it is unchanged since the last listing
+
+        directory: The directory to list
+        datescan : The datescan it belongs to
+        '''
+        if not os.path.isdir(directory):
+            return
+        mtime = os.stat(directory).st_mtime
+        if self.dirmtime.get(directory) != mtime:
+            # Forget everything listed under this directory before, in case files or subdirectories have gone
+            for path in [i for i in self.products if i.startswith(directory+os.sep)]:
+                del self.products[path]
+            for subdir in [i for i in self.dirmtime if i.startswith(directory+os.sep)]:
+                del self.dirmtime[subdir]
+            self.dirmtime[directory] = mtime
+            subdirs = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # A Zarr store (see SURFING.cubeformats) is a directory, but it is one product
+                    if entry.is_dir() and not entry.name.endswith('.zarr'):
+                        subdirs.append(entry.path)
+                    else:
+                        self.products[entry.path] = classify(entry.path,datescan)
+        else:
+            subdirs = [i for i in self.dirmtime if os.path.dirname(i) == directory]
+        for subdir in subdirs:
+            self._scan(subdir,datescan)
+
+    def add(self,path,datescan):
+        '''
+        Add a file that this run has just made to the index
+
+        path    : The path to the file
+        datescan: The datescan it belongs to
+        '''
+        with self._lock:
+            self.products[path] = classify(path,datescan)
+
+    def query(self,datescan=None,pol=None,subband=None,molecule=None,kind=None,ext='sdf',group=None):
+        '''
+        Return the sorted paths of all products matching every criterion given. None matches anything.
+
+        datescan: A datescan string, or a list of them
+        pol     : 'combined', 'P0' or 'P1'
+        subband : The subband number
+        molecule: The molecule (residual maps only)
+        kind    : The product kind, e.g. 'reduced', 'integ', 'residual', 'log', 'png'
+        ext     : The file extension, default 'sdf'
+        group   : True for ORACDR group products only (ga*), False for everything else
+        '''
+        if isinstance(datescan,str):
+            datescan = [datescan]
+        paths = []
+        with self._lock:
+            allproducts = list(self.products.values())
+        for product in allproducts:
+            if datescan is not None and product.datescan not in datescan:
+                continue
+            if pol is not None and product.pol != pol:
+                continue
+            if subband is not None and product.subband != subband:
+                continue
+            if molecule is not None and product.molecule != molecule:
+                continue
+            if kind is not None and product.kind != kind:
+                continue
+            if ext is not None and product.ext != ext:
+                continue
+            if group is not None and product.group != group:
+                continue
+            paths.append(product.path)
+        return sorted(paths)
+
+    def save(self,index_file=INDEX_FILE):
+        '''
+        Cache the index on disk
+
+        index_file: The path to write the cache to
+        '''
+        with self._lock, fileops.atomic_write(index_file) as f:
+            json.dump({'datescans':self.datescans,
+                       'dirmtime' :self.dirmtime,
+                       'products' :[list(i) for i in self.products.values()]},f)
+
+    @classmethod
+    def load(cls,datescans=(),index_file=INDEX_FILE):
+        '''
+        Load a cached index (if there is one), add any new datescans and refresh any directories that have changed
+
+        datescans : Datescans the index must cover
+        index_file: The path of the cache
+        '''
+        index = cls()
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                cached = json.load(f)
+            index.datescans = cached['datescans']
+            index.dirmtime  = cached['dirmtime']
+            index.products  = {i[0]:Product(*i) for i in cached['products']}
+        index.update(datescans)
+        return index
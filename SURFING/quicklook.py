@@ -0,0 +1,278 @@
+import html
+import json
+import os
+import struct
+import zlib
+import numpy as np
+from SURFING import fileops,ndfio,products
+from SURFING.residuals import _onto_grid
+
+#####
+# Quick-look previews for checking the P0 and P1 reductions by eye, without converting everything to FITS.
+#
+# For each datescan and molecule, from the reduced cubes and moment 0 (integ) maps of the combined, P0 and P1 reductions:
+#     <pol>_mom0.png  : the moment 0 map, spatially binned
+#     residual.png    : the P1-P0 moment 0 residual, binned (grey = 0)
+#     spectra.png     : the spectrum of the brightest (binned) region for combined (white), P0 (red) and P1 (blue)
+# These go in reduced/<YYYYMMDD>/<SSSSS>/quicklook/<molecule>/ along with quicklook.json, which records the
+# modification time of every file they were made from. They are only made again when one of those files changes.
+#
+# contact_sheet() writes reduced/quicklook.html, one row per datescan and molecule, for the whole batch.
+#####
+
+CONTACT_SHEET = 'reduced/quicklook.html'
+
+# Thumbnails are enlarged (without smoothing) to at least this many pixels across
+THUMBNAIL_SIZE = 128
+
+# Spectrum plots: width (channels are binned to fit), height, and line colours for each polarisation
+SPECTRUM_SIZE   = (256,96)
+SPECTRUM_COLOUR = {'combined':(255,255,255),'P0':(255,80,80),'P1':(80,160,255)}
+
+POLS = ['combined','P0','P1']
+
+def _write_png(path,image):
+    '''
+    Write an 8-bit greyscale (ny,nx) or RGB (ny,nx,3) image as a PNG file. Row 0 is the top of the image.
+    '''
+    image  = np.ascontiguousarray(image,dtype=np.uint8)
+    ny,nx  = image.shape[:2]
+    colour = 2 if image.ndim == 3 else 0
+    # Each row starts with a filter type byte (0 = none)
+    raw    = np.concatenate([np.zeros((ny,1),np.uint8),image.reshape(ny,-1)],axis=1).tobytes()
+
+    def chunk(tag,data):
+        return struct.pack('>I',len(data))+tag+data+struct.pack('>I',zlib.crc32(tag+data) & 0xffffffff)
+
+    with fileops.atomic_write(path,'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR',struct.pack('>IIBBBBB',nx,ny,8,colour,0,0,0)))
+        f.write(chunk(b'IDAT',zlib.compress(raw,6)))
+        f.write(chunk(b'IEND',b''))
+
+def _squeeze(array,origin):
+    '''
+    Drop degenerate axes (e.g. the single channel of a moment 0 map), keeping the origin in step
+    '''
+    keep = [i for i,n in enumerate(array.shape) if n > 1]
+    return array.reshape([array.shape[i] for i in keep]),[origin[i] for i in keep]
+
+def bin_map(image,binning):
+    '''
+    Bin a 2D map by binning x binning pixels, averaging the good pixels in each block (NaN if there are none)
+
+    image  : The 2D map, NaN where bad
+    binning: The block size
+    '''
+    ny,nx  = image.shape
+    by,bx  = -(-ny//binning),-(-nx//binning)
+    padded = np.full((by*binning,bx*binning),np.nan)
+    padded[:ny,:nx] = image
+    blocks = padded.reshape(by,binning,bx,binning)
+    good   = np.isfinite(blocks)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(good,blocks,0.0).sum(axis=(1,3))/good.sum(axis=(1,3))
+
+def _scale(image,symmetric=False):
+    '''
+    Scale a map to 0-255 for display: 1-99.5 percentile, or symmetric about 0 (0 -> 128) for residuals.
+    Bad pixels are black (or grey for residuals).
+    '''
+    good = np.isfinite(image)
+    if not good.any():
+        return np.full(image.shape,128 if symmetric else 0,dtype=np.uint8)
+    if symmetric:
+        top    = np.percentile(np.abs(image[good]),99) or 1.0
+        scaled = 128+127*np.clip(image/top,-1,1)
+        scaled = np.where(good,scaled,128)
+    else:
+        low,high = np.percentile(image[good],[1,99.5])
+        scaled   = 255*np.clip((image-low)/((high-low) or 1.0),0,1)
+        scaled   = np.where(good,scaled,0)
+    return scaled.astype(np.uint8)
+
+def _thumbnail(image,symmetric=False):
+    '''
+    A display image of a map: scaled, flipped so north (pixel y increasing) is up, and enlarged to THUMBNAIL_SIZE
+    '''
+    scaled = np.flipud(_scale(image,symmetric))
+    zoom   = max(1,THUMBNAIL_SIZE//max(scaled.shape))
+    return np.repeat(np.repeat(scaled,zoom,axis=0),zoom,axis=1)
+
+def _plot_spectra(spectra):
+    '''
+    Plot spectra (a dictionary of pol -> 1D array) on one RGB image, all on the same vertical scale
+    '''
+    width,height = SPECTRUM_SIZE
+    image  = np.zeros((height,width,3),dtype=np.uint8)
+    finite = [s[np.isfinite(s)] for s in spectra.values() if np.isfinite(s).any()]
+    if len(finite) == 0:
+        return image
+    low,high = min(i.min() for i in finite),max(i.max() for i in finite)
+
+    rows = np.arange(height)[:,None]
+    for pol,spectrum in spectra.items():
+        # Bin the channels to the plot width
+        nbin     = max(1,-(-len(spectrum)//width))
+        spectrum = bin_map(spectrum[None,:],nbin)[0] if nbin > 1 else spectrum
+        y        = (height-1)*(1-(spectrum-low)/((high-low) or 1.0))
+        y        = np.where(np.isfinite(y),y,np.nan)
+        # Draw a vertical segment from each channel's point to the next, so the line is continuous
+        ynext    = np.append(y[1:],y[-1])
+        lo       = np.fmin(y,ynext)
+        hi       = np.fmax(y,ynext)
+        mask     = (rows >= np.floor(lo)[None,:]) & (rows <= np.ceil(hi)[None,:])
+        image[:,:len(spectrum)][mask] = SPECTRUM_COLOUR[pol]
+    return image
+
+def _sources(index,datescan,subband):
+    '''
+    The files the quick-look for one datescan and subband is made from: {pol: (cube,integ)}, '' where missing
+    '''
+    sources = {}
+    for pol in POLS:
+        cubes = index.query(datescan,pol=pol,subband=subband,kind='reduced',group=True)
+        integ = index.query(datescan,pol=pol,subband=subband,kind='integ',group=True)
+        sources[pol] = (cubes[-1] if len(cubes) > 0 else '',integ[-1] if len(integ) > 0 else '')
+    return sources
+
+def _mtimes(sources):
+    return {path:os.path.getmtime(path) for pair in sources.values() for path in pair if path != ''}
+
+def quicklook_datescan(datescan,mol_subband,index=None,binning=4,force=False):
+    '''
+    Make the quick-look images for one datescan, for every molecule, unless they are up to date
+
+    datescan   : A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    mol_subband: A Key-Value paring of the Molecules associated with each subband e.g. {'C18O':1,'13CO':2,'CO':3}
+    index      : The SURFING.products.ProductIndex of the reduced products. Default None builds one for this datescan
+    binning    : The spatial binning of the maps
+    force      : If True, make them again even if they are up to date
+
+    Returns the number of molecules whose quick-looks were (re)made
+    '''
+    if index is None:
+        index = products.ProductIndex([datescan])
+
+    made = 0
+    for eachmol in mol_subband:
+        outdir   = os.path.join(products.datescan_path(datescan),'quicklook',eachmol)
+        cache    = os.path.join(outdir,'quicklook.json')
+        sources  = _sources(index,datescan,mol_subband[eachmol])
+        mtimes   = _mtimes(sources)
+        if len(mtimes) == 0:
+            continue
+        if not force and os.path.exists(cache):
+            with open(cache) as f:
+                cached = json.load(f)
+            if cached['sources'] == mtimes and cached['binning'] == binning:
+                continue
+
+        fileops.makedirs(outdir)
+        record  = {'datescan':datescan,'molecule':eachmol,'binning':binning,'sources':mtimes,'images':{},'stats':{}}
+        mom0    = {}
+        spectra = {}
+        for pol in POLS:
+            cubefile,integfile = sources[pol]
+            cube,cubeorigin    = ndfio.read_ndf(cubefile) if cubefile != '' else (None,None)
+
+            # The moment 0 map -- from the integ map if there is one, otherwise by collapsing the cube
+            if integfile != '':
+                mom0[pol] = _squeeze(*ndfio.read_ndf(integfile))
+            elif cube is not None:
+                mom0[pol] = (np.nansum(cube,axis=0),list(cubeorigin[1:]))
+            if pol in mom0:
+                name = '{}_mom0.png'.format(pol)
+                _write_png(os.path.join(outdir,name),_thumbnail(bin_map(mom0[pol][0],binning)))
+                record['images'][pol] = name
+
+            # The mean spectrum of the brightest binned region of the cube
+            if cube is not None:
+                collapsed = bin_map(np.where(np.isfinite(cube),cube,0.0).sum(axis=0),binning)
+                if np.isfinite(collapsed).any():
+                    by,bx = np.unravel_index(np.nanargmax(collapsed),collapsed.shape)
+                    block = cube[:,by*binning:(by+1)*binning,bx*binning:(bx+1)*binning]
+                    good  = np.isfinite(block)
+                    with np.errstate(divide='ignore',invalid='ignore'):
+                        spectra[pol] = np.where(good,block,0.0).sum(axis=(1,2))/good.sum(axis=(1,2))
+                    record['stats']['{}_peak'.format(pol)] = float(np.nanmax(spectra[pol]))
+
+        if len(spectra) > 0:
+            _write_png(os.path.join(outdir,'spectra.png'),_plot_spectra(spectra))
+            record['images']['spectra'] = 'spectra.png'
+
+        # The P1-P0 residual on P1's pixel grid
+        if 'P0' in mom0 and 'P1' in mom0 and mom0['P0'][0].ndim == 2 and mom0['P1'][0].ndim == 2:
+            P1map,P1origin = mom0['P1']
+            residual = P1map-_onto_grid(mom0['P0'][0],mom0['P0'][1],P1map.shape,P1origin)
+            _write_png(os.path.join(outdir,'residual.png'),_thumbnail(bin_map(residual,binning),symmetric=True))
+            record['images']['residual'] = 'residual.png'
+            if np.isfinite(residual).any():
+                record['stats']['residual_rms'] = float(np.sqrt(np.nanmean(residual**2)))
+
+        with fileops.atomic_write(cache) as f:
+            json.dump(record,f,indent=1)
+        made = made+1
+
+    return made
+
+def contact_sheet(datescans,mol_subband,out=CONTACT_SHEET):
+    '''
+    Write an HTML contact sheet of the quick-look images of a batch: one row per datescan and molecule
+
+    datescans  : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    mol_subband: A Key-Value paring of the Molecules associated with each subband
+    out        : The HTML file to write
+    '''
+    columns = POLS+['residual','spectra']
+    rows    = []
+    for datescan in datescans:
+        for eachmol in mol_subband:
+            outdir = os.path.join(products.datescan_path(datescan),'quicklook',eachmol)
+            if not os.path.exists(os.path.join(outdir,'quicklook.json')):
+                continue
+            with open(os.path.join(outdir,'quicklook.json')) as f:
+                record = json.load(f)
+            cells = []
+            for column in columns:
+                if column in record['images']:
+                    src = os.path.relpath(os.path.join(outdir,record['images'][column]),os.path.dirname(out) or '.')
+                    cells.append('<td><a href="{0}"><img src="{0}"></a></td>'.format(html.escape(src)))
+                else:
+                    cells.append('<td>-</td>')
+            stats = ', '.join('{}={:.3g}'.format(k,v) for k,v in sorted(record['stats'].items()))
+            rows.append('<tr><th>{}<br>{}</th>{}<td>{}</td></tr>'.format(html.escape(datescan),html.escape(eachmol),
+                                                                       ''.join(cells),html.escape(stats)))
+
+    page = ['<html><head><title>SURFING quick-look</title>',
+            '<style>body{background:#222;color:#ddd;font-family:sans-serif} td,th{padding:4px;text-align:center} '
+            'img{image-rendering:pixelated}</style></head><body>',
+            '<h1>SURFING quick-look</h1>',
+            '<p>Moment 0 maps, the P1-P0 moment 0 residual (grey = 0) and the spectrum of the brightest region: '
+            'combined (white), P0 (red), P1 (blue).</p>',
+            '<table><tr><th>datescan</th>{}<th>stats</th></tr>'.format(''.join('<th>{}</th>'.format(i) for i in columns))]
+    page = page+rows+['</table></body></html>']
+    with fileops.atomic_write(out) as f:
+        f.write('\n'.join(page)+'\n')
+
+def quicklook(datescans,mol_subband,index=None,binning=4,force=False,out=CONTACT_SHEET):
+    '''
+    Make the quick-look images for a batch of datescans (only where they are out of date) and the contact sheet
+
+    datescans  : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    mol_subband: A Key-Value paring of the Molecules associated with each subband e.g. {'C18O':1,'13CO':2,'CO':3}
+    index      : The SURFING.products.ProductIndex of the reduced products. Default None builds one for these datescans
+    binning    : The spatial binning of the maps
+    force      : If True, make them all again
+    out        : The contact sheet to write
+
+    Returns the number of (datescan, molecule) quick-looks that were (re)made
+    '''
+    if index is None:
+        index = products.ProductIndex(datescans)
+    made = 0
+    for datescan in datescans:
+        made = made+quicklook_datescan(datescan,mol_subband,index=index,binning=binning,force=force)
+    contact_sheet(datescans,mol_subband,out=out)
+    print('The quick-look contact sheet is available here: {}'.format(out))
+    return made
@@ -1,11 +1,31 @@
-import glob
 import re
 import os
-import logging
-logging.basicConfig(level=logging.INFO)
-logging.root.setLevel(logging.INFO)
-from starlink import wrapper,kappa,convert
-wrapper.change_starpath('/star')
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from SURFING import backend,fileops,instrument,manifest,scratch,screening
+
+# Record every call to Starlink (see SURFING.instrument). Starlink is only loaded when first used (see SURFING.backend)
+wrapper = instrument.wrap(backend.wrapper,'wrapper')
+kappa   = instrument.wrap(backend.kappa,'kappa')
+convert = instrument.wrap(backend.convert,'convert')
+
+#####
+# Define "bad" receptors that will be ignored when reducing the polarisations individually.
+# Format: N = Namakanui, U|W|A =Uu|Aweoweo|Alaihi, 0|1 = Polarisation, U|L = Upper or Lower sideband
+#####
+BAD_RECEPTORS = {'P0':['NU1L','NU1U','NW1L','NW1U','NA1L','NA1U'],
+                 'P1':['NU0L','NU0U','NW0L','NW0U','NA0L','NA0U']}
+
+def receptors_to_ignore(datescan,eachpol=None,compute=True):
+    '''
+    The receptors ORACDR is told to ignore in one reduction: the other polarisation's (for the individual P0 and P1
+    reductions), plus any whose raw data failed screening (see SURFING.screening)
+
+    datescan: A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    eachpol : None for the combined reduction, or 'P0'/'P1'
+    compute : If False, only use screening results that are already cached
+    '''
+    screened = screening.bad_receptors(datescan,compute=compute) or []
+    return sorted(set(BAD_RECEPTORS.get(eachpol,[])+screened))
 
 def DR_setup(datescans):
     '''
@@ -24,16 +44,196 @@ def DR_setup(datescans):
                     'you intend to reduce.'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5)))
 
         # Make Output Directories
-        if not os.path.exists('reduced'):
-            os.system('mkdir reduced')
-        if not os.path.exists('reduced/{}'.format(datescan.split('_')[0])):
-            os.system('mkdir reduced/{}'.format(datescan.split('_')[0]))
-        if not os.path.exists('reduced/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))):
-            os.system('mkdir reduced/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5)))
+        fileops.makedirs('reduced/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5)))
+
+
+
+def _run_oracdr(datescan,recipe,parfile='',eachpol=None,bad_receptors=None):
+    '''
+    Run ORACDR on a single datescan and tidy the results into the reduced directory tree.
+    This is one "job" of the reduction -- it is self contained so it can be run in a worker process.
+
+    datescan : A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    recipe   : The ORACDR recipe to run. e.g. 'REDUCE_SCIENCE_NARROWLINE'
+    parfile  : The configuration/parameter file to pass to ORACDR. An empty string ('') assumes the default parameters
+    eachpol  : None to reduce P0 and P1 together, or 'P0'/'P1' to reduce only that polarisation
+    bad_receptors: The receptors to ignore. Default None works them out with receptors_to_ignore
+
+    Returns the paths to the log, image and data files, as a SURFING.manifest.RecordedOutput
+    '''
+    # Define the out path -- the existence of this path (and of the raw data) is checked by DR_setup
+    outpath    = 'reduced/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+    if eachpol is not None:
+        outpath = os.path.join(outpath,eachpol)
+
+    print('\nNow running ORACDR for: {}{}...'.format(datescan,'' if eachpol is None else ' ({})'.format(eachpol)))
+
+    # Collect raw files into list -- the local copies if there is a scratch area (see SURFING.scratch).
+    # Each job has its own working directory, so the temporary ORACworking* directory the wrapper creates
+    # inside it is never shared with another job.
+    with scratch.raw_files(datescan) as raw_files, scratch.workdir(outpath) as dataout:
+
+        # Build the ORACDR arguments
+        kwargs = dict(loop='file',dataout=dataout,recipe=recipe,rawfiles=raw_files,verbose=True,debug=True)
+        if parfile != '':
+            kwargs['recpars'] = parfile
+        # Use the "bad_receptors" option to ignore the other polarisation, and any receptors that failed screening
+        if bad_receptors is None:
+            bad_receptors = receptors_to_ignore(datescan,eachpol)
+        if len(bad_receptors) > 0:
+            kwargs['calib'] = 'bad_receptors={}'.format(':'.join(bad_receptors))
+
+        with instrument.stage('reduce',inputs=raw_files,datescan=datescan,pol='combined' if eachpol is None else eachpol) as record:
+            output = wrapper.oracdr('ACSIS',**kwargs)
+
+            # Clean up the output. The python wrapper creates a temporary directory beginning with ORACworking* (given by output.outdir)
+            # to store the files -- we want to move the files to our directory tree (logs in logfiles/, images in imagefiles/)
+            # and remove the temporary directory.
+            with instrument.stage('publish'):
+                output = scratch.publish(output,outpath)
+
+            # Record where the products ended up
+            record['products']  = list(output.datafiles)
+            record['bytes_out'] = sum(os.path.getsize(i) for i in record['products'] if os.path.exists(i))
+
+    return output
+
+
+def _run_jobs(jobs,recipe,parfile='',nprocs=1,force=False,release=False):
+    '''
+    Run a list of ORACDR jobs, either one after the other or on a pool of worker processes.
+    A failure in one job is reported but does not stop the rest of the batch.
+    Jobs whose inputs (raw files, recipe, parfile, bad receptors) match the manifest from a previous run,
+    and whose products are still on disk, are skipped. Stale products of jobs that must be redone are removed first.
+
+    jobs     : A list of (datescan,eachpol) tuples -- eachpol is None for the combined P0+P1 reduction
+    recipe   : The ORACDR recipe to run. e.g. 'REDUCE_SCIENCE_NARROWLINE'
+    parfile  : The configuration/parameter file to pass to ORACDR. An empty string ('') assumes the default parameters
+    nprocs   : The number of ORACDR jobs to run at once. 1 runs everything serially in this process
+    force    : If True, ignore the manifest and reduce every job again
+    release  : If True, remove each datescan's raw files from the scratch area once all of its jobs are done
+
+    Returns (outputs,failures): outputs is a list of ORACDR output objects in the same order as jobs
+    (None where the job failed), failures is a list of (datescan,eachpol,error) tuples
+    '''
+    outputs  = [None]*len(jobs)
+    failures = []
+
+    #####
+    # Check the manifest to see which jobs actually need to be run
+    #####
+    keys        = [manifest.manifest_key(datescan,eachpol) for datescan,eachpol in jobs]
+    ignore      = [receptors_to_ignore(datescan,eachpol) for datescan,eachpol in jobs]
+    inputs      = [manifest.fingerprint(datescan,recipe,parfile=parfile,bad_receptors=ignore[i])
+                   for i,(datescan,eachpol) in enumerate(jobs)]
+    todo        = []
+    with manifest.locked_manifest() as themanifest:
+        for i in range(len(jobs)):
+            if not force and manifest.is_up_to_date(themanifest,keys[i],inputs[i]):
+                print('{} is already reduced from the same inputs -- skipping.'.format(keys[i]))
+                outputs[i] = manifest.recorded_output(themanifest,keys[i])
+            else:
+                manifest.remove_products(themanifest,keys[i])
+                todo.append(i)
+
+    # Record each finished job straight away, so a crash part way through a batch doesn't lose the others.
+    # Once the last job of a datescan is done, its staged raw files are no longer needed.
+    remaining = {}
+    for i in todo:
+        remaining[jobs[i][0]] = remaining.get(jobs[i][0],0)+1
+    def done(i):
+        remaining[jobs[i][0]] -= 1
+        if release and remaining[jobs[i][0]] == 0:
+            scratch.release(jobs[i][0])
+    def finished(i,output):
+        outputs[i] = output
+        with manifest.locked_manifest() as themanifest:
+            manifest.record(themanifest,keys[i],inputs[i],output)
+
+    # Copy the raw files in to the scratch area ahead of the jobs that need them
+    prefetcher = scratch.prefetch(list(dict.fromkeys(jobs[i][0] for i in todo)))
+
+    if nprocs <= 1:
+        for i in todo:
+            datescan,eachpol = jobs[i]
+            try:
+                finished(i,_run_oracdr(datescan,recipe,parfile=parfile,eachpol=eachpol,bad_receptors=ignore[i]))
+            except Exception as e:
+                failures.append((datescan,eachpol,e))
+            done(i)
+    else:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            futures = {pool.submit(_run_oracdr,jobs[i][0],recipe,parfile,jobs[i][1],ignore[i]):i for i in todo}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    finished(i,future.result())
+                except Exception as e:
+                    failures.append((jobs[i][0],jobs[i][1],e))
+                done(i)
+    prefetcher.join()
+
+    for datescan,eachpol,e in failures:
+        print('Oh no! ORACDR failed for {} ({}): {}'.format(datescan,'P0+P1' if eachpol is None else eachpol,e))
+
+    return outputs,failures
+
+
+def _write_summary(datescans,outputs,summary_file='Summary.txt'):
+    '''
+    Create a summary file that gives an overview of the locations of the combined P0+P1 data products.
+    Datescans whose reduction failed (output is None) are listed as such.
+
+    datescans   : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    outputs     : The ORACDR output objects, in the same order as datescans
+    summary_file: The file to write
+    '''
+    # The file is written under a temporary name and renamed in to place when it is complete
+    with fileops.atomic_write(summary_file) as summaryfile:
+        print('\n#####\n#####\nSummary:\n')
+        for datescan,output in zip(datescans,outputs):
+            if output is None:
+                summaryfile.write('~~~{}~~~\n#######\n\nThe reduction FAILED for {}\n'.format(datescan,datescan))
+                print('~~~{}~~~\n#######\n\nThe reduction FAILED for {}\n'.format(datescan,datescan))
+                continue
+
+            #Save the Summary to a file
+            summaryfile.write('~~~{}~~~\n#######\n'.format(datescan))
+            summaryfile.write('\nThe run log for {} can be found here {}'.format(datescan,re.sub('ORACworking\w+/','logfiles',output.runlog)))
+            summaryfile.write('\n\nThe datafiles are listed below:\n')
+            summaryfile.write(re.sub('ORACworking\w+/','','\n'.join(output.datafiles)))
+            summaryfile.write('\n\nThe image files are listed below:\n')
+            summaryfile.write(re.sub('ORACworking\w+/','','\n'.join(output.imagefiles)))
+            summaryfile.write('\n\nThe additional logs are listed below:\n')
+            summaryfile.write(re.sub('ORACworking\w+/','','\n'.join(output.logfiles)))
+            summaryfile.write('\n')
+
+            #Print the summary to the screen
+            print('~~~{}~~~\n#######\n'.format(datescan))
+            print('The run log for {} can be found here {}'.format(datescan,output.runlog))
+            print('\nThe datafiles are listed below:')
+            print(re.sub('ORACworking\w+/','','\n'.join(output.datafiles)))
+            print('\nThe image files are listed below:')
+            print(re.sub('ORACworking\w+/','','\n'.join(output.imagefiles)))
+            print('\nThe additional logs are listed below:')
+            print(re.sub('ORACworking\w+/','','\n'.join(output.logfiles)))
+            print('')
+
+    print('\nThis summary is available here: {}\n'.format(summary_file))
+
+
+def _setup_pol_dirs(datescans):
+    '''
+    Add the P0 and P1 directories to the reduced product tree made by DR_setup
 
+    datescans: A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    '''
+    for eachpol in ['P0','P1']:
+        for datescan in datescans:
+            fileops.makedirs('reduced/{}/{}/{}/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5),eachpol))
 
 
-def reduce_combined_p0_p1(datescans,recipe,parfile=''):
+def reduce_combined_p0_p1(datescans,recipe,parfile='',nprocs=1,force=False):
     '''
     Reduce the P0 and P1 data together using Starlink's pywrapper.
     Clean up the results into organised directories.
@@ -45,6 +245,10 @@ def reduce_combined_p0_p1(datescans,recipe,parfile=''):
     parfile  : The configuration/parameter file to pass to ORACDR. This file must reflect the recipe chosen.
                See: https://www.eaobservatory.org/jcmt/science/reductionanalysis-tutorials/heterodyne-instrument-data-reduction-tutorial-2/
                An empty string ('') assumes the default parameters for the chosen recipe
+    nprocs   : The number of datescans to reduce at once. Default 1 (one after the other)
+    force    : If True, reduce every datescan again even if the manifest says it is up to date
+
+    Returns a list of (datescan,eachpol,error) tuples for any reductions that failed
     '''
 
     #####
@@ -56,73 +260,20 @@ def reduce_combined_p0_p1(datescans,recipe,parfile=''):
     #####
     # Run the data reduction and save the output information
     #####
-    outputs = []
+    outputs,failures = _run_jobs([(datescan,None) for datescan in datescans],recipe,parfile=parfile,nprocs=nprocs,force=force)
 
-    # Loop over each input observation
-    for datescan in datescans:
-    
-        # Define raw and out paths -- the existence of these paths are checked by DR_setup, above
-        rawpath    = 'raw/{}/{}/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
-        outpath    = 'reduced/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
-    
-        # Collect raw files into list 
-        raw_files = sorted(list(glob.glob(os.path.join(rawpath,'*sdf'))))
-    
-        # Run ORACDR
-        print('\nNow running ORACDR for: {}...'.format(datescan))
-        if parfile != '':
-            output = wrapper.oracdr('ACSIS',loop='file',dataout=outpath,recipe=recipe,rawfiles=raw_files,recpars=parfile,verbose=True,debug=True)
-        else:
-            output = wrapper.oracdr('ACSIS',loop='file',dataout=outpath,recipe=recipe,rawfiles=raw_files,verbose=True,debug=True)
+    #####
+    # Next, we will create a summary file that gives an overview of the locations of the data products
+    #####
+    _write_summary(datescans,outputs)
 
-        # Save the output (paths to log, image, data files and other information)
-        outputs.append(output)
+    return failures
 
-        # Clean up the output. The python wrapper creates a temporary directory beginning with ORACworking* (given by output.outdir)
-        # to store the files -- we want to move the files to our directory tree and remove the temporary directory.
-        os.system('mv {}/* {}/'.format(output.outdir,outpath))
-        os.system('rm -rf {}'.format(output.outdir))
-        os.system('mkdir {}/logfiles; mv {}/*log* {}/logfiles'.format(outpath,outpath,outpath))
-        os.system('mkdir {}/imagefiles; mv {}/*png {}/imagefiles'.format(outpath,outpath,outpath))
 
-    #####
-    # Next, we will create a summary file that gives an overview of the locations of the data products 
-    #####
-    summaryfile = open('Summary.txt','w')
-    print('\n#####\n#####\nSummary:\n')
-    for datescan,output in zip(datescans,outputs):
-        #Save the Summary to a file
-        summaryfile.write('~~~{}~~~\n#######\n'.format(datescan))
-        summaryfile.write('\nThe run log for {} can be found here {}'.format(datescan,re.sub('ORACworking\w+/','logfiles',output.runlog)))
-        summaryfile.write('\n\nThe datafiles are listed below:\n')
-        summaryfile.write(re.sub('ORACworking\w+/','','\n'.join(output.datafiles)))
-        summaryfile.write('\n\nThe image files are listed below:\n')
-        summaryfile.write(re.sub('ORACworking\w+/','','\n'.join(output.imagefiles)))
-        summaryfile.write('\n\nThe additional logs are listed below:\n')
-        summaryfile.write(re.sub('ORACworking\w+/','','\n'.join(output.logfiles)))
-        summaryfile.write('\n')
-    
-        #Print the summary to the screen
-        print('~~~{}~~~\n#######\n'.format(datescan))
-        print('The run log for {} can be found here {}'.format(datescan,output.runlog))
-        print('\nThe datafiles are listed below:')
-        print(re.sub('ORACworking\w+/','','\n'.join(output.datafiles)))
-        print('\nThe image files are listed below:')
-        print(re.sub('ORACworking\w+/','','\n'.join(output.imagefiles)))
-        print('\nThe additional logs are listed below:')
-        print(re.sub('ORACworking\w+/','','\n'.join(output.logfiles)))
-        print('')
-    
-    # Close the file    
-    summaryfile.close()
-    print('\nThis summary is available here: Summary.txt\n')
-
-
-def reduce_individual_p0_p1(datescans,recipe,parfile=''): 
+def reduce_individual_p0_p1(datescans,recipe,parfile='',nprocs=1,force=False):
     '''
     Reduce the P0 and P1 data individually using Starlink's pywrapper.
     Clean up the results into organised directories.
-    Save the path information for the log, image, and data files to a summary text document.
     This will be used mainly for QA testing.
 
     datescans: A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
@@ -130,54 +281,97 @@ def reduce_individual_p0_p1(datescans,recipe,parfile=''):
     parfile  : The configuration/parameter file to pass to ORACDR. This file must reflect the recipe chosen.
                See: https://www.eaobservatory.org/jcmt/science/reductionanalysis-tutorials/heterodyne-instrument-data-reduction-tutorial-2/
                An empty string ('') assumes the default parameters for the chosen recipe
+    nprocs   : The number of reductions to run at once. Default 1 (one after the other)
+    force    : If True, reduce every datescan again even if the manifest says it is up to date
+
+    Returns a list of (datescan,eachpol,error) tuples for any reductions that failed
     '''
 
     #####
     # Ensure the raw data exists and then construct the appropriate reduced product directories
-    # for all datescans
+    # for all datescans, then add directories P0 and P1
     DR_setup(datescans)
+    _setup_pol_dirs(datescans)
     #####
 
-    for eachpol in ['P0','P1']:
-    
-        print('\n\t{}...'.format(eachpol))
-
-        #####
-        # Define "bad" receptors that will be ignored. 
-        # Format: N = Namakanui, U|W|A =Uu|Aweoweo|Alaihi, 0|1 = Polarisation, U|L = Upper or Lower sideband  
-        #####
-        if eachpol == 'P0':
-            BRlist = ['NU1L','NU1U','NW1L','NW1U','NA1L','NA1U']
-        elif eachpol == 'P1':
-            BRlist = ['NU0L','NU0U','NW0L','NW0U','NA0L','NA0U']
-        
-        #####
-        # Loop over each datescan and apply the lists of receptors to ignore such that we have individual P0 and P1 observations
-        #####
-        for datescan in datescans:
+    #####
+    # Loop over each polarisation and datescan and apply the lists of receptors to ignore such that
+    # we have individual P0 and P1 observations
+    #####
+    jobs = [(datescan,eachpol) for eachpol in ['P0','P1'] for datescan in datescans]
+    outputs,failures = _run_jobs(jobs,recipe,parfile=parfile,nprocs=nprocs,force=force)
 
-            # Define raw and out paths --  the existence of these initial paths are checked by DR_setup, above, the we add directories P0 and P1
-            rawpath    = 'raw/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
-            if not os.path.exists('reduced/{}/{}/{}/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5),eachpol)):
-                os.system('mkdir reduced/{}/{}/{}/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5),eachpol))
-            outpath    = 'reduced/{}/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5),eachpol)
-        
-            # Collect raw files into list 
-            raw_files = glob.glob(os.path.join(rawpath,'*sdf'))
-        
-            # Run ORACDR with the "bad_receptors" option to ignore one of the detectors
-            print('\nNow running ORACDR for: {}...'.format(datescan))
-            if parfile != '':
-                output = wrapper.oracdr('ACSIS',loop='file',dataout=outpath,recipe=recipe,rawfiles=raw_files,recpars=parfile,calib='bad_receptors={}'.format(':'.join(BRlist)),verbose=True,debug=True)
-            else:
-                output = wrapper.oracdr('ACSIS',loop='file',dataout=outpath,recipe=recipe,rawfiles=raw_files,calib='bad_receptors={}'.format(':'.join(BRlist)),verbose=True,debug=True)
+    return failures
 
-            #####
-            # Clean up the output. The python wrapper creates a temporary directory beginning with ORACworking* (given by output.outdir)
-            # to store the files -- we want to move the files to our directory tree and remove the temporary directory.
-            #####
-            os.system('mv {}/* {}'.format(output.outdir,outpath))
-            os.system('rm -rf {}'.format(output.outdir))
-            os.system('mkdir {}/logfiles; mv {}/*log* {}/logfiles'.format(outpath,outpath,outpath))
-            os.system('mkdir {}/imagefiles; mv {}/*png {}/imagefiles'.format(outpath,outpath,outpath))
 
+def reduce_all(datescans,recipe,parfile='',nprocs=1,force=False):
+    '''
+    Run the combined P0+P1 reduction and the individual P0 and P1 reductions for every datescan as one batch.
+    With nprocs > 1, every (datescan x {P0+P1, P0, P1}) job is shared out over a single pool of worker processes,
+    so the three passes for all datescans keep the cores busy rather than running one after the other.
+
+    datescans: A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    recipe   : The ORACDR recipe to run. e.g. 'REDUCE_SCIENCE_NARROWLINE'
+    parfile  : The configuration/parameter file to pass to ORACDR. This file must reflect the recipe chosen.
+               An empty string ('') assumes the default parameters for the chosen recipe
+    nprocs   : The number of ORACDR jobs to run at once. Default 1 (one after the other)
+    force    : If True, reduce every datescan again even if the manifest says it is up to date
+
+    Returns a list of (datescan,eachpol,error) tuples for any reductions that failed
+    '''
+    DR_setup(datescans)
+    _setup_pol_dirs(datescans)
+
+    # Combined reductions first, so with nprocs=1 the order matches running the two reduce functions in turn
+    jobs = [(datescan,None) for datescan in datescans]
+    jobs = jobs+[(datescan,eachpol) for eachpol in ['P0','P1'] for datescan in datescans]
+    outputs,failures = _run_jobs(jobs,recipe,parfile=parfile,nprocs=nprocs,force=force,release=True)
+
+    # Only the combined reductions go in to the summary file
+    _write_summary(datescans,outputs[:len(datescans)])
+
+    return failures
+
+
+def reduce_datescan(datescan,recipe,parfile='',eachpol=None,force=False):
+    '''
+    Run one reduction of one datescan -- the combined P0+P1 reduction, or one of the individual polarisations.
+    This is the unit of work the SURFING.pipeline task graph schedules. Like the batch functions above,
+    it is skipped if the manifest says it is already up to date.
+
+    datescan : A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    recipe   : The ORACDR recipe to run. e.g. 'REDUCE_SCIENCE_NARROWLINE'
+    parfile  : The configuration/parameter file to pass to ORACDR. An empty string ('') assumes the default parameters
+    eachpol  : None for the combined reduction, or 'P0'/'P1'
+    force    : If True, reduce the datescan again even if the manifest says it is up to date
+
+    Returns the ORACDR output object. Raises a RuntimeError if the reduction failed
+    '''
+    DR_setup([datescan])
+    if eachpol is not None:
+        _setup_pol_dirs([datescan])
+
+    outputs,failures = _run_jobs([(datescan,eachpol)],recipe,parfile=parfile,force=force)
+    if len(failures)>0:
+        raise RuntimeError('ORACDR failed for {}: {}'.format(manifest.manifest_key(datescan,eachpol),failures[0][2]))
+    return outputs[0]
+
+
+def write_summary(datescans,failed=(),summary_file='Summary.txt'):
+    '''
+    Write Summary.txt for the combined P0+P1 reductions of these datescans from the records in the manifest.
+    Datescans with no record (e.g. because their reduction failed) are listed as failed.
+
+    datescans   : A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+    failed      : Datescans whose combined reduction failed this time -- listed as failed even if an earlier
+                  reduction of them is in the manifest
+    summary_file: The file to write. Default Summary.txt
+    '''
+    themanifest = manifest.load_manifest()
+    outputs     = []
+    for datescan in datescans:
+        if datescan in themanifest and datescan not in failed:
+            outputs.append(manifest.recorded_output(themanifest,datescan))
+        else:
+            outputs.append(None)
+    _write_summary(datescans,outputs,summary_file)
@@ -0,0 +1,164 @@
+import csv
+import numpy as np
+from SURFING import fileops,ndfio
+
+#####
+# P1-P0 Moment 0 residuals computed with NumPy.
+#
+# All of the P0/P1 integrated intensity maps for a batch are loaded, put on to P1's pixel grid
+# and stacked, so the differences and statistics for every datescan and molecule come from one
+# set of array operations rather than a Starlink task per map.
+#####
+
+# The columns of the residual statistics table
+STAT_COLUMNS = ['datescan','molecule','npix','residual_rms','normalised_rms','fractional_difference','P0_file','P1_file']
+
+def _onto_grid(array,origin,refshape,reforigin):
+    '''
+    Place a map on to another map's pixel grid using the pixel origins. Pixels with no data are NaN.
+
+    array    : The map to move
+    origin   : The pixel origin of array (NumPy axis order)
+    refshape : The shape of the grid to put it on
+    reforigin: The pixel origin of that grid
+    '''
+    out = np.full(refshape,np.nan)
+    src = []
+    dst = []
+    for o,n,ro,rn in zip(origin,array.shape,reforigin,refshape):
+        lo = max(o,ro)
+        hi = min(o+n,ro+rn)
+        if hi <= lo:
+            return out
+        src.append(slice(lo-o,hi-o))
+        dst.append(slice(lo-ro,hi-ro))
+    out[tuple(dst)] = array[tuple(src)]
+    return out
+
+def _stack(maps,shape):
+    '''
+    Stack maps of different sizes in to one (nmaps,...) array, padding with NaN
+
+    maps : A list of arrays, all with the same number of dimensions
+    shape: The shape to pad each map to
+    '''
+    stacked = np.full((len(maps),)+tuple(shape),np.nan)
+    for i,eachmap in enumerate(maps):
+        stacked[(i,)+tuple(slice(0,n) for n in eachmap.shape)] = eachmap
+    return stacked
+
+def residual_statistics(P0,P1,P0var=None,P1var=None):
+    '''
+    Compute the P1-P0 residuals and their statistics for a stack of maps in one pass.
+    Statistics only use pixels that are good in both P0 and P1.
+
+    P0,P1      : (nmaps,...) arrays of P0 and P1 integrated intensity, NaN where there is no data
+    P0var,P1var: The matching variance arrays, or None if there are no variances
+
+    Returns (residuals,stats) -- residuals is the (nmaps,...) array of P1-P0 and stats is a dictionary of
+    (nmaps,) arrays:
+        npix                 : the number of pixels good in both maps
+        residual_rms         : the RMS of P1-P0
+        normalised_rms       : the RMS of (P1-P0)/sqrt(var(P0)+var(P1)) -- ~1 if the residual is consistent with noise
+                               (NaN without variances)
+        fractional_difference: (sum(P1)-sum(P0)) / mean(sum(P0),sum(P1)) -- the relative difference in total flux
+    '''
+    residuals = P1-P0
+    axes      = tuple(range(1,residuals.ndim))
+    good      = np.isfinite(residuals)
+    npix      = good.sum(axis=axes)
+    sq        = np.where(good,residuals,0.0)**2
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        residual_rms = np.sqrt(sq.sum(axis=axes)/npix)
+
+        if P0var is not None and P1var is not None:
+            sumvar     = P0var+P1var
+            goodvar    = good & np.isfinite(sumvar) & (sumvar > 0)
+            chisq      = np.where(goodvar,residuals**2/np.where(goodvar,sumvar,1.0),0.0)
+            normalised = np.sqrt(chisq.sum(axis=axes)/goodvar.sum(axis=axes))
+        else:
+            normalised = np.full(len(residuals),np.nan)
+
+        sum0       = np.where(good,P0,0.0).sum(axis=axes)
+        sum1       = np.where(good,P1,0.0).sum(axis=axes)
+        fractional = (sum1-sum0)/(0.5*(sum0+sum1))
+
+    stats = {'npix'                 : npix,
+             'residual_rms'         : residual_rms,
+             'normalised_rms'       : normalised,
+             'fractional_difference': fractional}
+    return residuals,stats
+
+def batch_residuals(pairs):
+    '''
+    Load a batch of P0/P1 Moment 0 map pairs, compute all residuals and statistics together and write
+    each residual map as an SDF (a copy of the P1 map with the residual written in to it). Each map is made under
+    a temporary name and renamed in to place, so a P1 map is never left behind under the residual's name.
+
+    pairs: A list of dictionaries with keys 'datescan','molecule','P0','P1' (paths to the integ.sdf maps)
+           and 'out' (the path of the residual map to write)
+
+    Returns a list of dictionaries (one per pair, with keys STAT_COLUMNS)
+    '''
+    if len(pairs) == 0:
+        return []
+
+    #####
+    # Load every map and put P0 on to the P1 pixel grid, so pixel (i,j) is the same sky position in both
+    #####
+    P0maps,P1maps,P0vars,P1vars = [],[],[],[]
+    havevar = True
+    for pair in pairs:
+        P1,P1origin = ndfio.read_ndf(pair['P1'])
+        P0,P0origin = ndfio.read_ndf(pair['P0'])
+        P1v,_       = ndfio.read_ndf(pair['P1'],'VARIANCE')
+        P0v,_       = ndfio.read_ndf(pair['P0'],'VARIANCE')
+        P0maps.append(_onto_grid(P0,P0origin,P1.shape,P1origin))
+        P1maps.append(P1)
+        if P0v is None or P1v is None:
+            havevar = False
+        else:
+            P0vars.append(_onto_grid(P0v,P0origin,P1.shape,P1origin))
+            P1vars.append(P1v)
+
+    shape = np.max([eachmap.shape for eachmap in P1maps],axis=0)
+    residuals,stats = residual_statistics(_stack(P0maps,shape),_stack(P1maps,shape),
+                                          _stack(P0vars,shape) if havevar else None,
+                                          _stack(P1vars,shape) if havevar else None)
+
+    #####
+    # Write the residual maps and collect the statistics
+    #####
+    rows = []
+    for i,pair in enumerate(pairs):
+        inside = tuple(slice(0,n) for n in P1maps[i].shape)
+        partial = fileops.copy(pair['P1'],fileops.temp_path(pair['out'],'_residual_temp'))
+        try:
+            ndfio.write_ndf(partial,residuals[i][inside])
+            if havevar:
+                ndfio.write_ndf(partial,P0vars[i]+P1vars[i],'VARIANCE')
+        except BaseException:
+            fileops.remove(partial)
+            raise
+        fileops.replace(partial,pair['out'])
+
+        row = {'datescan':pair['datescan'],'molecule':pair['molecule'],'P0_file':pair['P0'],'P1_file':pair['P1']}
+        for eachstat in stats:
+            row[eachstat] = stats[eachstat][i].item()
+        rows.append(row)
+
+    return rows
+
+def write_statistics(rows,outfile):
+    '''
+    Write the residual statistics as a CSV table (under a temporary name, renamed in to place)
+
+    rows   : A list of dictionaries with keys STAT_COLUMNS, as returned by batch_residuals
+    outfile: The path to the CSV file
+    '''
+    with fileops.atomic_write(outfile,newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=STAT_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
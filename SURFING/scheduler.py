@@ -0,0 +1,209 @@
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor,FIRST_COMPLETED,wait
+from SURFING import fileops,instrument
+
+#####
+# A small dependency-graph executor.
+#
+# Each task declares the tasks it depends on and (optionally) the files it produces. A task starts as soon as
+# all of its own dependencies have finished, rather than waiting for a whole stage of the batch to finish.
+# Tasks run on a pool of threads -- the heavy lifting (ORACDR, KAPPA, CONVERT) happens in separate Starlink
+# processes, so threads are enough to keep several of them going at once.
+#
+# A task can also be ordered after other tasks without depending on them succeeding (e.g. the summary, which
+# reports the reductions that failed): it waits for them to finish, fail or be skipped, and then runs anyway.
+#
+# Finished tasks are recorded in a state file as they complete. If a run is interrupted, running the same graph
+# again skips tasks that already finished (as long as their declared outputs still exist), so it picks up where
+# it left off. The state file is removed once every task has finished successfully.
+#####
+
+class Task:
+    '''
+    One step of the task graph
+
+    name     : A unique name for the task, e.g. 'reduce:20220307_73:P0'
+    func     : The function to call
+    args     : Positional arguments for func
+    kwargs   : Keyword arguments for func
+    deps     : The names of the tasks that must finish before this one starts. If any of them fails, this task is skipped
+    after    : The names of tasks this one runs after, whether or not they succeed
+    skipnote : Printed (after the reason) if the task is skipped because a task it depends on failed
+    outputs  : Files the task produces. A finished task is only skipped on resume if these all exist
+    signature: A string describing the task's inputs (e.g. the datescans a coadd includes). A finished task
+               is only skipped on resume if its signature has not changed
+    '''
+
+    def __init__(self,name,func,args=(),kwargs=None,deps=(),outputs=(),signature='',after=(),skipnote=''):
+        self.name      = name
+        self.func      = func
+        self.args      = args
+        self.kwargs    = kwargs or {}
+        self.deps      = list(deps)
+        self.after     = list(after)
+        self.skipnote  = skipnote
+        self.outputs   = list(outputs)
+        self.signature = signature
+
+class TaskGraph:
+    '''
+    A set of tasks and the dependencies between them
+
+    state_file: The file finished tasks are recorded in, so an interrupted run can be resumed
+    '''
+
+    def __init__(self,state_file='reduced/pipeline_state.json'):
+        self.tasks      = {}
+        self.state_file = state_file
+        self.results    = {}
+        self.failed     = {}
+        self.blocked    = set()
+        self.skipped    = []
+
+    def add(self,name,func,args=(),kwargs=None,deps=(),outputs=(),signature='',after=(),skipnote=''):
+        '''
+        Add a task to the graph. See Task for a description of the arguments.
+        Dependencies may be added before or after the tasks that depend on them.
+        '''
+        if name in self.tasks:
+            raise ValueError('There is already a task called {}'.format(name))
+        self.tasks[name] = Task(name,func,args,kwargs,deps,outputs,signature,after,skipnote)
+        return self.tasks[name]
+
+    def succeeded(self,name):
+        '''
+        False if the task failed, or was skipped because a task it depends on failed -- e.g. for a task that runs
+        after it (see Task) to check
+        '''
+        return name not in self.failed and name not in self.blocked
+
+    def _check(self):
+        '''
+        Make sure every dependency exists and there are no cycles
+        '''
+        for task in self.tasks.values():
+            for dep in task.deps+task.after:
+                if dep not in self.tasks:
+                    raise ValueError('Task {} depends on {}, which is not in the graph'.format(task.name,dep))
+
+        # Depth first search for cycles
+        visiting = set()
+        visited  = set()
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError('The task graph has a cycle through {}'.format(name))
+            visiting.add(name)
+            for dep in self.tasks[name].deps+self.tasks[name].after:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+        for name in self.tasks:
+            visit(name)
+
+    def _load_state(self):
+        '''
+        Read the names and signatures of the tasks that finished in a previous (interrupted) run
+        '''
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def _save_state(self,state):
+        '''
+        Record the finished tasks, writing a temporary file and renaming it in to place
+        '''
+        with fileops.atomic_write(self.state_file) as f:
+            json.dump(state,f,indent=1)
+
+    def _already_done(self,task,state):
+        '''
+        Check whether a task finished in a previous run and its results are still valid
+        '''
+        if state.get(task.name) != task.signature:
+            return False
+        return all(os.path.exists(i) for i in task.outputs)
+
+    def run(self,nworkers=1,resume=True):
+        '''
+        Run every task, each one as soon as its dependencies have finished.
+        If a task fails, the error is reported and every task that depends on it is skipped;
+        tasks that don't depend on it (or only run after it) carry on. Tasks that ran after a failure are not
+        recorded as finished, so they run again when the run is resumed.
+
+        nworkers: The number of tasks to run at once
+        resume  : If True (default), skip tasks that finished in a previous interrupted run
+
+        Returns True if every task finished successfully
+        '''
+        self._check()
+        state   = self._load_state() if resume else {}
+        done    = set()
+        blocked = self.blocked
+
+        for name,task in self.tasks.items():
+            if self._already_done(task,state):
+                done.add(name)
+                self.skipped.append(name)
+        if len(self.skipped)>0:
+            print('Resuming: {} of {} tasks already finished in a previous run.'.format(len(self.skipped),len(self.tasks)))
+        state = {i:state[i] for i in done}
+
+        def ready(task):
+            return all(dep in done for dep in task.deps) and \
+                   all(dep in done or dep in self.failed or dep in blocked for dep in task.after)
+
+        def runtask(task):
+            with instrument.stage('task',task=task.name):
+                return task.func(*task.args,**task.kwargs)
+
+        pending = {name for name in self.tasks if name not in done}
+        with ThreadPoolExecutor(max_workers=max(1,nworkers)) as pool:
+            running = {}
+            while pending or running:
+
+                # Skip anything that depends (directly or indirectly) on a task that failed
+                newlyblocked = True
+                while newlyblocked:
+                    newlyblocked = False
+                    for name in sorted(pending):
+                        failed = [dep for dep in self.tasks[name].deps if dep in self.failed or dep in blocked]
+                        if len(failed) > 0:
+                            print('Skipping {} because {} failed.{}'.format(name,', '.join(failed),
+                                  ' '+self.tasks[name].skipnote if self.tasks[name].skipnote else ''))
+                            blocked.add(name)
+                            pending.discard(name)
+                            newlyblocked = True
+
+                # Start everything whose dependencies are all done
+                for name in sorted(pending):
+                    if ready(self.tasks[name]):
+                        running[pool.submit(runtask,self.tasks[name])] = name
+                        pending.discard(name)
+
+                if not running:
+                    break
+
+                finished,_ = wait(list(running),return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        print('Oh no! Task {} failed: {}'.format(name,e))
+                        traceback.print_exception(type(e),e,e.__traceback__)
+                        self.failed[name] = e
+                        continue
+                    done.add(name)
+                    if all(self.succeeded(dep) for dep in self.tasks[name].after):
+                        state[name] = self.tasks[name].signature
+                        self._save_state(state)
+
+        success = len(self.failed) == 0 and len(blocked) == 0 and len(done) == len(self.tasks)
+        if success and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        return success
@@ -0,0 +1,255 @@
+import fnmatch
+import glob
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from SURFING import fileops,manifest
+
+#####
+# A fast local scratch area (e.g. local NVMe or a tmpfs) for ORACDR.
+#
+# Each datescan is reduced three times (P0+P1 combined, P0 alone and P1 alone), and each pass reads every raw
+# file again. With a scratch area the raw files of a datescan are copied there once -- ideally by prefetch()
+# while the previous datescan is still being reduced -- and all three passes read the local copies:
+#     <scratch>/raw/<YYYYMMDD>/<SSSSS>/   the staged raw files, plus a 'complete' marker once they are all there
+#     <scratch>/raw/<YYYYMMDD>_<SSSSS>.lock   a lock file: held shared by running reductions, exclusive while staging or removing
+#     <scratch>/work/                     the ORACDR working directories
+# Staged raw files are kept within a size budget: when a datescan needs room, the least recently used staged
+# datescans that no reduction is using are removed. If there still isn't room, the reduction reads from raw/ as before.
+#
+# ORACDR writes in to its own working directory and the products are then published in to reduced/ by renaming
+# each file in to place, so a half-tidied reduction is never seen there. Files we never keep (PURGE_PATTERNS) are
+# deleted with the working directory.
+#
+# The scratch area is off unless a directory is given with configure(), or in the SURFING_SCRATCH environment variable.
+#####
+
+SCRATCH_DIR    = os.environ.get('SURFING_SCRATCH') or None
+SCRATCH_BUDGET = float(os.environ.get('SURFING_SCRATCH_BUDGET_GB') or 0)
+
+# ORACDR's own temporary files -- these are never published
+PURGE_PATTERNS = ['oractemp*','*.ok']
+
+def configure(path=None,budget_gb=0):
+    '''
+    Choose the scratch area. The settings are passed on to worker processes through the environment.
+
+    path     : The scratch directory. None turns the scratch area off
+    budget_gb: The most space (in GB) the staged raw files may use. 0 means only limited by the free space
+    '''
+    global SCRATCH_DIR,SCRATCH_BUDGET
+    SCRATCH_DIR    = None if path is None else os.path.abspath(path)
+    SCRATCH_BUDGET = float(budget_gb or 0)
+    os.environ['SURFING_SCRATCH']           = SCRATCH_DIR or ''
+    os.environ['SURFING_SCRATCH_BUDGET_GB'] = str(SCRATCH_BUDGET)
+
+def enabled():
+    '''
+    True if there is a scratch area
+    '''
+    return SCRATCH_DIR is not None
+
+def _rawpath(datescan):
+    return 'raw/{}/{}/'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+
+def _staged_path(datescan):
+    return os.path.join(SCRATCH_DIR,'raw',datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+
+@contextmanager
+def _locked(datescan,exclusive=True,block=True):
+    '''
+    Hold the lock file of a staged datescan. Yields True if the lock was taken, False if block=False and it is busy.
+    '''
+    lockfile = _staged_path(datescan).rstrip(os.sep)
+    lockfile = os.path.dirname(lockfile)+'_'+os.path.basename(lockfile)+'.lock'
+    with fileops.locked(lockfile,exclusive=exclusive,block=block) as got:
+        yield got
+
+def _staged():
+    '''
+    The datescans currently staged, least recently used first, with the size of each
+    '''
+    staged = []
+    for marker in glob.glob(os.path.join(SCRATCH_DIR,'raw','*','*','complete')):
+        stagedpath = os.path.dirname(marker)
+        datescan   = '{}_{}'.format(os.path.basename(os.path.dirname(stagedpath)),int(os.path.basename(stagedpath)))
+        size       = sum(os.path.getsize(i) for i in glob.glob(os.path.join(stagedpath,'*sdf')))
+        staged.append((os.path.getmtime(marker),datescan,size))
+    return [(datescan,size) for mtime,datescan,size in sorted(staged)]
+
+def _make_room(nbytes,evict,keep=()):
+    '''
+    Check there is room for nbytes more of staged raw files, removing least recently used datescans
+    that aren't in use if evict is True.
+
+    Returns True if there is room
+    '''
+    fileops.makedirs(SCRATCH_DIR)
+    staged = _staged()
+    used   = sum(size for datescan,size in staged)
+    for datescan,size in staged:
+        if (SCRATCH_BUDGET <= 0 or used+nbytes <= SCRATCH_BUDGET*1e9) and nbytes < shutil.disk_usage(SCRATCH_DIR).free:
+            return True
+        if not evict or datescan in keep:
+            continue
+        with _locked(datescan,block=False) as got:
+            if got:
+                release(datescan,locked=True)
+                used = used-size
+    return (SCRATCH_BUDGET <= 0 or used+nbytes <= SCRATCH_BUDGET*1e9) and nbytes < shutil.disk_usage(SCRATCH_DIR).free
+
+def _stage(datescan,evict):
+    '''
+    Copy the raw files of a datescan in to the scratch area, unless they are already there.
+    The caller must hold the datescan's lock exclusively.
+
+    Returns True if the datescan is staged
+    '''
+    stagedpath = _staged_path(datescan)
+    marker     = os.path.join(stagedpath,'complete')
+    if os.path.exists(marker):
+        return True
+
+    raw_files = sorted(glob.glob(os.path.join(_rawpath(datescan),'*sdf')))
+    if len(raw_files) == 0 or not _make_room(sum(os.path.getsize(i) for i in raw_files),evict,keep=[datescan]):
+        return False
+
+    fileops.makedirs(stagedpath)
+    for eachfile in raw_files:
+        fileops.copy(eachfile,stagedpath)
+    open(marker,'w').close()
+    return True
+
+@contextmanager
+def raw_files(datescan):
+    '''
+    The raw files to give ORACDR for a datescan: the staged copies if there is a scratch area (staging them first if
+    need be, and holding them so they can't be removed until the block ends), otherwise the files in raw/
+
+    datescan: A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    '''
+    if not enabled():
+        yield sorted(glob.glob(os.path.join(_rawpath(datescan),'*sdf')))
+        return
+
+    marker = os.path.join(_staged_path(datescan),'complete')
+    while True:
+        # Usually it's already staged, and the reductions of the datescan can all share it at once
+        with _locked(datescan,exclusive=False):
+            if os.path.exists(marker):
+                os.utime(marker)
+                yield sorted(glob.glob(os.path.join(_staged_path(datescan),'*sdf')))
+                return
+
+        # Otherwise stage it -- which needs the lock to ourselves -- then go back for the shared lock. It may be
+        # removed again in between, in which case it's staged again
+        with _locked(datescan):
+            staged = _stage(datescan,evict=True)
+        if not staged:
+            print('There is no room to stage {} in {} -- reading the raw files from {}'.format(datescan,SCRATCH_DIR,_rawpath(datescan)))
+            yield sorted(glob.glob(os.path.join(_rawpath(datescan),'*sdf')))
+            return
+
+def prefetch(datescans):
+    '''
+    Stage the raw files of these datescans, in order, in a background thread. Prefetching never removes other
+    staged datescans to make room -- it stops at the first datescan that doesn't fit in the budget.
+
+    datescans: A list of datescan strings in the format ['YYYYMMDD_SS','YYYYMMDD_SS'...], where SS = Scan Number
+
+    Returns the thread (already started). Join it when the batch is done
+    '''
+    def run():
+        for datescan in datescans:
+            try:
+                with _locked(datescan):
+                    if not _stage(datescan,evict=False):
+                        return
+            except OSError as e:
+                print('Could not prefetch {} to {}: {}'.format(datescan,SCRATCH_DIR,e))
+                return
+
+    thread = threading.Thread(target=run if enabled() else (lambda: None),name='SURFING-prefetch',daemon=True)
+    thread.start()
+    return thread
+
+def release(datescan,locked=False):
+    '''
+    Remove the staged raw files of a datescan, e.g. once all its reductions are done.
+    Waits for any reduction still using them.
+
+    datescan: A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    locked  : True if the caller already holds the datescan's lock exclusively
+    '''
+    if not enabled():
+        return
+    if not locked:
+        with _locked(datescan):
+            return release(datescan,locked=True)
+    # Remove the marker first, so a half removed datescan is never mistaken for a staged one
+    stagedpath = _staged_path(datescan)
+    fileops.remove(os.path.join(stagedpath,'complete'))
+    fileops.remove_tree(stagedpath)
+
+@contextmanager
+def workdir(outpath):
+    '''
+    A directory for ORACDR to write in to (its 'dataout'). With a scratch area this is a new directory there,
+    removed afterwards -- unless the reduction fails, when it is kept to look at. Without one it is outpath,
+    as ORACDR makes its own ORACworking* directory inside it.
+
+    outpath: Where the products will be published
+    '''
+    if not enabled():
+        yield outpath
+        return
+    fileops.makedirs(os.path.join(SCRATCH_DIR,'work'))
+    path = tempfile.mkdtemp(prefix=outpath.replace(os.sep,'_')+'_',dir=os.path.join(SCRATCH_DIR,'work'))
+    try:
+        yield path
+    except BaseException:
+        print('The ORACDR working directory has been kept here: {}'.format(path))
+        raise
+    fileops.remove_tree(path)
+
+def _destination(path,outpath):
+    '''
+    Where a file from the ORACDR working directory is published to: logs in outpath/logfiles,
+    images in outpath/imagefiles and everything else in outpath
+    '''
+    name = os.path.basename(path)
+    if 'log' in name:
+        return os.path.join(outpath,'logfiles',name)
+    if name.endswith('png'):
+        return os.path.join(outpath,'imagefiles',name)
+    return os.path.join(outpath,name)
+
+def publish(output,outpath):
+    '''
+    Move the products of an ORACDR run from its working directory (output.outdir) in to outpath, a file at a time with
+    an atomic rename, then delete the working directory along with anything left in it (e.g. files matching PURGE_PATTERNS).
+
+    output : The ORACDR output object
+    outpath: The reduced product directory e.g. reduced/20220307/00073/P0
+
+    Returns a SURFING.manifest.RecordedOutput with the published paths
+    '''
+    for eachdir in [outpath,os.path.join(outpath,'logfiles'),os.path.join(outpath,'imagefiles')]:
+        fileops.makedirs(eachdir)
+
+    for name in sorted(os.listdir(output.outdir)):
+        path = os.path.join(output.outdir,name)
+        if any(fnmatch.fnmatch(name,i) for i in PURGE_PATTERNS):
+            continue
+        if os.path.isdir(path):
+            shutil.move(path,os.path.join(outpath,name))
+        else:
+            fileops.replace(path,_destination(path,outpath))
+    fileops.remove_tree(output.outdir)
+
+    return manifest.RecordedOutput(_destination(output.runlog,outpath),
+                                   [_destination(i,outpath) for i in output.datafiles],
+                                   [_destination(i,outpath) for i in output.imagefiles],
+                                   [_destination(i,outpath) for i in output.logfiles])
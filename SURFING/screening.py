@@ -0,0 +1,202 @@
+import glob
+import json
+import os
+import re
+import numpy as np
+from SURFING import fileops,instrument,manifest,ndfio,products
+
+#####
+# Screen each receptor's raw data before reduction, so a misbehaving receptor is left out of the first ORACDR run
+# rather than found afterwards (at the cost of reducing the scan three more times).
+#
+# One pass over the raw ACSIS time series in raw/<YYYYMMDD>/<SSSSS>/, a subscan file at a time (so memory is bounded
+# by one file), working on whole (time,receptor,channel) arrays at once. For each receptor:
+#     rms           : the baseline noise, from the channel-to-channel differences of the outer EDGE_FRACTION of each
+#                     spectrum (away from the line, and insensitive to baseline offsets and slopes)
+#     spike_fraction: the fraction of samples more than SPIKE_SIGMA times the spectrum's noise from the running median
+#                     of their 3 channels -- a spike is one or two channels wide, while lines are broad enough for the
+#                     running median to follow them, so line emission doesn't count
+#     tsys          : the median system temperature (MORE.ACSIS.TSYS)
+# A receptor is bad if it has no good data, its rms or Tsys is more than RMS_FACTOR or TSYS_FACTOR times the
+# median over all receptors, or its spike fraction is more than SPIKE_FACTOR times the median over all receptors
+# (and more than SPIKE_FRACTION, so a few stray spikes on otherwise clean receptors don't count).
+# If that would leave out every receptor of a polarisation, none of them are left out -- the whole scan is odd, and
+# needs looking at rather than reducing with nothing left.
+#
+# The bad receptors go in to the calib='bad_receptors=...' argument of every ORACDR run of the datescan (see
+# SURFING.reduce.receptors_to_ignore), and so in to the manifest's fingerprint of the reduction.
+# Results are cached in reduced/screening/<datescan>.json and only worked out again if the raw files change.
+#####
+
+SCREENING_DIR = 'reduced/screening'
+
+# Screening can be turned off (e.g. SURFING_SCREEN_RECEPTORS=0). The setting is passed on to worker processes
+# through the environment.
+ENABLED = os.environ.get('SURFING_SCREEN_RECEPTORS','1') != '0'
+
+EDGE_FRACTION  = 0.25
+SPIKE_SIGMA    = 6.0
+SPIKE_FRACTION = 1e-3
+SPIKE_FACTOR   = 5.0
+RMS_FACTOR     = 1.5
+TSYS_FACTOR    = 1.5
+
+def configure(enabled=True):
+    '''
+    Turn receptor screening on or off
+
+    enabled: If False, no receptors are flagged automatically
+    '''
+    global ENABLED
+    ENABLED = bool(enabled)
+    os.environ['SURFING_SCREEN_RECEPTORS'] = '1' if ENABLED else '0'
+
+def _thresholds():
+    return {'edge_fraction':EDGE_FRACTION,'spike_sigma':SPIKE_SIGMA,'spike_fraction':SPIKE_FRACTION,
+            'spike_factor':SPIKE_FACTOR,'rms_factor':RMS_FACTOR,'tsys_factor':TSYS_FACTOR}
+
+def _polarisation(receptor):
+    '''
+    The polarisation of a receptor from its name e.g. NU0L -> '0' (Namakanui: N, receiver, polarisation, sideband).
+    Receptors of single polarisation instruments (e.g. HARP's H00-H15) are all in one group, None.
+    '''
+    match = re.match(r'^N[A-Z]([01])[LU]$',receptor)
+    return None if match is None else match.group(1)
+
+def _cache_file(datescan):
+    return os.path.join(SCREENING_DIR,'{}.json'.format(datescan))
+
+def _accumulate(totals,rawfile):
+    '''
+    Add one raw file's per-receptor noise, spike and Tsys totals in to totals
+    '''
+    receptors = ndfio.read_extension(rawfile,'ACSIS','RECEPTORS')
+    tsys      = ndfio.read_extension(rawfile,'ACSIS','TSYS')
+    data,_    = ndfio.read_ndf(rawfile)
+    if receptors is None or data is None or data.ndim != 3:
+        return
+
+    # data is (time,receptor,channel). Noise per spectrum from the channel differences of the two edges
+    edge  = max(2,int(data.shape[-1]*EDGE_FRACTION))
+    diffs = np.concatenate([np.diff(data[...,:edge],axis=-1),np.diff(data[...,-edge:],axis=-1)],axis=-1)
+    good  = np.isfinite(diffs)
+    sumsq = np.where(good,diffs**2,0.0).sum(axis=-1)
+    ndiff = good.sum(axis=-1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sigma = np.sqrt(sumsq/ndiff/2)
+
+    # Spikes: samples far from the running median of their 3 channels (the median of three is the largest of the
+    # pairwise minimums). NaNs never count as spikes
+    finite = np.isfinite(data)
+    left,right = data[...,:-2],data[...,2:]
+    middle     = data[...,1:-1]
+    median     = np.maximum(np.maximum(np.minimum(left,middle),np.minimum(middle,right)),np.minimum(left,right))
+    with np.errstate(invalid='ignore'):
+        spikes = np.zeros(data.shape,dtype=bool)
+        spikes[...,1:-1] = np.abs(middle-median) > SPIKE_SIGMA*sigma[...,None]
+
+    for r,name in enumerate(receptors):
+        thisrec = totals.setdefault(str(name),{'sumsq':0.0,'ndiff':0,'nspike':0,'nsample':0,'tsys':[]})
+        thisrec['sumsq']   += float(sumsq[:,r].sum())
+        thisrec['ndiff']   += int(ndiff[:,r].sum())
+        thisrec['nspike']  += int(spikes[:,r].sum())
+        thisrec['nsample'] += int(finite[:,r].sum())
+        if tsys is not None:
+            thisrec['tsys'].append(tsys[:,r])
+
+def screen(datescan):
+    '''
+    Screen the receptors of one datescan's raw data (see above). Does not use or update the cache.
+
+    datescan: A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+
+    Returns a dictionary: 'receptors' {name: {'rms','spike_fraction','tsys','reasons'}}, 'bad' (a sorted list) and
+    'kept' (receptors that would have been bad, but were all of a polarisation)
+    '''
+    rawfiles = sorted(glob.glob(os.path.join(products.datescan_path(datescan,root='raw'),'*sdf')))
+    totals   = {}
+    with instrument.stage('screen',inputs=rawfiles,datescan=datescan):
+        for rawfile in rawfiles:
+            _accumulate(totals,rawfile)
+
+    receptors = {}
+    for name,thisrec in totals.items():
+        tsys = np.concatenate(thisrec['tsys']) if len(thisrec['tsys']) > 0 else np.array([])
+        tsys = tsys[np.isfinite(tsys)]
+        receptors[name] = {'rms'           : float(np.sqrt(thisrec['sumsq']/thisrec['ndiff']/2)) if thisrec['ndiff'] > 0 else float('nan'),
+                           'spike_fraction': thisrec['nspike']/thisrec['nsample'] if thisrec['nsample'] > 0 else float('nan'),
+                           'tsys'          : float(np.median(tsys)) if tsys.size > 0 else float('nan'),
+                           'reasons'       : []}
+
+    # Compare each receptor with the typical receptor
+    rms    = np.array([i['rms'] for i in receptors.values()])
+    tsys   = np.array([i['tsys'] for i in receptors.values()])
+    spikes = np.array([i['spike_fraction'] for i in receptors.values()])
+    typical_rms    = np.median(rms[np.isfinite(rms)]) if np.isfinite(rms).any() else np.nan
+    typical_tsys   = np.median(tsys[np.isfinite(tsys) & (tsys > 0)]) if (np.isfinite(tsys) & (tsys > 0)).any() else np.nan
+    typical_spikes = np.median(spikes[np.isfinite(spikes)]) if np.isfinite(spikes).any() else np.nan
+    for name,thisrec in receptors.items():
+        if not np.isfinite(thisrec['rms']) or thisrec['rms'] == 0:
+            thisrec['reasons'].append('no data')
+        elif thisrec['rms'] > RMS_FACTOR*typical_rms:
+            thisrec['reasons'].append('noisy')
+        if thisrec['spike_fraction'] > max(SPIKE_FRACTION,SPIKE_FACTOR*typical_spikes):
+            thisrec['reasons'].append('spikes')
+        if np.isfinite(typical_tsys) and (not np.isfinite(thisrec['tsys']) or thisrec['tsys'] <= 0 or
+                                          thisrec['tsys'] > TSYS_FACTOR*typical_tsys):
+            thisrec['reasons'].append('tsys')
+
+    # Never leave out every receptor of a polarisation
+    bad     = sorted(i for i in receptors if len(receptors[i]['reasons']) > 0)
+    refused = []
+    for pol in set(_polarisation(i) for i in receptors):
+        allofthem = sorted(i for i in receptors if _polarisation(i) == pol)
+        if all(i in bad for i in allofthem):
+            refused = refused+allofthem
+    if len(refused) > 0:
+        print('Oh no! Screening {} would leave out every receptor of a polarisation ({}) -- keeping them all. '\
+                'Check the raw data by hand.'.format(datescan,', '.join(refused)))
+        bad = [i for i in bad if i not in refused]
+
+    return {'receptors':receptors,'bad':bad,'kept':refused}
+
+def bad_receptors(datescan,compute=True):
+    '''
+    The receptors to leave out of a datescan's reductions, screening its raw data if there is no up-to-date result
+    in the cache. Workers screening the same datescan at once wait for each other rather than all doing it.
+
+    datescan: A datescan string in the format 'YYYYMMDD_SS', where SS = Scan Number
+    compute : If False, only use the cache -- returns None if there is no up-to-date result
+
+    Returns a sorted list of receptor names ([] if screening is off)
+    '''
+    if not ENABLED:
+        return []
+    raw       = manifest.fingerprint(datescan,'')['raw']
+    cachefile = _cache_file(datescan)
+
+    def cached():
+        if not os.path.exists(cachefile):
+            return None
+        with open(cachefile) as f:
+            result = json.load(f)
+        if result['raw'] != raw or result['thresholds'] != _thresholds():
+            return None
+        return result['bad']
+
+    if not compute:
+        return cached()
+    with fileops.locked(cachefile+'.lock'):
+        bad = cached()
+        if bad is not None:
+            return bad
+        result = screen(datescan)
+        result.update({'datescan':datescan,'raw':raw,'thresholds':_thresholds()})
+        with fileops.atomic_write(cachefile) as f:
+            json.dump(result,f,indent=1)
+
+    for name in result['bad']:
+        thisrec = result['receptors'][name]
+        print('\t{}: leaving out receptor {} ({}) -- rms {:.3g}, spike fraction {:.2g}, Tsys {:.4g} K'.format(
+                datescan,name,', '.join(thisrec['reasons']),thisrec['rms'],thisrec['spike_fraction'],thisrec['tsys']))
+    return result['bad']
@@ -0,0 +1,209 @@
+import math
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from SURFING import backend,coaddstore,fileops,instrument,ndfio
+from SURFING.residuals import _onto_grid
+
+# Record every call to Starlink (see SURFING.instrument)
+kappa = instrument.wrap(backend.kappa,'kappa')
+
+#####
+# A tiled, out-of-core, multi-core alternative to mosaicking a whole region with one kappa.wcsmosaic call.
+#
+#     1. Regrid: each input cube is aligned to the reference pixel grid with kappa.wcsalign (one cube per
+#        worker process at a time) in to an NDF in a work directory. Inputs already on the reference grid (the
+#        reference itself, e.g. the existing co-add) are used as they are. Nothing is read in to Python here.
+#     2. Tile:   the output grid (the union of the aligned inputs, as wcsmosaic's lbnd='!',ubnd='!') is split
+#        in to spatial tiles, each covering the whole spectral axis, small enough that a worker's arrays for one
+#        take no more than max_tile_mb of memory.
+#     3. Accumulate: each worker averages the inputs over its tile. It reads only the part of each input that
+#        overlaps the tile, as an NDF section (see ndfio.read_section), and writes the tile as a small NDF on the
+#        reference grid (see coaddstore.write_on_grid).
+#     4. Stitch: the tiles are pasted together in to the output NDF with one kappa.paste call, so neither this
+#        process nor the workers ever hold a whole input or the whole output cube.
+#
+# max_tile_mb bounds the memory of the Python processes. The Starlink commands (wcsalign, ndfcopy and paste) run as
+# processes of their own and map whole NDFs through HDS as they always do. Each tile costs one ndfcopy per input it
+# overlaps, so a very small max_tile_mb trades memory for many short Starlink calls.
+#
+# The aim is the same co-add kappa.wcsmosaic makes with the parameters the 'wcsmosaic' engine gives it, i.e. its
+# defaults: the inputs are rebinned with a bilinear kernel and no flux conservation (ALIGN_PARAMS), and averaged
+# with equal weights (VARIANCE=FALSE), so the output variance is the sum of the input variances over n**2.
+# wcsmosaic spreads each input pixel over the whole output grid before normalising, while here each input is
+# rebinned on its own first, so the two can differ within a pixel of the edge of an input. Use compare() to
+# check the engines agree on real data.
+#####
+
+# The kappa.wcsalign parameters that resample an input as kappa.wcsmosaic does by default
+ALIGN_PARAMS = {'method':'bilinear','rebin':True,'conserve':False}
+
+# The number of arrays of tile size a worker holds at once (sum, variance sum, count, data, variance, good)
+_ARRAYS_PER_TILE = 6
+
+def _regrid(infile,ref,workdir,n):
+    '''
+    Align one input cube to the reference grid, unless it is the reference
+
+    infile : The input cube
+    ref    : The reference NDF
+    workdir: Where to put the aligned cube
+    n      : The number of this input, for the file name
+
+    Returns a dictionary with the path to the aligned cube, its origin and shape, and whether it has a variance
+    '''
+    if os.path.abspath(infile) == os.path.abspath(ref):
+        aligned = infile
+    else:
+        aligned = os.path.join(workdir,'aligned_{}.sdf'.format(n))
+        kappa.wcsalign(infile,out=aligned,ref=ref,lbnd='!',ubnd='!',**ALIGN_PARAMS)
+
+    lbnd,ubnd = ndfio.ndf_bounds(aligned)
+    return {'path':aligned,'origin':list(lbnd),'shape':[u-l+1 for l,u in zip(lbnd,ubnd)],
+            'var':ndfio.has_component(aligned,'VARIANCE')}
+
+def _tiles(origin,shape,max_tile_mb):
+    '''
+    Split a grid in to tiles along the last two (spatial) axes, each covering the rest of the grid,
+    with no more than max_tile_mb of working memory per tile
+
+    origin     : The pixel origin of the grid (NumPy axis order)
+    shape      : The shape of the grid
+    max_tile_mb: The memory budget for one tile
+
+    Returns a list of (origin,shape) tuples
+    '''
+    other  = int(np.prod(shape[:-2]))
+    pixels = max(1,int(max_tile_mb*1e6/(8*_ARRAYS_PER_TILE*other)))
+    side   = max(1,int(math.sqrt(pixels)))
+    ny,nx  = shape[-2],shape[-1]
+    ty,tx  = min(ny,side),min(nx,max(side,pixels//min(ny,side)))
+
+    tiles = []
+    for y in range(0,ny,ty):
+        for x in range(0,nx,tx):
+            tileorigin = list(origin[:-2])+[origin[-2]+y,origin[-1]+x]
+            tileshape  = list(shape[:-2])+[min(ty,ny-y),min(tx,nx-x)]
+            tiles.append((tileorigin,tileshape))
+    return tiles
+
+def _accumulate_tile(regridded,ref,tileorigin,tileshape,variance,tilefile,workdir):
+    '''
+    Average the inputs over one tile and write it as an NDF on the reference grid
+
+    regridded : The regridded inputs, see _regrid
+    ref       : The reference NDF
+    tileorigin: The pixel origin of the tile
+    tileshape : The shape of the tile
+    variance  : If True, write the variance too
+    tilefile  : The SDF file to write
+    workdir   : A directory for the sections of the inputs
+    '''
+    total = np.zeros(tileshape)
+    vsum  = np.zeros(tileshape)
+    count = np.zeros(tileshape)
+    for eachinput in regridded:
+        # Only read the part of the input that overlaps the tile
+        lower = [max(a,b) for a,b in zip(eachinput['origin'],tileorigin)]
+        upper = [min(a+n,b+m) for a,n,b,m in zip(eachinput['origin'],eachinput['shape'],tileorigin,tileshape)]
+        if any(u <= l for l,u in zip(lower,upper)):
+            continue
+        dst      = tuple(slice(l-o,u-o) for l,u,o in zip(lower,upper,tileorigin))
+        data,var = ndfio.read_section(eachinput['path'],lower,[u-1 for u in upper],workdir)
+
+        # Every good pixel counts the same, as kappa.wcsmosaic with VARIANCE=FALSE
+        good = np.isfinite(data)
+        total[dst] += np.where(good,data,0.0)
+        count[dst] += good
+        if variance:
+            vsum[dst] += np.where(good,var,0.0)
+        del data,var,good
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        data = np.where(count > 0,total/count,np.nan)
+        var  = np.where(count > 0,vsum/count**2,np.nan) if variance else None
+    del total,vsum,count
+    coaddstore.write_on_grid(ref,tileorigin,data,var,tilefile)
+
+def mosaic(infiles,out,ref=None,nprocs=1,max_tile_mb=256,workdir=None):
+    '''
+    Mosaic cubes on to the pixel grid of a reference NDF, tile by tile on a pool of worker processes
+
+    infiles    : The cubes to mosaic
+    out        : The SDF file to write
+    ref        : The reference NDF. Default None uses the first input
+    nprocs     : The number of worker processes. 1 does everything in this process
+    max_tile_mb: The most memory (in MB) a worker uses for one tile
+    workdir    : A directory for the aligned inputs and the tiles. Default None uses <out>_tiles/. It is removed afterwards
+    '''
+    ref     = infiles[0] if ref is None else ref
+    workdir = os.path.splitext(out)[0]+'_tiles' if workdir is None else workdir
+    fileops.makedirs(workdir)
+
+    pool = ProcessPoolExecutor(max_workers=nprocs) if nprocs > 1 else None
+    try:
+        # 1. Regrid every input on to the reference grid
+        if pool is None:
+            regridded = [_regrid(infile,ref,workdir,n) for n,infile in enumerate(infiles)]
+        else:
+            regridded = list(pool.map(_regrid,infiles,[ref]*len(infiles),[workdir]*len(infiles),range(len(infiles))))
+
+        # 2. The output grid covers all of the inputs
+        origin   = [min(i['origin'][d] for i in regridded) for d in range(len(regridded[0]['origin']))]
+        upper    = [max(i['origin'][d]+i['shape'][d] for i in regridded) for d in range(len(regridded[0]['origin']))]
+        shape    = [u-o for o,u in zip(origin,upper)]
+        variance = all(i['var'] for i in regridded)
+
+        # 3. Build each tile
+        tiles     = _tiles(origin,shape,max_tile_mb)
+        tilefiles = [os.path.join(workdir,'tile_{}.sdf'.format(n)) for n in range(len(tiles))]
+        args      = [(regridded,ref,tileorigin,tileshape,variance,tilefile,workdir) for (tileorigin,tileshape),tilefile in zip(tiles,tilefiles)]
+        if pool is None:
+            for eacharg in args:
+                _accumulate_tile(*eacharg)
+        else:
+            for future in [pool.submit(_accumulate_tile,*eacharg) for eacharg in args]:
+                future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # 4. Stitch the tiles together in to the output NDF. The first tile is the base, and the output covers all of
+    #    them (confine=False). The tiles don't overlap, and bad pixels are copied too (transp=False)
+    tilelist = os.path.join(workdir,'tiles.lis')
+    with open(tilelist,'w') as f:
+        f.write('\n'.join(tilefiles)+'\n')
+    tmpout = fileops.temp_path(out,'_paste_temp')
+    kappa.paste('^'+tilelist,p1='!',out=tmpout,confine=False,transp=False)
+    fileops.replace(tmpout,out)
+    fileops.remove_tree(workdir)
+
+def compare(coadd1,coadd2,rtol=1e-4,atol=1e-6):
+    '''
+    Compare two coadds of the same data, e.g. from the 'wcsmosaic' and 'tiled' engines, on their common pixel grid
+
+    coadd1,coadd2: The two SDF files
+    rtol,atol    : They match if |coadd1-coadd2| <= atol + rtol*|coadd2| wherever either has data,
+                   and both have data in the same pixels
+
+    Returns a dictionary: npix (pixels with data in both), nmismatch_bad (pixels with data in only one),
+    max_abs_diff, max_rel_diff and match (True/False)
+    '''
+    data1,origin1 = ndfio.read_ndf(coadd1)
+    data2,origin2 = ndfio.read_ndf(coadd2)
+    origin = [min(a,b) for a,b in zip(origin1,origin2)]
+    shape  = [max(a+n,b+m)-o for a,n,b,m,o in zip(origin1,data1.shape,origin2,data2.shape,origin)]
+    data1  = _onto_grid(data1,origin1,shape,origin)
+    data2  = _onto_grid(data2,origin2,shape,origin)
+
+    both  = np.isfinite(data1) & np.isfinite(data2)
+    diff  = np.abs(data1-data2)[both]
+    scale = np.abs(data2)[both]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rel = np.where(scale > 0,diff/scale,0.0)
+    result = {'npix'         : int(both.sum()),
+              'nmismatch_bad': int((np.isfinite(data1) != np.isfinite(data2)).sum()),
+              'max_abs_diff' : float(diff.max()) if diff.size > 0 else 0.0,
+              'max_rel_diff' : float(rel.max()) if rel.size > 0 else 0.0}
+    result['match'] = result['nmismatch_bad'] == 0 and bool(np.all(diff <= atol+rtol*scale))
+    return result
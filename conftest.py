@@ -0,0 +1,3 @@
+#####
+# Lets pytest import SURFING from the repository root (the tests live in tests/)
+#####
@@ -0,0 +1,19 @@
+import pytest
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path,monkeypatch):
+    '''
+    Run every test in its own empty directory, as SURFING works relative to the current directory
+    '''
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def stub_backend(monkeypatch):
+    '''
+    Use the benchmark's stub Starlink (SURFING.bench.stubstar), in this process and in any worker processes
+    '''
+    from SURFING import backend
+    monkeypatch.setattr(backend,'BACKEND','SURFING.bench.stubstar')
+    monkeypatch.setattr(backend,'_loaded',None)
+    monkeypatch.setenv('SURFING_BACKEND','SURFING.bench.stubstar')
@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import pytest
+from SURFING import coaddstore,ndfio,postprocess
+from SURFING.bench import stubstar
+
+pytestmark = pytest.mark.usefixtures('stub_backend')
+
+def _cube(path,value,var,origin,shape=(2,2,2)):
+    stubstar.write_ndf(path,np.full(shape,float(value)),origin=origin,variance=np.full(shape,float(var)))
+    # Make sure a rewritten cube looks changed, however coarse the file system's clock
+    mtime = os.path.getmtime(path)
+    os.utime(path,(mtime+_cube.tick,mtime+_cube.tick))
+    _cube.tick += 10
+_cube.tick = 0
+
+def _coadd(region='R',mol='CO'):
+    coaddstore.materialise(region,mol,'coadd.sdf')
+    data,origin = ndfio.read_ndf('coadd.sdf')
+    var,_       = ndfio.read_ndf('coadd.sdf','VARIANCE')
+    return data,var,origin
+
+def test_overlapping_and_separate_cubes():
+    _cube('a.sdf',1,1,(1,1,1))
+    _cube('b.sdf',4,2,(1,2,2))
+    _cube('c.sdf',2,0.5,(1,5,5))
+    for eachfile in ['a.sdf','b.sdf','c.sdf']:
+        assert coaddstore.accumulate('R','CO',eachfile)
+    assert not coaddstore.accumulate('R','CO','b.sdf')
+
+    data,var,origin = _coadd()
+    assert origin == (1,1,1) and data.shape == (2,6,6)
+    # Inverse-variance weighted mean (1*1 + 4*0.5)/1.5 = 2 where a and b overlap, with variance 1/1.5
+    assert data[0,0,0] == 1 and var[0,0,0] == 1
+    assert data[1,1,1] == pytest.approx(2) and var[1,1,1] == pytest.approx(1/1.5)
+    assert data[0,2,2] == 4 and var[0,2,2] == 2
+    assert data[0,4,4] == 2 and var[0,4,4] == 0.5
+    assert np.isnan(data[0,3,3]) and np.isnan(var[0,3,3])
+
+def test_the_store_grows_to_cover_new_cubes():
+    _cube('a.sdf',1,1,(1,1,1))
+    _cube('b.sdf',3,1,(1,-2,0),shape=(2,1,1))
+    coaddstore.accumulate('R','CO','a.sdf')
+    coaddstore.accumulate('R','CO','b.sdf')
+
+    meta = coaddstore._load_meta(coaddstore.store_path('R','CO'))
+    assert meta['origin'] == [1,-2,0] and meta['shape'] == [2,5,3]
+    assert np.load(os.path.join(coaddstore.store_path('R','CO'),'wt.npy')).shape == (2,5,3)
+    data,var,origin = _coadd()
+    assert origin == (1,-2,0)
+    assert data[0,0,0] == 3 and (data[:,3:,1:] == 1).all()
+    assert np.isnan(data[0,1,1])
+
+def test_a_changed_cube_replaces_its_old_contribution():
+    _cube('a.sdf',1,1,(1,1,1))
+    _cube('b.sdf',4,2,(1,2,2))
+    coaddstore.accumulate('R','CO','a.sdf')
+    coaddstore.accumulate('R','CO','b.sdf')
+    _cube('a.sdf',7,1,(1,1,1))
+    assert coaddstore.accumulate('R','CO','a.sdf')
+
+    data,var,origin = _coadd()
+    assert data[0,0,0] == 7
+    assert data[1,1,1] == pytest.approx((7+4*0.5)/1.5) and var[1,1,1] == pytest.approx(1/1.5)
+    store = coaddstore.store_path('R','CO')
+    assert len(coaddstore._load_meta(store)['contributions']) == 2
+    assert sorted(os.listdir(os.path.join(store,'contributions'))) == ['1_wsum.npy','1_wt.npy','2_wsum.npy','2_wt.npy']
+
+def test_the_store_is_seeded_from_an_existing_coadd():
+    os.makedirs('coadds')
+    _cube('coadds/R_CO_coadd.sdf',1,1,(1,1,1))
+    _cube('b.sdf',4,2,(1,2,2))
+    postprocess._coadd_incremental(['b.sdf'],'R','CO')
+    postprocess._coadd_incremental(['b.sdf'],'R','CO')
+
+    meta = coaddstore._load_meta(coaddstore.store_path('R','CO'))
+    assert sorted(meta['contributions']) == ['b.sdf','previous_coadd']
+    data,_ = ndfio.read_ndf('coadds/R_CO_coadd.sdf')
+    assert data[0,0,0] == 1 and data[1,1,1] == pytest.approx(2)
+
+def test_an_interrupted_update_is_not_counted_twice(monkeypatch):
+    _cube('a.sdf',1,1,(1,1,1))
+    _cube('b.sdf',4,2,(1,2,2))
+    coaddstore.accumulate('R','CO','a.sdf')
+
+    # Stop just before meta.json records b.sdf, after the running sums have been updated
+    save_meta = coaddstore._save_meta
+    def interrupted(store,meta):
+        if 'b.sdf' in meta['contributions']:
+            raise KeyboardInterrupt
+        save_meta(store,meta)
+    monkeypatch.setattr(coaddstore,'_save_meta',interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        coaddstore.accumulate('R','CO','b.sdf')
+    monkeypatch.setattr(coaddstore,'_save_meta',save_meta)
+
+    assert coaddstore.accumulate('R','CO','b.sdf')
+    data,var,origin = _coadd()
+    assert data[1,1,1] == pytest.approx(2) and var[1,1,1] == pytest.approx(1/1.5)
+    assert not os.path.exists(os.path.join(coaddstore.store_path('R','CO'),'journal'))
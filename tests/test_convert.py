@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pytest
+from SURFING import postprocess
+from SURFING.bench import stubstar
+
+pytestmark = pytest.mark.usefixtures('stub_backend')
+
+class _Index:
+    '''
+    Stands in for a products.ProductIndex of the given files
+    '''
+    def __init__(self,files):
+        self.files = files
+
+    def query(self,datescan=None,ext='sdf',**kwargs):
+        return list(self.files)
+
+def _products():
+    for name in ['a.sdf','c.sdf']:
+        stubstar.write_ndf(name,np.ones((2,3,4)))
+    with open('bad.sdf','w') as f:
+        f.write('not an NDF')
+    return _Index(['a.sdf','bad.sdf','c.sdf'])
+
+@pytest.mark.parametrize('nprocs',[1,2])
+def test_a_failure_does_not_stop_the_other_conversions(nprocs):
+    index = _products()
+    with pytest.raises(RuntimeError,match='1 of 3 files could not be converted to fits \\(2 were converted\\)'):
+        postprocess.convert_to_fits(['20220307_1'],nprocs=nprocs,index=index)
+    assert os.path.exists('a.fits') and os.path.exists('c.fits')
+    assert not os.path.exists('bad.fits')
+
+def test_only_new_or_changed_files_are_converted():
+    index = _products()
+    assert postprocess.convert_to_fits(['20220307_1'],exclude=['bad*'],index=index) == 2
+    assert postprocess.convert_to_fits(['20220307_1'],exclude=['bad*'],index=index) == 0
+    os.utime('c.sdf',(os.path.getmtime('c.fits')+10,)*2)
+    assert postprocess.convert_to_fits(['20220307_1'],exclude=['bad*'],index=index) == 1
+    assert postprocess.convert_to_fits(['20220307_1'],exclude=['bad*'],index=index,force=True) == 2
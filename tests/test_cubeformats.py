@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from SURFING import cubeformats,ndfio
+from SURFING.bench import stubstar
+
+pytestmark = pytest.mark.usefixtures('stub_backend')
+
+WCS = ['Begin FrameSet','   Nframe = 3','+  Ident = "SKY-DSBSPECTRUM"','End FrameSet']
+
+def _cube(path='cube.sdf'):
+    '''
+    A cube of 150 channels with pixel origin (channel 3, y -2, x 5), a variance, some bad pixels and a WCS
+    '''
+    rng  = np.random.default_rng(0)
+    data = rng.normal(size=(150,6,7)).astype(np.float32)
+    data[10,2,3] = np.nan
+    var  = rng.uniform(1,2,size=data.shape).astype(np.float32)
+    stubstar.write_ndf(path,data,origin=(3,-2,5),variance=var)
+    ndf = stubstar._load(path)
+    ndf['WCS'] = {'DATA':np.array([i.encode() for i in WCS])}
+    stubstar._save(path,ndf)
+    return path,data,var
+
+@pytest.fixture(params=['h5','zarr','fits.fz','fits'])
+def fmt(request):
+    if request.param in ['fits.fz','fits']:
+        pytest.importorskip('astropy')
+    return request.param
+
+def test_round_trip(fmt):
+    path,data,var = _cube()
+    cubeformats.write(path,fmt=fmt)
+    out = cubeformats.output_path(path,fmt)
+    assert out == 'cube'+cubeformats.FORMATS[fmt]
+
+    with cubeformats.open_cube(out) as cube:
+        assert cube.shape == (150,6,7) and cube.origin == (3,-2,5)
+        np.testing.assert_array_equal(cube[...],data)
+        # Pixel indices, clipped to the cube
+        np.testing.assert_array_equal(cube.section((10,-5,6),(12,-1,100)),data[7:10,0:2,1:])
+        np.testing.assert_array_equal(cube.spectrum(8,0),data[:,2,3])
+        with pytest.raises(IndexError):
+            cube.spectrum(4,0)
+        if fmt in ['h5','zarr']:
+            assert cube.wcs == WCS
+        else:
+            assert cube.wcs['LBOUND3'] == 3
+
+    if fmt in ['h5','zarr']:
+        with cubeformats.open_cube(out,'VARIANCE') as cube:
+            np.testing.assert_array_equal(cube[...],var)
+
+@pytest.mark.parametrize('fmt',['h5','zarr'])
+def test_big_cubes_are_copied_a_block_at_a_time(fmt,monkeypatch):
+    path,data,var = _cube()
+    reads,whole = [],[]
+    read_section,read_ndf = ndfio.read_section,ndfio.read_ndf
+    def recording_read_section(path,lbnd,ubnd,workdir):
+        reads.append((lbnd[0],ubnd[0]))
+        return read_section(path,lbnd,ubnd,workdir)
+    def recording_read_ndf(path,component='DATA'):
+        whole.append(path)
+        return read_ndf(path,component)
+    with monkeypatch.context() as patched:
+        patched.setattr(ndfio,'read_section',recording_read_section)
+        patched.setattr(ndfio,'read_ndf',recording_read_ndf)
+        # Room for about 70 channels, i.e. one chunk of 64
+        patched.setattr(cubeformats,'MAX_BLOCK_MB',70*6*7*2*8/1e6)
+        cubeformats.write(path,fmt=fmt,chunks=(64,32,32))
+    assert reads == [(3,66),(67,130),(131,152)]
+    assert path not in whole
+    with cubeformats.open_cube(cubeformats.output_path(path,fmt)) as cube:
+        np.testing.assert_array_equal(cube[...],data)
+    with cubeformats.open_cube(cubeformats.output_path(path,fmt),'VARIANCE') as cube:
+        np.testing.assert_array_equal(cube[...],var)
+
+def test_unknown_formats():
+    with pytest.raises(ValueError):
+        cubeformats.output_path('cube.sdf','png')
+    assert cubeformats.format_of('coadds/X_CO_coadd.fits.fz') == 'fits.fz'
+    assert cubeformats.format_of('coadds/X_CO_coadd.zarr/') == 'zarr'
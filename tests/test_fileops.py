@@ -0,0 +1,42 @@
+import os
+import pytest
+from SURFING import fileops
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def test_replace_and_copy():
+    with open('old','w') as f:
+        f.write('old')
+    with open('new','w') as f:
+        f.write('new')
+    fileops.replace('new','old')
+    assert _read('old') == 'new' and not os.path.exists('new')
+
+    os.makedirs('dir')
+    assert fileops.copy('old','dir') == os.path.join('dir','old')
+    assert _read('dir/old') == 'new' and os.listdir('dir') == ['old']
+
+    with pytest.raises(OSError):
+        fileops.replace('missing','old')
+
+def test_atomic_write():
+    with fileops.atomic_write('reduced/manifest.json') as f:
+        f.write('first')
+    assert _read('reduced/manifest.json') == 'first'
+
+    # An error part way through leaves the old file, and no partial file
+    with pytest.raises(RuntimeError):
+        with fileops.atomic_write('reduced/manifest.json') as f:
+            f.write('half')
+            raise RuntimeError('interrupted')
+    assert _read('reduced/manifest.json') == 'first'
+    assert os.listdir('reduced') == ['manifest.json']
+
+def test_remove_is_quiet_only_when_already_gone():
+    fileops.remove('missing')
+    fileops.remove_tree('missing_dir')
+    os.makedirs('dir')
+    with pytest.raises(OSError):
+        fileops.remove('dir')
@@ -0,0 +1,35 @@
+import subprocess
+import sys
+import threading
+from SURFING import instrument
+
+def _records(name):
+    return [i for i in instrument.load_records(run=instrument.RUN_ID) if i['name'] == name]
+
+def test_child_processes_are_counted_when_alone():
+    with instrument.stage('alone'):
+        subprocess.run([sys.executable,'-c','x = bytearray(50*1024*1024); sum(range(10**6))'],check=True)
+    record = _records('alone')[-1]
+    assert not record['shared']
+    assert record['cpu_children'] > 0 and record['cpu'] >= record['cpu_children']
+    assert record['maxrss_kb'] is None or record['maxrss_kb'] > 50*1024
+
+def test_overlapping_threads_are_marked_shared():
+    started = threading.Barrier(2)
+    def work(name):
+        with instrument.stage(name):
+            started.wait()
+            sum(range(10**5))
+            started.wait()
+    threads = [threading.Thread(target=work,args=('thread{}'.format(i),)) for i in range(2)]
+    for eachthread in threads:
+        eachthread.start()
+    for eachthread in threads:
+        eachthread.join()
+
+    for name in ['thread0','thread1']:
+        record = _records(name)[-1]
+        assert record['shared'] and record['cpu_children'] is None and record['maxrss_kb'] is None
+        # This thread's own CPU, not the other thread's
+        assert 0 <= record['cpu_self'] == record['cpu']
+    assert 'shared' in instrument.summary_table(instrument.load_records(run=instrument.RUN_ID))
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from SURFING import jobqueue,quicklook
+
+QUEUE = 'reduced/queue.sqlite'
+
+def _claim_all(worker):
+    '''
+    Claim jobs until there are none left, returning their ids
+    '''
+    claimed = []
+    while True:
+        job = jobqueue.claim(worker,QUEUE)
+        if job is None:
+            return claimed
+        claimed.append(job['id'])
+
+def _statuses():
+    return {i['datescan']:i['status'] for i in jobqueue.jobs(QUEUE)}
+
+def test_submit():
+    assert jobqueue.submit('R',['20220307_1','20220307_2'],QUEUE,recipe='X') == 2
+    assert jobqueue.submit('R',['20220307_1','20220307_3'],QUEUE) == 1
+    job = jobqueue.jobs(QUEUE,region='R')[0]
+    assert job['status'] == 'pending' and '"recipe": "X"' in job['params']
+    with pytest.raises(ValueError):
+        jobqueue.submit('R',['20220307_4'],QUEUE,nonsense=1)
+
+    # Failed jobs go back in the queue, done jobs only with resubmit=True
+    one,two = jobqueue.claim('w',QUEUE),jobqueue.claim('w',QUEUE)
+    jobqueue.finish(one['id'],'it broke',QUEUE)
+    jobqueue.finish(two['id'],None,QUEUE)
+    assert jobqueue.submit('R',['20220307_1','20220307_2'],QUEUE) == 1
+    assert _statuses() == {'20220307_1':'pending','20220307_2':'done','20220307_3':'pending'}
+    assert jobqueue.submit('R',['20220307_2'],QUEUE,resubmit=True) == 1
+
+def test_two_workers_never_claim_the_same_job():
+    jobqueue.submit('R',['20220307_{}'.format(i) for i in range(40)],QUEUE)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        claimed = list(pool.map(_claim_all,['w1','w2']))
+    assert sorted(claimed[0]+claimed[1]) == list(range(1,41))
+    assert len(set(claimed[0]) & set(claimed[1])) == 0
+    assert all(i['status'] == 'running' and i['attempts'] == 1 for i in jobqueue.jobs(QUEUE))
+
+def test_jobs_without_a_heartbeat_go_back_in_the_queue(monkeypatch):
+    jobqueue.submit('R',['20220307_1','20220307_2'],QUEUE)
+    one,two = jobqueue.claim('w1',QUEUE),jobqueue.claim('w1',QUEUE)
+
+    # Both workers went quiet long ago, but one of them is still beating
+    conn = sqlite3.connect(QUEUE)
+    with conn:
+        conn.execute('UPDATE jobs SET heartbeat=0')
+    conn.close()
+    jobqueue.heartbeat(one['id'],QUEUE)
+
+    job = jobqueue.claim('w2',QUEUE)
+    assert job['id'] == two['id'] and job['worker'] is None and job['attempts'] == 1
+    rows = {i['id']:i for i in jobqueue.jobs(QUEUE)}
+    assert rows[one['id']]['worker'] == 'w1' and rows[two['id']]['worker'] == 'w2' and rows[two['id']]['attempts'] == 2
+    assert jobqueue.claim('w2',QUEUE) is None
+
+def test_work_and_status_table(monkeypatch):
+    jobqueue.submit('R',['20220307_1','20220307_2'],QUEUE)
+    jobqueue.submit('S',['20220308_1'],QUEUE)
+    def run_job(job,nprocs=1):
+        if job['datescan'] == '20220307_2':
+            raise RuntimeError('no raw data')
+        return None
+    monkeypatch.setattr(jobqueue,'_run_job',run_job)
+
+    assert jobqueue.work(QUEUE,max_jobs=2) == (2,1)
+    assert _statuses() == {'20220307_1':'done','20220307_2':'failed','20220308_1':'pending'}
+    assert jobqueue.jobs(QUEUE,status='failed')[0]['error'] == 'RuntimeError: no raw data'
+    assert os.path.exists(quicklook.CONTACT_SHEET)
+    assert jobqueue.status_table(QUEUE).split('\n') == [
+        'region                    pending  running     done   failed',
+        'R                               0        0        1        1',
+        'S                               1        0        0        0']
+
+def test_jobs_write_their_own_files(monkeypatch):
+    from SURFING import pipeline,products
+    calls = []
+    class Graph:
+        failed = set()
+        def run(self,nworkers=1):
+            return True
+    def build_pipeline(region,datescans,*args,**kwargs):
+        calls.append(kwargs)
+        return Graph()
+    monkeypatch.setattr(pipeline,'build_pipeline',build_pipeline)
+
+    for datescan in ['20220307_1','20220307_2']:
+        assert jobqueue._run_job({'region':'R','datescan':datescan,'params':{}}) is None
+    for name in ['state_file','summary_file','contact_sheet']:
+        assert calls[0][name] != calls[1][name]
+    assert calls[0]['summary_file'] == os.path.join(jobqueue.job_dir({'region':'R','datescan':'20220307_1'}),'Summary.txt')
+    assert os.path.exists(os.path.join(jobqueue.job_dir({'region':'R','datescan':'20220307_2'}),'product_index.json'))
+    assert not os.path.exists(products.INDEX_FILE)
@@ -0,0 +1,50 @@
+import os
+from types import SimpleNamespace
+from SURFING import manifest
+
+def _raw(datescan,names):
+    path = 'raw/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+    os.makedirs(path,exist_ok=True)
+    for name in names:
+        with open(os.path.join(path,name),'w') as f:
+            f.write(name)
+
+def _reduced(themanifest,datescan,inputs,products):
+    for eachfile in products:
+        os.makedirs(os.path.dirname(eachfile),exist_ok=True)
+        open(eachfile,'w').close()
+    output = SimpleNamespace(datafiles=products,runlog='run.log',imagefiles=[],logfiles=[])
+    manifest.record(themanifest,datescan,inputs,output)
+
+def test_up_to_date_only_with_the_same_inputs_and_products():
+    _raw('20220307_73',['a20220307_00073_01_0001.sdf'])
+    themanifest = {}
+    inputs = manifest.fingerprint('20220307_73','REDUCE_SCIENCE_NARROWLINE')
+    assert not manifest.is_up_to_date(themanifest,'20220307_73',inputs)
+
+    _reduced(themanifest,'20220307_73',inputs,['reduced/20220307/00073/ga20220307_73_1_reduced001.sdf'])
+    assert manifest.is_up_to_date(themanifest,'20220307_73',manifest.fingerprint('20220307_73','REDUCE_SCIENCE_NARROWLINE'))
+
+    # A different recipe, or different bad receptors, means reducing again
+    assert not manifest.is_up_to_date(themanifest,'20220307_73',manifest.fingerprint('20220307_73','REDUCE_SCIENCE_LINEFOREST'))
+    assert not manifest.is_up_to_date(themanifest,'20220307_73',
+                                      manifest.fingerprint('20220307_73','REDUCE_SCIENCE_NARROWLINE',bad_receptors=['NW0L']))
+
+    # So does a product that has gone missing
+    os.remove('reduced/20220307/00073/ga20220307_73_1_reduced001.sdf')
+    assert not manifest.is_up_to_date(themanifest,'20220307_73',inputs)
+
+def test_new_raw_data_or_parameters_change_the_fingerprint():
+    _raw('20220307_73',['a20220307_00073_01_0001.sdf'])
+    with open('SURFING.ini','w') as f:
+        f.write('[REDUCE_SCIENCE_NARROWLINE]\nPIXEL_SCALE = 6.0\n')
+    before = manifest.fingerprint('20220307_73','REDUCE_SCIENCE_NARROWLINE',parfile='SURFING.ini')
+    assert before['hash'] == manifest.fingerprint('20220307_73','REDUCE_SCIENCE_NARROWLINE',parfile='SURFING.ini')['hash']
+
+    with open('SURFING.ini','w') as f:
+        f.write('[REDUCE_SCIENCE_NARROWLINE]\nPIXEL_SCALE = 4.0\n')
+    parchanged = manifest.fingerprint('20220307_73','REDUCE_SCIENCE_NARROWLINE',parfile='SURFING.ini')
+    assert parchanged['hash'] != before['hash']
+
+    _raw('20220307_73',['a20220307_00073_01_0002.sdf'])
+    assert manifest.fingerprint('20220307_73','REDUCE_SCIENCE_NARROWLINE',parfile='SURFING.ini')['hash'] != parchanged['hash']
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+import pytest
+from types import SimpleNamespace
+from SURFING import manifest,plan,screening
+from SURFING.reduce import BAD_RECEPTORS
+
+RECIPE      = 'REDUCE_SCIENCE_NARROWLINE'
+MOL_SUBBAND = {'C18O':1}
+
+@pytest.fixture(autouse=True)
+def no_screening(monkeypatch):
+    # Nothing to screen against, so the plan can tell straight away whether the inputs changed
+    monkeypatch.setattr(screening,'ENABLED',False)
+
+def _raw(datescan,names):
+    path = 'raw/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+    os.makedirs(path,exist_ok=True)
+    for name in names:
+        with open(os.path.join(path,name),'w') as f:
+            f.write(name)
+
+def _record(themanifest,datescan,eachpol,products,exist=True):
+    inputs = manifest.fingerprint(datescan,RECIPE,bad_receptors=sorted(set(BAD_RECEPTORS.get(eachpol,[]))))
+    for eachfile in products:
+        os.makedirs(os.path.dirname(eachfile),exist_ok=True)
+        if exist:
+            open(eachfile,'w').close()
+    output = SimpleNamespace(datafiles=products,runlog='run.log',imagefiles=[],logfiles=[])
+    manifest.record(themanifest,manifest.manifest_key(datescan,eachpol),inputs,output)
+
+def test_imports_without_starlink():
+    # Planning and the rest of the pipeline's modules must import on a machine without Starlink
+    code = ('import sys\n'
+            'import SURFING.reduce, SURFING.postprocess, SURFING.plan\n'
+            'from SURFING import backend\n'
+            'assert "starlink" not in sys.modules, "starlink was imported"\n'
+            'assert not backend.loaded(), "the backend was loaded"\n')
+    env = dict(os.environ,PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = subprocess.run([sys.executable,'-c',code],env=env,capture_output=True,text=True)
+    assert result.returncode == 0,result.stderr
+
+def test_plan_reports_missing_raw_data():
+    theplan = plan.plan('SERPENS_SOUTH',['20220307_1'],RECIPE,MOL_SUBBAND)
+    thisds  = theplan['datescans']['20220307_1']
+    assert thisds['raw'] == 0
+    assert set(thisds['reduce'].values()) == {'no raw data'}
+    assert theplan['coadds']['C18O']['cubes'] == 0
+    assert 'Oh no! No raw data in raw/<YYYYMMDD>/<SSSSS>/ for: 20220307_1' in plan.format_plan(theplan)
+
+def test_plan_reports_missing_products():
+    _raw('20220307_2',['a20220307_00002_01_0001.sdf'])
+    themanifest = {}
+    # The combined reduction's product was deleted, the P0 reduction never made its moment 0 map,
+    # and the P1 reduction has not been run
+    gone = 'reduced/20220307/00002/ga20220307_2_1_reduced001.sdf'
+    _record(themanifest,'20220307_2',None,[gone],exist=False)
+    _record(themanifest,'20220307_2','P0',['reduced/20220307/00002/P0/ga20220307_2_1_reduced001.sdf'])
+    manifest.save_manifest(themanifest)
+
+    theplan = plan.plan('SERPENS_SOUTH',['20220307_2'],RECIPE,MOL_SUBBAND)
+    thisds  = theplan['datescans']['20220307_2']
+    assert thisds['raw'] == 1
+    assert thisds['reduce'] == {'combined':'run (products missing)','P0':'up to date','P1':'run (new)'}
+    assert thisds['missing'] == [gone]
+    assert thisds['molecules']['C18O']['missing'] == ['P0 integ']
+
+    text = plan.format_plan(theplan)
+    assert 'Products recorded in the manifest but missing from disk:' in text
+    assert '    20220307_2: {}'.format(gone) in text
+    assert 'Oh no! No raw data' not in text
@@ -0,0 +1,27 @@
+import pytest
+from SURFING.products import classify
+
+DS = '20220307_73'
+
+@pytest.mark.parametrize('path,expected',[
+    ('reduced/20220307/00073/ga20220307_73_1_reduced001.sdf' ,('combined',1 ,'reduced','sdf',True)),
+    ('reduced/20220307/00073/ga20220307_73_11_reduced001.sdf',('combined',11,'reduced','sdf',True)),
+    ('reduced/20220307/00073/P0/ga20220307_73_1_integ.sdf'   ,('P0'      ,1 ,'integ'  ,'sdf',True)),
+    ('reduced/20220307/00073/P1/ga20220307_73_11_integ.fits' ,('P1'      ,11,'integ'  ,'fits',True)),
+    ('reduced/20220307/00073/a20220307_73_2_sp001.sdf'       ,('combined',2 ,'sp'     ,'sdf',False)),
+    ('reduced/20220307/00073/logfiles/oracdr_run.log'        ,('combined',None,'log'  ,'log',False)),
+    ('reduced/20220307/00073/imagefiles/ga20220307_73_1_rimg.png',('combined',None,'png','png',True)),
+])
+def test_classify(path,expected):
+    product = classify(path,DS)
+    assert (product.pol,product.subband,product.kind,product.ext,product.group) == expected
+    assert product.datescan == DS
+
+def test_subband_1_is_not_subband_11():
+    one    = classify('reduced/20220307/00073/ga20220307_73_1_reduced001.sdf',DS)
+    eleven = classify('reduced/20220307/00073/ga20220307_73_11_reduced001.sdf',DS)
+    assert one.subband == 1 and eleven.subband == 11
+
+def test_classify_residual():
+    product = classify('reduced/20220307/00073/Moment0_residuals/C18O_P1_minus_P0_integ.sdf',DS)
+    assert (product.kind,product.molecule,product.subband) == ('residual','C18O',None)
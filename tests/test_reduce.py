@@ -0,0 +1,48 @@
+import os
+import time
+import pytest
+from SURFING import manifest,reduce,scratch,screening
+from SURFING.manifest import RecordedOutput
+
+JOBS = [('20220307_1',None),('20220307_1','P0'),('20220307_2',None),('20220307_3',None)]
+
+def _fake_oracdr(datescan,recipe,parfile='',eachpol=None,bad_receptors=None):
+    # Later jobs finish first, so the order they complete in is not the order they were submitted in
+    time.sleep(0.1*(4-int(datescan.split('_')[-1]))+(0.1 if eachpol is None else 0))
+    if datescan == '20220307_2':
+        raise RuntimeError('ORACDR exited with status 1')
+    path = 'reduced/{}/{}/{}ga{}_1_reduced001.sdf'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5),
+                                                          '' if eachpol is None else eachpol+'/',datescan)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    open(path,'w').close()
+    return RecordedOutput('run.log',[path],[],[])
+
+@pytest.fixture(autouse=True)
+def fake_oracdr(monkeypatch):
+    monkeypatch.setattr(reduce,'_run_oracdr',_fake_oracdr)
+    monkeypatch.setattr(screening,'ENABLED',False)
+    monkeypatch.setattr(scratch,'SCRATCH_DIR',None)
+    for datescan in dict.fromkeys(i for i,_ in JOBS):
+        path = 'raw/{}/{}'.format(datescan.split('_')[0],datescan.split('_')[-1].zfill(5))
+        os.makedirs(path)
+        with open(os.path.join(path,'a{}_{}_01_0001.sdf'.format(*datescan.split('_'))),'w') as f:
+            f.write(datescan)
+
+@pytest.mark.parametrize('nprocs',[1,2])
+def test_outputs_in_job_order_and_failures_do_not_stop_the_batch(nprocs):
+    outputs,failures = reduce._run_jobs(JOBS,'REDUCE_SCIENCE_NARROWLINE',nprocs=nprocs)
+
+    assert [None if i is None else i.datafiles for i in outputs] == [
+        ['reduced/20220307/00001/ga20220307_1_1_reduced001.sdf'],
+        ['reduced/20220307/00001/P0/ga20220307_1_1_reduced001.sdf'],
+        None,
+        ['reduced/20220307/00003/ga20220307_3_1_reduced001.sdf']]
+    assert [(datescan,eachpol,str(e)) for datescan,eachpol,e in failures] == \
+           [('20220307_2',None,'ORACDR exited with status 1')]
+
+    # The jobs that worked are recorded, so only the failed one runs again
+    themanifest = manifest.load_manifest()
+    assert sorted(themanifest) == ['20220307_1','20220307_1/P0','20220307_3']
+    outputs,failures = reduce._run_jobs(JOBS,'REDUCE_SCIENCE_NARROWLINE',nprocs=nprocs)
+    assert [i is None for i in outputs] == [False,False,True,False]
+    assert len(failures) == 1
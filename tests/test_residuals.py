@@ -0,0 +1,47 @@
+import csv
+import os
+import numpy as np
+from SURFING.residuals import _onto_grid,residual_statistics,write_statistics
+
+def test_residual_statistics():
+    rng = np.random.default_rng(0)
+    P0  = rng.normal(10,1,(3,20,30))
+    P1  = P0+rng.normal(0,0.5,P0.shape)
+    P1[1] = P0[1]*1.1
+    P0[2,:5] = np.nan
+    var = np.full(P0.shape,0.125)
+
+    residuals,stats = residual_statistics(P0,P1,var,var)
+    assert np.array_equal(residuals,P1-P0,equal_nan=True)
+    assert list(stats['npix']) == [600,600,450]
+
+    good = np.isfinite(residuals[2])
+    assert np.isclose(stats['residual_rms'][2],np.sqrt(np.mean(residuals[2][good]**2)))
+    # Noise-like residuals have a normalised rms of about 1
+    assert abs(stats['normalised_rms'][0]-1) < 0.1
+    # A 10% gain difference
+    assert np.isclose(stats['fractional_difference'][1],0.1/1.05)
+
+def test_residual_statistics_without_variances_or_overlap():
+    P0 = np.ones((2,4,4))
+    P1 = np.full((2,4,4),3.0)
+    P1[1] = np.nan
+    with np.errstate(invalid='ignore'):
+        residuals,stats = residual_statistics(P0,P1)
+    assert stats['residual_rms'][0] == 2
+    assert np.all(np.isnan(stats['normalised_rms']))
+    assert stats['npix'][1] == 0 and np.isnan(stats['residual_rms'][1])
+
+def test_onto_grid():
+    array = np.arange(6.0).reshape(2,3)
+    out   = _onto_grid(array,(1,1),(3,3),(0,0))
+    assert np.array_equal(out,[[np.nan]*3,[np.nan,0,1],[np.nan,3,4]],equal_nan=True)
+    assert np.all(np.isnan(_onto_grid(array,(10,10),(3,3),(0,0))))
+
+def test_write_statistics():
+    rows = [{'datescan':'20220307_73','molecule':'CO','npix':10,'residual_rms':0.5,'normalised_rms':1.0,
+             'fractional_difference':0.01,'P0_file':'a','P1_file':'b'}]
+    write_statistics(rows,'reduced/20220307/00073/Moment0_residuals/residual_stats.csv')
+    with open('reduced/20220307/00073/Moment0_residuals/residual_stats.csv',newline='') as f:
+        assert list(csv.DictReader(f)) == [{i:str(j) for i,j in rows[0].items()}]
+    assert os.listdir('reduced/20220307/00073/Moment0_residuals') == ['residual_stats.csv']
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+import pytest
+from SURFING.scheduler import TaskGraph
+
+def _recorder():
+    order = []
+    lock  = threading.Lock()
+    def task(name):
+        with lock:
+            order.append(name)
+        return name
+    return order,task
+
+def _fail(name):
+    raise RuntimeError('{} broke'.format(name))
+
+@pytest.mark.parametrize('nworkers',[1,4])
+def test_tasks_run_after_their_dependencies(nworkers):
+    order,task = _recorder()
+    graph = TaskGraph()
+    # Added before its dependencies, which is allowed
+    graph.add('coadd',task,args=('coadd',),deps=['reduce:1','reduce:2'])
+    graph.add('reduce:1',task,args=('reduce:1',))
+    graph.add('reduce:2',task,args=('reduce:2',))
+    graph.add('residuals:1',task,args=('residuals:1',),deps=['reduce:1'])
+
+    assert graph.run(nworkers=nworkers)
+    assert sorted(order) == sorted(graph.tasks)
+    assert order.index('coadd') > max(order.index('reduce:1'),order.index('reduce:2'))
+    assert order.index('residuals:1') > order.index('reduce:1')
+    assert graph.results['coadd'] == 'coadd'
+    assert not os.path.exists(graph.state_file)
+
+def test_missing_dependency_and_cycles_are_refused():
+    graph = TaskGraph()
+    graph.add('a',print,deps=['b'])
+    with pytest.raises(ValueError):
+        graph.run()
+    graph.add('b',print,deps=['a'])
+    with pytest.raises(ValueError):
+        graph.run()
+    with pytest.raises(ValueError):
+        graph.add('a',print)
+
+def test_failure_blocks_dependents_only():
+    order,task = _recorder()
+    graph = TaskGraph()
+    graph.add('reduce:1',_fail,args=('reduce:1',))
+    graph.add('reduce:2',task,args=('reduce:2',))
+    graph.add('residuals:1',task,args=('residuals:1',),deps=['reduce:1'])
+    graph.add('convert:1',task,args=('convert:1',),deps=['residuals:1'])
+    graph.add('residuals:2',task,args=('residuals:2',),deps=['reduce:2'])
+    graph.add('summary',task,args=('summary',),after=['reduce:1','reduce:2'])
+
+    assert not graph.run(nworkers=2)
+    assert list(graph.failed) == ['reduce:1']
+    assert graph.blocked == {'residuals:1','convert:1'}
+    assert sorted(order) == ['reduce:2','residuals:2','summary']
+    assert not graph.succeeded('reduce:1') and not graph.succeeded('convert:1') and graph.succeeded('reduce:2')
+
+    # The summary ran after a failure, so it isn't recorded as finished
+    with open(graph.state_file) as f:
+        assert sorted(json.load(f)) == ['reduce:2','residuals:2']
+
+def test_resume_skips_finished_tasks(workdir):
+    fixed = []
+    def flaky(name):
+        if not fixed:
+            raise RuntimeError('{} broke'.format(name))
+        return name
+
+    order,task = _recorder()
+    def build():
+        graph = TaskGraph()
+        graph.add('reduce:1',task,args=('reduce:1',),outputs=['out1'],signature='recipe')
+        graph.add('reduce:2',flaky,args=('reduce:2',))
+        graph.add('coadd',task,args=('coadd',),deps=['reduce:1','reduce:2'])
+        return graph
+
+    open('out1','w').close()
+    assert not build().run()
+    assert order == ['reduce:1']
+
+    fixed.append(True)
+    graph = build()
+    assert graph.run()
+    assert graph.skipped == ['reduce:1']
+    assert order == ['reduce:1','coadd']
+    assert not os.path.exists(graph.state_file)
+
+def test_resume_reruns_tasks_whose_outputs_or_signature_changed(workdir):
+    order,task = _recorder()
+    def build(signature):
+        graph = TaskGraph()
+        graph.add('a',task,args=('a',),outputs=['out_a'])
+        graph.add('b',task,args=('b',),signature=signature)
+        graph.add('c',_fail,args=('c',))
+        return graph
+
+    open('out_a','w').close()
+    build('v1').run()
+    os.remove('out_a')
+    build('v2').run()
+    assert order == ['a','b','a','b']
+    build('v2').run(resume=False)
+    assert order == ['a','b','a','b','a','b']
@@ -0,0 +1,120 @@
+import os
+import pytest
+from SURFING import scratch
+from SURFING.bench import stubstar
+
+@pytest.fixture(autouse=True)
+def scratch_area(workdir,monkeypatch):
+    '''
+    A scratch area with room for two datescans of raw files (see _raw)
+    '''
+    monkeypatch.setenv('SURFING_SCRATCH','')
+    monkeypatch.setenv('SURFING_SCRATCH_BUDGET_GB','0')
+    monkeypatch.setattr(scratch,'SCRATCH_DIR',None)
+    scratch.configure('scratch',budget_gb=2500/1e9)
+    return workdir/'scratch'
+
+def _raw(datescan,nfiles=2,size=500):
+    rawpath = scratch._rawpath(datescan)
+    os.makedirs(rawpath,exist_ok=True)
+    for n in range(nfiles):
+        with open(os.path.join(rawpath,'a{}_{:04d}.sdf'.format(datescan,n+1)),'wb') as f:
+            f.write(bytes([n])*size)
+    return rawpath
+
+def _staged():
+    return [datescan for datescan,size in scratch._staged()]
+
+def _use(datescan):
+    with scratch.raw_files(datescan) as files:
+        return files
+
+def test_configure_and_disabled():
+    assert scratch.enabled() and os.environ['SURFING_SCRATCH'] == scratch.SCRATCH_DIR
+    scratch.configure(None)
+    assert not scratch.enabled() and os.environ['SURFING_SCRATCH'] == ''
+    _raw('20220307_1')
+    assert _use('20220307_1') == ['raw/20220307/00001/a20220307_1_0001.sdf','raw/20220307/00001/a20220307_1_0002.sdf']
+
+def test_raw_files_are_staged_once(scratch_area):
+    _raw('20220307_1')
+    files = _use('20220307_1')
+    assert files == [str(scratch_area/'raw/20220307/00001/a20220307_1_000{}.sdf'.format(i)) for i in [1,2]]
+    with open(files[1],'rb') as f:
+        assert f.read() == bytes([1])*500
+
+    # Later reductions use the staged copies, even if raw/ has gone
+    os.remove('raw/20220307/00001/a20220307_1_0001.sdf')
+    assert _use('20220307_1') == files
+    scratch.release('20220307_1')
+    assert _staged() == [] and not os.path.exists(scratch_area/'raw/20220307/00001')
+
+def test_least_recently_used_datescans_make_room():
+    for datescan in ['20220307_1','20220307_2','20220307_3']:
+        _raw(datescan)
+    _use('20220307_1')
+    _use('20220307_2')
+    os.utime(os.path.join(scratch._staged_path('20220307_1'),'complete'),(1e9,1e9))
+    os.utime(os.path.join(scratch._staged_path('20220307_2'),'complete'),(1.1e9,1.1e9))
+    assert _staged() == ['20220307_1','20220307_2']
+
+    # 1 was staged first, but using it again makes 2 the least recently used
+    _use('20220307_1')
+    assert _staged() == ['20220307_2','20220307_1']
+    _use('20220307_3')
+    assert sorted(_staged()) == ['20220307_1','20220307_3']
+
+def test_datescans_in_use_are_not_removed():
+    for datescan in ['20220307_1','20220307_2','20220307_3']:
+        _raw(datescan)
+    _use('20220307_1')
+    _use('20220307_2')
+    with scratch.raw_files('20220307_1'):
+        with scratch.raw_files('20220307_2'):
+            # Neither can be removed, so 3 is read from raw/
+            assert _use('20220307_3') == ['raw/20220307/00003/a20220307_3_0001.sdf','raw/20220307/00003/a20220307_3_0002.sdf']
+    assert sorted(_staged()) == ['20220307_1','20220307_2']
+
+def test_shared_and_exclusive_locks():
+    _raw('20220307_1')
+    with scratch.raw_files('20220307_1'):
+        # Other reductions can share the staged files, but nothing can stage or remove them meanwhile
+        with scratch._locked('20220307_1',exclusive=False,block=False) as got:
+            assert got
+        with scratch._locked('20220307_1',block=False) as got:
+            assert not got
+    with scratch._locked('20220307_1',block=False) as got:
+        assert got
+
+def test_prefetch_stops_when_the_budget_is_full():
+    for datescan in ['20220307_1','20220307_2','20220307_3']:
+        _raw(datescan)
+    scratch.prefetch(['20220307_1','20220307_2','20220307_3']).join()
+    assert sorted(_staged()) == ['20220307_1','20220307_2']
+
+def test_publish_renames_the_products_in_to_place(scratch_area):
+    with scratch.workdir('reduced/20220307/00001') as work:
+        assert work.startswith(str(scratch_area/'work'))
+        names = ['log.20220307_1','ga20220307_1_1_reduced001.sdf','ga20220307_1_1_rimg.png','oractemp123.sdf','x.ok']
+        for name in names:
+            with open(os.path.join(work,name),'w') as f:
+                f.write(name)
+        inodes = {i:os.stat(os.path.join(work,i)).st_ino for i in names}
+        output = stubstar.ORACOutput(os.path.join(work,names[0]),work,[os.path.join(work,names[1])],
+                                     [os.path.join(work,names[2])],[],0)
+        recorded = scratch.publish(output,'reduced/20220307/00001')
+
+    assert recorded.runlog == 'reduced/20220307/00001/logfiles/log.20220307_1'
+    assert recorded.datafiles == ['reduced/20220307/00001/ga20220307_1_1_reduced001.sdf']
+    assert recorded.imagefiles == ['reduced/20220307/00001/imagefiles/ga20220307_1_1_rimg.png']
+    # Moved with a rename (the same files), not copied; ORACDR's temporary files are left behind and removed
+    for path,name in zip([recorded.runlog,recorded.datafiles[0],recorded.imagefiles[0]],names):
+        assert os.stat(path).st_ino == inodes[name]
+    assert sorted(os.listdir('reduced/20220307/00001')) == ['ga20220307_1_1_reduced001.sdf','imagefiles','logfiles']
+    assert not os.path.exists(work)
+
+def test_a_failed_reduction_keeps_its_working_directory():
+    with pytest.raises(RuntimeError):
+        with scratch.workdir('reduced/20220307/00001') as work:
+            raise RuntimeError('ORACDR failed')
+    assert os.path.isdir(work)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from SURFING import screening
+from SURFING.bench import run,stubstar
+
+pytestmark = pytest.mark.usefixtures('stub_backend')
+
+@pytest.fixture(autouse=True)
+def screening_on(monkeypatch):
+    # screening.configure also sets the environment for worker processes -- both are put back after each test
+    monkeypatch.setattr(screening,'ENABLED',True)
+    monkeypatch.setenv('SURFING_SCREEN_RECEPTORS','1')
+
+def _raw(datescan,spoil=None,seed=0):
+    '''
+    Raw data with a bright line in every receptor, then spoil(data,tsys) any way the test likes
+    '''
+    run.make_raw(datescan,nraw=1,ntime=100,nchan=256,seed=seed)
+    path = 'raw/{}/{}/a{}_{}_01_0001.sdf'.format(datescan.split('_')[0],datescan.split('_')[1].zfill(5),
+                                                 datescan.split('_')[0],datescan.split('_')[1].zfill(5))
+    if spoil is not None:
+        ndf = stubstar._load(path)
+        spoil(ndf['DATA_ARRAY']['DATA'],ndf['MORE']['ACSIS']['TSYS'])
+        stubstar._save(path,ndf)
+
+def test_lines_are_not_spikes():
+    _raw('20220307_1')
+    result = screening.screen('20220307_1')
+    assert result['bad'] == []
+    assert max(i['spike_fraction'] for i in result['receptors'].values()) < screening.SPIKE_FRACTION
+
+def test_spiky_noisy_and_hot_receptors_are_found():
+    r = run.RECEPTORS
+    def spoil(data,tsys):
+        rng = np.random.default_rng(1)
+        data[rng.integers(0,100,200),r.index('NU0L'),rng.integers(0,256,200)] = 40
+        data[:,r.index('NW1U'),:] *= 3
+        tsys[:,r.index('NA1L')] *= 2
+    _raw('20220307_2',spoil)
+    result = screening.screen('20220307_2')
+    assert result['bad'] == ['NA1L','NU0L','NW1U']
+    assert 'spikes' in result['receptors']['NU0L']['reasons']
+    assert result['receptors']['NW1U']['reasons'] == ['noisy']
+    assert result['receptors']['NA1L']['reasons'] == ['tsys']
+
+def test_a_whole_polarisation_is_never_left_out():
+    r = run.RECEPTORS
+    def spoil(data,tsys):
+        for i in [i for i in r if i[2] == '1']:
+            data[:,r.index(i),:] = stubstar.VAL__BADR
+    _raw('20220307_3',spoil)
+    result = screening.screen('20220307_3')
+    assert result['bad'] == []
+    assert sorted(result['kept']) == sorted(i for i in r if i[2] == '1')
+
+def test_results_are_cached_until_the_raw_data_change():
+    _raw('20220307_4')
+    assert screening.bad_receptors('20220307_4',compute=False) is None
+    assert screening.bad_receptors('20220307_4') == []
+    assert screening.bad_receptors('20220307_4',compute=False) == []
+    screening.configure(False)
+    assert screening.bad_receptors('20220307_4') == []
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from SURFING import ndfio,tiledmosaic
+from SURFING.bench import stubstar
+
+pytestmark = pytest.mark.usefixtures('stub_backend')
+
+nan = np.nan
+
+# Two cubes of 2 channels on a common pixel grid (NumPy axis order: channel,y,x):
+#     a.sdf covers y=1:3, x=1:4 with data 1 and variance 1
+#     b.sdf covers y=2:4, x=3:6 with data 3 and variance 4, except for one bad pixel at y=2, x=3
+# so the mosaic covers y=1:4, x=1:6 and, worked out by hand, is the same in both channels:
+EXPECTED_DATA = [[1.0,1.0,1.0,1.0,nan,nan],
+                 [1.0,1.0,1.0,2.0,3.0,3.0],
+                 [1.0,1.0,2.0,2.0,3.0,3.0],
+                 [nan,nan,3.0,3.0,3.0,3.0]]
+# (1+4)/2**2 where both have data
+EXPECTED_VAR  = [[1.0,1.0,1.0,1.0, nan, nan],
+                 [1.0,1.0,1.0,1.25,4.0,4.0],
+                 [1.0,1.0,1.25,1.25,4.0,4.0],
+                 [nan,nan,4.0,4.0, 4.0, 4.0]]
+
+def _inputs():
+    stubstar.write_ndf('a.sdf',np.ones((2,3,4)),origin=(1,1,1),variance=np.ones((2,3,4)))
+    b = np.full((2,3,4),3.0)
+    b[:,0,0] = nan
+    stubstar.write_ndf('b.sdf',b,origin=(1,2,3),variance=np.full((2,3,4),4.0))
+    return ['a.sdf','b.sdf']
+
+def _check(path):
+    data,origin = ndfio.read_ndf(path)
+    var,_       = ndfio.read_ndf(path,'VARIANCE')
+    assert origin == (1,1,1)
+    assert data.shape == (2,4,6)
+    for channel in range(2):
+        np.testing.assert_allclose(data[channel],EXPECTED_DATA,rtol=1e-6,atol=1e-6)
+        np.testing.assert_allclose(var[channel],EXPECTED_VAR,rtol=1e-6,atol=1e-6)
+
+@pytest.mark.parametrize('nprocs,max_tile_mb',[(1,256),(1,1e-4),(2,1e-4)])
+def test_tiled_mosaic_of_known_cubes(nprocs,max_tile_mb):
+    # 1e-4 MB leaves room for one spectrum per tile, so every pixel is its own tile
+    tiledmosaic.mosaic(_inputs(),'out.sdf',nprocs=nprocs,max_tile_mb=max_tile_mb)
+    _check('out.sdf')
+
+def test_workers_read_one_tile_at_a_time(monkeypatch):
+    reads,aligned = [],[]
+    read_ndf = ndfio.read_ndf
+    def recording_read_ndf(path,component='DATA'):
+        array,origin = read_ndf(path,component)
+        if array is not None:
+            reads.append(array.size)
+        return array,origin
+    def recording_wcsalign(inndf,out,**kwargs):
+        aligned.append(inndf)
+        stubstar.ndfcopy(inndf,out)
+    monkeypatch.setattr(ndfio,'read_ndf',recording_read_ndf)
+    monkeypatch.setattr(stubstar,'wcsalign',recording_wcsalign)
+
+    tiledmosaic.mosaic(_inputs(),'out.sdf',ref='b.sdf',max_tile_mb=1e-4)
+    # The reference is used as it is, and nothing bigger than a tile (one spectrum) is read
+    assert aligned == ['a.sdf']
+    assert max(reads) == 2
+    _check('out.sdf')
+
+def test_stub_wcsmosaic_of_known_cubes():
+    # The benchmark checks the tiled engine against the stub, so the stub has to be right too
+    with open('in.lis','w') as f:
+        f.write('\n'.join(_inputs())+'\n')
+    stubstar.wcsmosaic('^in.lis',out='out.sdf',ref='a.sdf')
+    _check('out.sdf')
+
+def test_tiles_cover_the_grid_once():
+    tiles  = tiledmosaic._tiles([1,-5,3],[10,7,9],10*8*tiledmosaic._ARRAYS_PER_TILE*12/1e6)
+    hits   = np.zeros((7,9),dtype=int)
+    for origin,shape in tiles:
+        assert origin[0] == 1 and shape[0] == 10
+        assert shape[1]*shape[2] <= 12
+        hits[origin[1]+5:origin[1]+5+shape[1],origin[2]-3:origin[2]-3+shape[2]] += 1
+    assert (hits == 1).all()
+
+def test_compare():
+    stubstar.write_ndf('one.sdf',np.array([[[1.0,2.0,nan]]]))
+    stubstar.write_ndf('two.sdf',np.array([[[1.0,2.0+1e-5,nan]]]))
+    stubstar.write_ndf('three.sdf',np.array([[[1.0,2.0,5.0]]]))
+    assert tiledmosaic.compare('one.sdf','two.sdf')['match']
+    assert not tiledmosaic.compare('one.sdf','two.sdf',rtol=0,atol=1e-6)['match']
+    result = tiledmosaic.compare('one.sdf','three.sdf')
+    assert result['nmismatch_bad'] == 1 and not result['match']